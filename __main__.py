@@ -1,19 +1,75 @@
-from twisted.internet import reactor, endpoints
-from twisted.web.wsgi import WSGIResource
+from twisted.internet import reactor
 from twisted.python.threadpool import ThreadPool
-from twisted.web import static, server
-from twisted.application import service, strports
-from twisted.web.server import Site
-import privadome_frontend.backend.wsgi as a
+import argparse
 import os, sys
+import socket
 import sqlite3
 
-def main():
-    wsgiThreadPool = ThreadPool()
-    wsgiThreadPool.start()
-    reactor.addSystemEventTrigger('after', 'shutdown', wsgiThreadPool.stop)
-    wsgiAppAsResource = WSGIResource(reactor, wsgiThreadPool, a.application)
+from privadome_frontend.supervisor import DrainableSite
 
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'privadome_frontend.backend.settings')
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compress_static:
+        from privadome_frontend.staticfiles import compress_static
+        for path in compress_static(os.path.join(module_path(), "static")):
+            print(path)
+        return
+    if args.import_profile:
+        from privadome_frontend.startup import format_digest, import_profile
+        print(format_digest(import_profile(args.import_profile)))
+        return
+    if args.workers > 1 and args.listen_fd is None:
+        from privadome_frontend.supervisor import Supervisor
+        extraArgs = ['--lazy', args.lazy] if args.lazy else []
+        Supervisor(args.port, args.workers, extraArgs).run()
+        return
+
+    site = build_site(args.lazy)
+    if args.listen_fd is not None:
+        from privadome_frontend.supervisor import drain_on_shutdown
+        port = reactor.adoptStreamPort(args.listen_fd, socket.AF_INET, site)
+        os.close(args.listen_fd)
+        drain_on_shutdown(reactor, port, site, args.shutdown_timeout)
+    else:
+        reactor.listenTCP(args.port, site)
+    if args.heartbeat_fd is not None:
+        from privadome_frontend.supervisor import start_heartbeat
+        start_heartbeat(reactor, args.heartbeat_fd)
+    install_profiler_signal()
+    reactor.run()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='privadome_frontend')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='HTTP port to listen on')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port')
+    parser.add_argument('--compress-static', action='store_true',
+                        help='write precompressed variants of the static '
+                             'files and exit')
+    parser.add_argument('--lazy', nargs='?', const='background',
+                        choices=('background', 'request'),
+                        help='listen before loading Django, which is then '
+                             'loaded in the background (default) or on the '
+                             'first API request')
+    parser.add_argument('--import-profile', type=int, nargs='?', const=15,
+                        metavar='TOP',
+                        help='print where the import time of the API goes '
+                             'and exit')
+    # Set by the supervisor for the worker processes it starts.
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--heartbeat-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--shutdown-timeout', type=float, default=30.0,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def build_site(lazy=None):
+    """
+    The site, with the API and stream resources loaded later when lazy
+    is 'background' or 'request'.
+    """
     BASE_DIR = module_path()
     print(BASE_DIR)
     if check_first_run(BASE_DIR):
@@ -24,12 +80,126 @@ def main():
             print(ex)
             raise ex
 
-    root = static.File(os.path.join(BASE_DIR, "static"))
-    index = static.File(os.path.join(BASE_DIR, "static/index.html"))
-    root.putChild(b"api", wsgiAppAsResource)
-    root.childNotFound = index
-    reactor.listenTCP(8080, Site(root))
-    reactor.run()
+    root = static_resource(os.path.join(BASE_DIR, "static"))
+    if not lazy:
+        for name, child in django_resources().items():
+            root.putChild(name, child)
+        return DrainableSite(root)
+
+    from privadome_frontend.api import stats
+    from privadome_frontend.startup import LazyLoader, LazyResource, load_django
+    loader = LazyLoader(reactor, root, load_django, django_resources)
+    stats.register('startup', loader.stats)
+    for name in (b"api", b"stream"):
+        root.putChild(name, LazyResource(loader, name))
+    if lazy == 'background':
+        reactor.callWhenRunning(loader.load)
+    return DrainableSite(root)
+
+def django_resources():
+    """ The resources served by Django, by path segment. """
+    import privadome_frontend.backend.wsgi as a
+    from django.conf import settings
+    from privadome_frontend.api import stats
+    from privadome_frontend.threadpools import SheddingWSGIResource, pool_stats
+    wsgiThreadPool = wsgi_thread_pool(
+        'wsgi',
+        getattr(settings, 'PRIVADOME_WSGI_MIN_THREADS', 5),
+        getattr(settings, 'PRIVADOME_WSGI_MAX_THREADS', 20),
+        getattr(settings, 'PRIVADOME_WSGI_MAX_QUEUE', 100))
+    wsgiAppAsResource = SheddingWSGIResource(reactor, wsgiThreadPool,
+                                             a.application)
+    coreWsgiAppAsResource = None
+    if getattr(settings, 'PRIVADOME_CORE_WSGI_MAX_THREADS', 0) > 0:
+        coreThreadPool = wsgi_thread_pool(
+            'core',
+            getattr(settings, 'PRIVADOME_CORE_WSGI_MIN_THREADS', 2),
+            settings.PRIVADOME_CORE_WSGI_MAX_THREADS,
+            getattr(settings, 'PRIVADOME_CORE_WSGI_MAX_QUEUE', 100))
+        coreWsgiAppAsResource = SheddingWSGIResource(reactor, coreThreadPool,
+                                                     a.application)
+    stats.register('thread_pools', pool_stats)
+    authThreadPool = auth_thread_pool()
+    return {
+        b"api": api_resource(wsgiAppAsResource, coreWsgiAppAsResource,
+                             authThreadPool),
+        b"stream": stream_resource(authThreadPool),
+    }
+
+def install_profiler_signal():
+    """ Profile the process for a while on SIGUSR2. """
+    from django.conf import settings
+    from privadome_frontend.profiler import install_signal_handler
+    install_signal_handler(
+        seconds=getattr(settings, 'PRIVADOME_PROFILE_SIGNAL_SECONDS', 30),
+        interval=getattr(settings, 'PRIVADOME_PROFILE_INTERVAL', 0.01),
+        directory=getattr(settings, 'PRIVADOME_PROFILE_DIR', None))
+
+def static_resource(directory):
+    """ The static bundle, served from memory unless disabled. """
+    from django.conf import settings
+    from privadome_frontend.staticfiles import (CompressedStaticFile,
+                                                MemoryStaticResource)
+    if not getattr(settings, 'PRIVADOME_STATIC_IN_MEMORY', True):
+        root = CompressedStaticFile(directory)
+        root.childNotFound = CompressedStaticFile(
+            os.path.join(directory, "index.html"))
+        return root
+    root = MemoryStaticResource(directory)
+    interval = getattr(settings, 'PRIVADOME_STATIC_WATCH_INTERVAL', 2)
+    if interval > 0:
+        root.watch(reactor, interval)
+    return root
+
+def wsgi_thread_pool(name, minthreads, maxthreads, maxQueue):
+    """ Start an instrumented, load-shedding WSGI thread pool. """
+    from privadome_frontend.threadpools import InstrumentedThreadPool
+    threadPool = InstrumentedThreadPool(minthreads, maxthreads, name,
+                                        maxQueue)
+    threadPool.start()
+    reactor.addSystemEventTrigger('after', 'shutdown', threadPool.stop)
+    return threadPool
+
+def auth_thread_pool():
+    """
+    Small thread pool, separate from the WSGI pool, validating tokens
+    for the resources served on the reactor.
+    """
+    from django.conf import settings
+    authThreadPool = ThreadPool(
+        minthreads=1,
+        maxthreads=getattr(settings, 'PRIVADOME_AUTH_THREADS', 4),
+        name='auth')
+    authThreadPool.start()
+    reactor.addSystemEventTrigger('after', 'shutdown', authThreadPool.stop)
+    return authThreadPool
+
+def api_resource(wsgiAppAsResource, coreWsgiAppAsResource, authThreadPool):
+    """
+    Resource mounted at /api. With PRIVADOME_REACTOR_PROXY enabled the
+    core proxy endpoints are answered on the reactor instead of the
+    WSGI thread pool, otherwise they run on their own core WSGI pool
+    when one is configured.
+    """
+    from django.conf import settings
+    from privadome_frontend.coreproxy import ApiResource, CoreProxyResource
+    proxyResource = None
+    if getattr(settings, 'PRIVADOME_REACTOR_PROXY', False):
+        proxyResource = CoreProxyResource(reactor, authThreadPool)
+    if proxyResource is None and coreWsgiAppAsResource is None:
+        return wsgiAppAsResource
+    return ApiResource(wsgiAppAsResource, proxyResource,
+                       coreWsgiAppAsResource)
+
+def stream_resource(authThreadPool):
+    """ Resource mounted at /stream pushing tile updates. """
+    from django.conf import settings
+    from privadome_frontend.api import stats
+    from privadome_frontend.tilestream import TileHub, TileStreamResource
+    hub = TileHub(reactor,
+                  getattr(settings, 'PRIVADOME_TILE_STREAM_INTERVAL', 2))
+    stats.register('tile_stream', hub.stats)
+    return TileStreamResource(reactor, authThreadPool, hub)
 
 def initialize_installation():
     from privadome_frontend import manage
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'privadome_frontend.api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .authentication import check_revocation_cache
+        check_revocation_cache()
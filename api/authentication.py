@@ -1,30 +1,237 @@
 """
 Expiring token authentication.
+
+Tokens are either rows of the authtoken table (ExpiringTokenAuthentication)
+or self-contained signed tokens (SignedTokenAuthentication), chosen with
+the PRIVADOME_AUTH_TOKENS setting.
 """
+import collections
 import datetime
+import threading
+import time
+import uuid
 
 from rest_framework.authentication import TokenAuthentication
 from rest_framework import exceptions
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
 from django.utils.translation import ugettext_lazy as _
 
+from privadome_frontend.supervisor import worker_count
+
+from . import metrics, stats
+
+
+class TokenCache:
+    """
+    Bounded cache of validated tokens, key -> (user, token).
+    Entries expire after ttl seconds and are dropped explicitly when
+    their token or user changes.
+    """
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, key, user, token):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, user, token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_key(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[1].pk == user_id:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def token_cache_ttl():
+    """
+    Seconds validated tokens are cached for. The cache is disabled when
+    several workers serve the API: it is per process, and a token deleted
+    through one worker would still be accepted by the others.
+    """
+    if worker_count() > 1:
+        return 0
+    return getattr(settings, 'PRIVADOME_TOKEN_CACHE_TTL', 60)
+
+
+TOKEN_CACHE = TokenCache(
+    ttl=token_cache_ttl(),
+    max_entries=getattr(settings, 'PRIVADOME_TOKEN_CACHE_SIZE', 1024))
+
+stats.register('token_cache', TOKEN_CACHE.stats)
+
+
 class ExpiringTokenAuthentication(TokenAuthentication):
     """
     Expiring token authentication.
     """
     def authenticate_credentials(self, key):
-        model = self.get_model()
-        try:
-            token = model.objects.select_related('user').get(key=key)
-        except model.DoesNotExist:
-            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        cached = TOKEN_CACHE.get(key)
+        if cached is not None:
+            user, token = cached
+        else:
+            model = self.get_model()
+            try:
+                token = model.objects.select_related('user').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            user = token.user
 
-        if not token.user.is_active:
+        if not user.is_active:
             raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
 
         utc_now = datetime.datetime.utcnow()
 
         if token.created < utc_now - datetime.timedelta(hours=24):
+            TOKEN_CACHE.invalidate_key(key)
+            raise exceptions.AuthenticationFailed(_('Token has expired'))
+
+        if cached is None:
+            TOKEN_CACHE.set(key, user, token)
+        return (user, token)
+
+
+SIGNED_TOKEN_SALT = 'privadome_frontend.api.signed_token'
+
+
+def signed_tokens_enabled():
+    """ Whether signed tokens are issued instead of database tokens. """
+    return getattr(settings, 'PRIVADOME_AUTH_TOKENS', 'db') == 'signed'
+
+
+def signed_token_max_age():
+    return getattr(settings, 'PRIVADOME_SIGNED_TOKEN_MAX_AGE', 24 * 60 * 60)
+
+
+def check_revocation_cache():
+    """
+    Raise ImproperlyConfigured when signed tokens are enabled and the
+    default cache, where their revocations are kept, is local to the
+    process: a revoked token would still be accepted by the other
+    workers and by every process after a restart.
+    """
+    if not signed_tokens_enabled():
+        return
+    backend = import_string(settings.CACHES[DEFAULT_CACHE_ALIAS]['BACKEND'])
+    if issubclass(backend, (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            'PRIVADOME_AUTH_TOKENS = \'signed\' requires a default cache '
+            'shared by every process, {} is not.'.format(backend.__name__))
+
+
+def issue_signed_token(user):
+    """ Sign a self-expiring token carrying the claims of user. """
+    return signing.dumps({
+        'uid': user.pk,
+        'usr': user.username,
+        'stf': user.is_staff,
+        'adm': user.is_superuser,
+        'iat': time.time(),
+        'jti': uuid.uuid4().hex,
+    }, salt=SIGNED_TOKEN_SALT, compress=True)
+
+
+def revoke_signed_token(claims):
+    """ Revoke a single signed token, used on logout. """
+    cache.set('signed_token:revoked:' + claims['jti'], True,
+              signed_token_max_age())
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revoke every signed token issued to a user so far,
+    used on password change and deactivation.
+    """
+    cache.set('signed_token:not_before:{}'.format(user_id), time.time(),
+              signed_token_max_age())
+
+
+def _revoked(claims):
+    not_before = cache.get('signed_token:not_before:{}'.format(claims['uid']))
+    if not_before is not None and claims['iat'] <= not_before:
+        return True
+    return cache.get('signed_token:revoked:' + claims['jti'], False)
+
+
+class SignedTokenAuthentication(TokenAuthentication):
+    """
+    HMAC signed, self-expiring token authentication.
+    Tokens are verified without any database access, the user is
+    rebuilt from the signed claims.
+    """
+    def authenticate_credentials(self, key):
+        try:
+            claims = signing.loads(key, salt=SIGNED_TOKEN_SALT,
+                                   max_age=signed_token_max_age())
+        except signing.SignatureExpired:
             raise exceptions.AuthenticationFailed(_('Token has expired'))
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if _revoked(claims):
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
 
-        return (token.user, token)
+        user = User(id=claims['uid'], username=claims['usr'],
+                    is_staff=claims['stf'], is_superuser=claims['adm'],
+                    is_active=True)
+        return (user, claims)
+
+
+def token_authentication():
+    """ An instance of the configured token authentication. """
+    if signed_tokens_enabled():
+        return SignedTokenAuthentication()
+    return ExpiringTokenAuthentication()
+
+
+class ConfiguredTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication with the backend selected by PRIVADOME_AUTH_TOKENS.
+    """
+    def authenticate_credentials(self, key):
+        with metrics.phase('auth'):
+            return token_authentication().authenticate_credentials(key)
@@ -0,0 +1,234 @@
+"""
+Bulk policy changes.
+
+A bulk request carries an ordered list of policy operations, each one a
+core verb and the body its single-change endpoint takes:
+
+    {"operations": [{"op": "add_client", "payload": {"address": "..."}},
+                    ...],
+     "atomic": false}
+
+Every operation is validated before the first one is sent, then they are
+sent in order over one pooled core connection. An operation rejected by
+the core does not stop the others, unless the request is atomic: the
+remaining operations are then skipped and the applied ones are undone in
+reverse order. The undo calls are derived from the module state the core
+returns, the same state the policy endpoints answer with.
+"""
+from procbridge.errors import ProtocolError, ServerError
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+
+from .pool import DeadlineExceeded
+
+# Core verb -> payload key naming the policy level it changes.
+OPERATIONS = {
+    'add_group': 'groupname',
+    'add_client': 'address',
+    'delete_group': 'groupname',
+    'delete_client': 'address',
+    'update_network_policy': None,
+    'update_group_policy': 'groupname',
+    'update_client_policy': 'address',
+}
+
+OK = 'ok'
+ERROR = 'error'
+SKIPPED = 'skipped'
+ROLLED_BACK = 'rolled_back'
+ROLLBACK_FAILED = 'rollback_failed'
+
+
+def validate(data, max_operations):
+    """
+    Return the (verb, payload) operations and the atomic flag of a bulk
+    request, raise ValidationError listing every invalid operation.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError({'operations': 'A non-empty list of operations'
+                                             ' is required.'})
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        raise ValidationError({'operations': 'A non-empty list of operations'
+                                             ' is required.'})
+    if len(operations) > max_operations:
+        raise ValidationError({'operations': 'At most {} operations can be'
+                                             ' applied at once.'
+                                             .format(max_operations)})
+    atomic = data.get('atomic', False)
+    if not isinstance(atomic, bool):
+        raise ValidationError({'atomic': 'Must be a boolean.'})
+
+    errors = {}
+    for index, operation in enumerate(operations):
+        error = _invalid(operation)
+        if error:
+            errors[str(index)] = error
+    if errors:
+        raise ValidationError({'operations': errors})
+    return [(op['op'], op['payload']) for op in operations], atomic
+
+
+def _invalid(operation):
+    if not isinstance(operation, dict):
+        return 'An operation must be an object.'
+    verb = operation.get('op')
+    if verb not in OPERATIONS:
+        return 'Unknown operation {!r}.'.format(verb)
+    payload = operation.get('payload')
+    if not isinstance(payload, dict):
+        return 'The payload must be an object.'
+    key = OPERATIONS[verb]
+    if key is not None and not isinstance(payload.get(key), str):
+        return 'The payload must name the {}.'.format(key)
+    return None
+
+
+def is_state(reply):
+    """ Whether a core reply is the module state. """
+    return isinstance(reply, dict)\
+        and any(key in reply for key in ('network', 'group', 'address'))
+
+
+def inverse(verb, payload, state):
+    """
+    The (verb, payload) calls undoing verb(payload) applied to the module
+    state, in order.
+    """
+    key = OPERATIONS[verb]
+    name = payload.get(key) if key else None
+    groups = state.get('group') or {}
+    addresses = state.get('address') or {}
+    if verb == 'add_group':
+        return [] if name in groups\
+            else [('delete_group', {'groupname': name})]
+    if verb == 'add_client':
+        return [] if name in addresses\
+            else [('delete_client', {'address': name})]
+    if verb == 'delete_group':
+        if name not in groups:
+            return []
+        group = groups[name] or {}
+        calls = [('add_group', {'groupname': name,
+                                'members': group.get('members') or []})]
+        if group.get('module_policies'):
+            calls.append(('update_group_policy', {
+                'groupname': name,
+                'module_policies': group['module_policies']}))
+        return calls
+    if verb == 'delete_client':
+        if name not in addresses:
+            return []
+        calls = [('add_client', {'address': name})]
+        policies = (addresses[name] or {}).get('module_policies')
+        if policies:
+            calls.append(('update_client_policy', {
+                'address': name, 'module_policies': policies}))
+        return calls
+    if verb == 'update_group_policy':
+        policies = (groups.get(name) or {}).get('module_policies')
+        return [(verb, {'groupname': name, 'module_policies': policies or {}})]
+    if verb == 'update_client_policy':
+        policies = (addresses.get(name) or {}).get('module_policies')
+        return [(verb, {'address': name, 'module_policies': policies or {}})]
+    return [(verb, (state.get('network') or {}).get('module_policies') or {})]
+
+
+def apply(pool, breaker, operations, atomic=False, deadline=None):
+    """
+    Send operations to the core through pool and return the status and
+    body of the bulk response.
+    Raise CircuitOpen without calling the core while its circuit is open,
+    and the error of the core call when it fails before any operation was
+    answered.
+    """
+    breaker.before()
+    results = [{'op': verb, 'status': SKIPPED} for verb, _ in operations]
+    applied = []
+    state = before = None
+    failed = False
+    try:
+        with pool.session(deadline) as session:
+            if atomic:
+                state = before = session.request('read_state')
+            for index, (verb, payload) in enumerate(operations):
+                if failed and atomic:
+                    break
+                undo = inverse(verb, payload, state) if atomic else None
+                try:
+                    reply = session.request(verb, payload)
+                except ServerError as ex:
+                    results[index].update(status=ERROR, error=str(ex))
+                    failed = True
+                    continue
+                except (OSError, ProtocolError, DeadlineExceeded) as ex:
+                    results[index].update(status=ERROR, error=_error(ex))
+                    raise
+                results[index]['status'] = OK
+                applied.append((index, undo))
+                if is_state(reply):
+                    state = reply
+                elif atomic:
+                    state = session.request('read_state')
+    except ServerError:
+        breaker.success()
+        if not applied and not failed:
+            raise
+        failed = True
+    except Exception as ex:
+        # Only the core timeout counts, not a shorter one of the client.
+        if isinstance(ex, DeadlineExceeded) and deadline is not None:
+            breaker.release()
+        else:
+            breaker.failure()
+        if not applied and not failed:
+            raise
+        failed = True
+    else:
+        breaker.success()
+
+    if not (atomic and failed):
+        code = status.HTTP_207_MULTI_STATUS if failed else status.HTTP_200_OK
+        return code, {'atomic': atomic, 'results': results, 'state': state}
+
+    if rollback(pool, applied, results):
+        return status.HTTP_409_CONFLICT,\
+            {'atomic': atomic, 'results': results, 'state': before}
+    return status.HTTP_500_INTERNAL_SERVER_ERROR,\
+        {'atomic': atomic, 'results': results, 'state': None}
+
+
+def rollback(pool, applied, results):
+    """
+    Undo the applied (index, undo calls) operations in reverse order,
+    whatever the state of the circuit. Return whether all were undone.
+    """
+    pending = list(reversed(applied))
+    undone = True
+    try:
+        with pool.session() as session:
+            while pending:
+                index, undo = pending[0]
+                try:
+                    for call in undo:
+                        session.request(*call)
+                except ServerError as ex:
+                    results[index].update(status=ROLLBACK_FAILED,
+                                          error=_error(ex))
+                    undone = False
+                else:
+                    results[index]['status'] = ROLLED_BACK
+                pending.pop(0)
+    except Exception as ex:
+        for index, _ in pending:
+            results[index].update(status=ROLLBACK_FAILED, error=_error(ex))
+        undone = False
+    return undone
+
+
+def _error(ex):
+    if isinstance(ex, ServerError):
+        return str(ex)
+    if isinstance(ex, DeadlineExceeded):
+        return 'Timeout'
+    return 'Core unavailable'
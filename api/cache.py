@@ -0,0 +1,309 @@
+"""
+In-process caches for core responses.
+"""
+import collections
+import threading
+import time
+
+from . import jsoncodec, metrics, stats
+
+_CACHES = []
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into one call.
+    Callers arriving while a call is in flight wait for its result.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """ Call function once for all concurrent callers of key. """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class TTLCache:
+    """
+    Thread-safe cache whose entries expire after ttl seconds.
+    A ttl of 0 disables caching. With single_flight, concurrent
+    misses of the same key produce a single load.
+    """
+
+    def __init__(self, name, ttl, single_flight=True):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+        self._flight = SingleFlight() if single_flight else None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        _CACHES.append(self)
+
+    def get_or_load(self, key, loader):
+        """ Return the cached value of key, calling loader on a miss. """
+        hit, value = self.lookup(key)
+        if hit:
+            return value
+        generation = value
+
+        if self._flight is None:
+            return self._load(key, loader, generation)
+        # Callers arriving after an invalidation must not join a load
+        # that started before it.
+        return self._flight.do((key, generation),
+                               lambda: self._load(key, loader, generation))
+
+    def _load(self, key, loader, generation):
+        return self.store(key, loader(), generation)
+
+    def lookup(self, key):
+        """
+        Return (True, value) when key is cached, or (False, generation)
+        on a miss, to be given to store() with the loaded value.
+        For callers that cannot block on a load.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, self._generation
+
+    def store(self, key, value, generation):
+        """ Cache value loaded for key after a miss of generation. """
+        with self._lock:
+            # Results loaded across an invalidation may predate it.
+            if self.ttl > 0 and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        """ Drop one entry, or every entry when no key is given. """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'coalesced': self._flight.coalesced if self._flight else 0,
+            }
+
+
+class StaleWhileRevalidateCache:
+    """
+    LRU cache of at most max_entries keys and max_bytes bytes of values,
+    with a freshness window per key. A value is sized by its JSON
+    encoding when it is loaded; a value larger than max_bytes on its own
+    is served but not kept.
+
+    Fresh entries are served as they are. Entries past their freshness
+    but within the stale window are served immediately while a single
+    background refresh is submitted to the executor. Older or missing
+    entries are loaded synchronously; when that load fails, an older
+    entry is still served as stale.
+    """
+    HIT = 'hit'
+    STALE = 'stale'
+    MISS = 'miss'
+
+    def __init__(self, name, executor, max_entries=256, max_bytes=None,
+                 freshness=None, default_freshness=1.0, stale_window=10.0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.freshness = freshness or {}
+        self.default_freshness = default_freshness
+        self.stale_window = stale_window
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.stale_on_error = 0
+        _CACHES.append(self)
+
+    def fresh_for(self, key):
+        """ Freshness window of key in seconds. """
+        return self.freshness.get(key, self.default_freshness)
+
+    def fresh(self, key):
+        """
+        Return the value of key while it is fresh, counted as a hit,
+        or None. For callers that cannot block on get().
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None\
+                    or time.monotonic() - entry[0] >= self.fresh_for(key):
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get(self, key, loader):
+        """
+        Return the value of key and whether it was a
+        hit, a stale hit or a miss.
+        """
+        now = time.monotonic()
+        fresh_for = self.fresh_for(key)
+        expired = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[0]
+                if age < fresh_for:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], self.HIT
+                if age < fresh_for + self.stale_window:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    refresh = key not in self._refreshing
+                    if refresh:
+                        self._refreshing.add(key)
+                    value = entry[1]
+                else:
+                    expired, entry = entry, None
+            if entry is None:
+                self.misses += 1
+
+        if entry is None:
+            try:
+                return self._load(key, loader), self.MISS
+            except Exception:
+                if expired is None:
+                    raise
+                with self._lock:
+                    self.stale_on_error += 1
+                return expired[1], self.STALE
+        if refresh:
+            self._executor.submit(self._refresh, key, loader)
+        return value, self.STALE
+
+    def _load(self, key, loader):
+        value = loader()
+        if self.fresh_for(key) <= 0:
+            return value
+        size = self.size(value)
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                self.evictions += 1
+                return value
+            self._entries[key] = (time.monotonic(), value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None
+                    and self.bytes > self.max_bytes):
+                self.bytes -= self._entries.popitem(last=False)[1][2]
+                self.evictions += 1
+        return value
+
+    @staticmethod
+    def size(value):
+        """ Bytes of the JSON encoding of value. """
+        try:
+            return len(jsoncodec.dumps(value))
+        except (TypeError, ValueError):
+            return len(repr(value))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _refresh(self, key, loader):
+        try:
+            with metrics.background(self.name + '_refresh'):
+                self._load(key, loader)
+            with self._lock:
+                self.refreshes += 1
+        except Exception as ex:
+            print(ex)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """ Drop one entry, or every entry when no key is given. """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.bytes = 0
+            else:
+                self._pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'evictions': self.evictions,
+                'stale_on_error': self.stale_on_error,
+            }
+
+
+def cache_stats():
+    """ Statistics of every cache. """
+    return {cache.name: cache.stats() for cache in _CACHES}
+
+
+stats.register('caches', cache_stats)
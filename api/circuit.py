@@ -0,0 +1,155 @@
+"""
+Circuit breakers and deadlines of core calls.
+
+A breaker per core port opens after consecutive connection failures or
+timeouts, and calls are then refused at once instead of tying up a
+thread until the core answers. After reset_timeout a few trial calls
+are let through (half-open); a success closes the circuit again, a
+failure reopens it. Errors reported by the core itself mean it is up
+and do not count, and calls ended without an answer either way (a
+shorter client deadline, a cancelled request) are released and only
+give their trial slot back.
+
+Clients can shorten the time a core call may take with the
+X-Request-Timeout header, in seconds, capped by PRIVADOME_CORE_TIMEOUT.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from . import stats
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """ The circuit of a core port is open, the call was not made. """
+
+    def __init__(self, name, retry_after):
+        super().__init__('Circuit {} is open'.format(name))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """ Closed, open and half-open circuit of one core port. """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10.0,
+                 half_open_calls=1, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trials = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def before(self):
+        """ Raise CircuitOpen unless a call may be made now. """
+        with self._lock:
+            if self.state == OPEN:
+                waited = self._clock() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.reset_timeout - waited)
+                self.state = HALF_OPEN
+                self._trials = 0
+            if self.state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.reset_timeout)
+                self._trials += 1
+
+    def success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def release(self):
+        """ End a call that tells nothing about the core. """
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN\
+                    or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self.opened_at = self._clock()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(port):
+    """ Return the process-wide breaker of a core port. """
+    breaker = _BREAKERS.get(port)
+    if breaker is None:
+        with _BREAKERS_LOCK:
+            breaker = _BREAKERS.get(port)
+            if breaker is None:
+                breaker = _BREAKERS[port] = CircuitBreaker(
+                    str(port),
+                    failure_threshold=getattr(
+                        settings, 'PRIVADOME_CIRCUIT_FAILURES', 5),
+                    reset_timeout=getattr(
+                        settings, 'PRIVADOME_CIRCUIT_RESET_TIMEOUT', 10.0))
+    return breaker
+
+
+def circuit_stats():
+    """ Statistics of every breaker. """
+    with _BREAKERS_LOCK:
+        breakers = list(_BREAKERS.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+stats.register('circuits', circuit_stats)
+
+
+def core_timeout():
+    return getattr(settings, 'PRIVADOME_CORE_TIMEOUT', 30)
+
+
+def client_timeout(header):
+    """
+    Seconds allowed by an X-Request-Timeout header value, or None when it
+    is missing, invalid or not shorter than the core timeout.
+    """
+    try:
+        timeout = float(header)
+    except (TypeError, ValueError):
+        return None
+    if timeout <= 0 or timeout != timeout:
+        return None
+    return timeout if timeout < core_timeout() else None
+
+
+def request_deadline(request):
+    """
+    time.monotonic() deadline of the core calls of a Django request, None
+    when the client did not ask for less than the core timeout.
+    """
+    timeout = client_timeout(request.META.get('HTTP_X_REQUEST_TIMEOUT'))
+    return None if timeout is None else time.monotonic() + timeout
@@ -0,0 +1,140 @@
+"""
+Versioned core payloads.
+
+The last few payloads of every proxied resource are kept with an ETag,
+so that clients can revalidate with If-None-Match or ask for a JSON
+patch (RFC 6902) relative to a version they already hold.
+"""
+import collections
+import hashlib
+import threading
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import jsoncodec
+
+
+def compute_etag(payload):
+    """ Strong ETag of a JSON payload. """
+    canonical = jsoncodec.dumps(payload, sort_keys=True)
+    return '"{}"'.format(hashlib.sha1(canonical).hexdigest())
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def json_patch(old, new, path=''):
+    """
+    JSON patch turning old into new. Objects are diffed member by member,
+    any other changed value is replaced as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old:
+            if key not in new:
+                patch.append({'op': 'remove', 'path': path + '/' + _escape(key)})
+        for key, value in new.items():
+            member = path + '/' + _escape(key)
+            if key not in old:
+                patch.append({'op': 'add', 'path': member, 'value': value})
+            else:
+                patch.extend(json_patch(old[key], value, member))
+        return patch
+    if old == new and type(old) is type(new):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+class VersionStore:
+    """
+    The last max_versions payloads of the max_keys most recently
+    used resources, by ETag.
+    """
+
+    def __init__(self, max_versions=8, max_keys=512):
+        self.max_versions = max_versions
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._versions = collections.OrderedDict()
+
+    def record(self, key, payload):
+        """ Remember payload as the latest version of key, return its ETag. """
+        with self._lock:
+            versions = self._versions.get(key)
+            # Cached payloads are handed out as the same object.
+            if versions and versions[-1][1] is payload:
+                return versions[-1][0]
+        etag = compute_etag(payload)
+        with self._lock:
+            versions = self._versions.get(key)
+            if versions is None:
+                versions = self._versions[key] = collections.deque(
+                    maxlen=self.max_versions)
+                while len(self._versions) > self.max_keys:
+                    self._versions.popitem(last=False)
+            self._versions.move_to_end(key)
+            if not versions or versions[-1][0] != etag:
+                versions.append((etag, payload))
+        return etag
+
+    def latest(self, key):
+        """ The latest payload of key, or None. """
+        with self._lock:
+            versions = self._versions.get(key)
+            return versions[-1][1] if versions else None
+
+    def get(self, key, etag):
+        """ The payload of a known version of key, or None. """
+        with self._lock:
+            for version, payload in self._versions.get(key, ()):
+                if version == etag:
+                    return payload
+        return None
+
+
+VERSIONS = VersionStore()
+
+
+def _if_none_match(header, etag):
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags\
+        or 'W/' + etag in tags
+
+
+def versioned(key, payload, since=None, if_none_match=None):
+    """
+    Status, body and headers answering with the latest payload of key.
+
+    A request whose If-None-Match holds the current ETag receives 304
+    without a body. When since names a version still known, the body is
+    a JSON patch from that version instead of the full payload.
+    """
+    etag = VERSIONS.record(key, payload)
+    headers = {'ETag': etag}
+    if _if_none_match(if_none_match, etag):
+        return status.HTTP_304_NOT_MODIFIED, None, headers
+
+    if since is not None:
+        since = str(since)
+        since = since if since.startswith('"') else '"{}"'.format(since)
+        base = VERSIONS.get(key, since)
+        if base is not None:
+            return status.HTTP_200_OK, {'version': etag, 'since': since,
+                                        'patch': json_patch(base, payload)},\
+                headers
+    return status.HTTP_200_OK, payload, headers
+
+
+def versioned_response(request, key, payload, since=None):
+    """
+    Response for the latest payload of key, see versioned().
+    Only GET requests are answered with 304.
+    """
+    code, data, headers = versioned(
+        key, payload, since, request.META.get('HTTP_IF_NONE_MATCH')
+        if request.method == 'GET' else None)
+    return Response(data, status=code, headers=headers)
@@ -0,0 +1,63 @@
+"""
+Dict dispatch of the core proxy endpoints.
+
+The modules/ and tiles/ routes are plain literal paths, so they are
+looked up in a dict built from the URLconf instead of going through
+the regex resolver. Other paths are resolved as usual.
+With PRIVADOME_FAST_PROXY the policy routes use the minimal handlers
+of api.fastpath instead of the DRF views.
+"""
+import re
+
+from django.conf import settings
+from django.urls import ResolverMatch
+
+from . import fastpath, urls
+
+DISPATCH_PREFIXES = ('modules/', 'tiles/')
+
+
+def build_routes(patterns, prefixes=DISPATCH_PREFIXES, handlers=None):
+    """
+    Map the path of every literal, anchored pattern under prefixes to
+    its resolver match, with the views of handlers, URL name -> view,
+    in place of the patterns' own.
+    """
+    handlers = handlers or {}
+    routes = {}
+    for pattern in patterns:
+        regex = getattr(pattern.pattern, '_regex', '')
+        if not (regex.startswith('^') and regex.endswith('$')):
+            continue
+        path = regex[1:-1]
+        if path.startswith(prefixes) and re.escape(path) == path:
+            routes['/' + path] = ResolverMatch(
+                handlers.get(pattern.name, pattern.callback), (), {},
+                pattern.name, route=path)
+    return routes
+
+
+ROUTES = build_routes(
+    urls.urlpatterns,
+    handlers=fastpath.HANDLERS
+    if getattr(settings, 'PRIVADOME_FAST_PROXY', False) else None)
+
+
+class DispatchMiddleware:
+    """
+    Call the views of ROUTES directly, without resolving the path.
+    Keep it last in MIDDLEWARE, it ends the middleware chain.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        match = ROUTES.get(request.path_info)
+        if match is None:
+            return self.get_response(request)
+        request.resolver_match = match
+        response = match.func(request)
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
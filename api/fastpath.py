@@ -0,0 +1,94 @@
+"""
+Minimal handlers of the policy endpoints.
+
+The policy views only forward the request body to the core, the handlers
+below do the same without the DRF request cycle: the token is checked
+once, the body is parsed once by the core call and the reply is written
+as compact JSON. They replace the DRF views in the dispatch table when
+PRIVADOME_FAST_PROXY is enabled and answer with the same status codes
+and bodies; requests other than POST are left to the DRF views.
+
+The read endpoints (module_config, module_schema, tiles_data) keep their
+DRF views. They are mostly answered from the state, schema and tile
+caches, and their responses carry the ETag, 304, JSON patch and stale
+Warning handling of views.versioned_response() and last_known_good(),
+which a second implementation here would have to duplicate. The
+reactor proxy (PRIVADOME_REACTOR_PROXY) serves them outside Django
+when the request cycle has to be avoided.
+"""
+from django.http import HttpResponse
+from django.utils.encoding import force_str
+from rest_framework import exceptions
+from rest_framework.exceptions import server_error
+
+from . import jsoncodec, metrics, views
+from .authentication import token_authentication
+from .circuit import request_deadline
+
+# URL name -> core verb of the policy endpoints.
+POLICY_VERBS = {
+    'add_policy_group': 'add_group',
+    'add_policy_address': 'add_client',
+    'delete_policy_group': 'delete_group',
+    'delete_policy_address': 'delete_client',
+    'update_policy_network': 'update_network_policy',
+    'update_policy_group': 'update_group_policy',
+    'update_policy_address': 'update_client_policy',
+}
+
+
+def json_response(data, status=200):
+    with metrics.phase('serialize'):
+        data = jsoncodec.dumps(data)
+    return HttpResponse(data, status=status, content_type='application/json')
+
+
+def authenticate(request):
+    """ The error response of an unauthenticated request, or None. """
+    try:
+        with metrics.phase('auth'):
+            result = token_authentication().authenticate(request)
+    except exceptions.AuthenticationFailed as ex:
+        detail = ex.detail
+    else:
+        if result is not None:
+            request.user, request.auth = result
+            return None
+        detail = exceptions.NotAuthenticated.default_detail
+    response = json_response({'detail': force_str(detail)}, status=401)
+    response['WWW-Authenticate'] = 'Token'
+    return response
+
+
+def policy_handler(verb, view):
+    """
+    A handler forwarding a POST body to the core as verb, other methods
+    are answered by view.
+    """
+    def handler(request):
+        if request.method != 'POST':
+            return view(request)
+        denied = authenticate(request)
+        if denied is not None:
+            return denied
+        try:
+            reply = views.procbridge_call(verb, request.body,
+                                          deadline=request_deadline(request))
+        except Exception as ex:
+            error = views.core_error(ex)
+            if error is None:
+                return server_error(request)
+            code, data, headers = error
+            response = json_response(data, status=code)
+            for name, value in headers.items():
+                response[name] = value
+            return response
+        finally:
+            views.STATE_CACHE.invalidate()
+        return json_response(reply)
+    handler.__name__ = verb
+    return handler
+
+
+HANDLERS = {name: policy_handler(verb, getattr(views, name))
+            for name, verb in POLICY_VERBS.items()}
@@ -0,0 +1,153 @@
+"""
+JSON codec of the proxy pipeline.
+
+orjson is used when it is installed, then ujson, then the standard
+library. Everything is encoded to compact UTF-8 bytes, like the DRF
+renderer does. Request bodies that only pass through to the core are
+wrapped in RawJSON and embedded in the procbridge frame without being
+encoded again.
+
+NaN and infinite floats are refused with ValueError by every backend,
+like the strict DRF encoder does. Floats are written in the shortest
+form that reads back to the same value by all three, but orjson and
+ujson write exponents without padding (1e-7 where the standard library
+writes 1e-07).
+"""
+import json
+import math
+
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+elif ujson is not None:
+    BACKEND = 'ujson'
+else:
+    BACKEND = 'json'
+
+
+class RawJSON(bytes):
+    """ Encoded JSON embedded as is by the procbridge frame encoder. """
+
+
+NON_FINITE = 'Out of range float values are not JSON compliant'
+
+
+def _stdlib_dumps(obj, sort_keys=False):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                      sort_keys=sort_keys, allow_nan=False).encode('utf-8')
+
+
+def _finite(obj):
+    """ Whether obj holds no NaN or infinite float. """
+    if isinstance(obj, float):
+        return math.isfinite(obj)
+    if isinstance(obj, dict):
+        return all(_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(_finite(value) for value in obj)
+    return True
+
+
+if BACKEND == 'orjson':
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as ex:
+            raise ValueError(str(ex))
+
+    def dumps(obj, sort_keys=False):
+        """ Compact UTF-8 JSON of obj. """
+        # Datetimes are left to the DRF encoder, which formats them
+        # differently.
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, option=option)
+        except TypeError:
+            # Integers beyond 64 bits and other types orjson refuses.
+            return _stdlib_dumps(obj, sort_keys)
+        # orjson writes NaN and infinities as null.
+        if b'null' in data and not _finite(obj):
+            raise ValueError(NON_FINITE)
+        return data
+
+elif BACKEND == 'ujson':
+    def loads(data):
+        try:
+            return ujson.loads(data)
+        except (ujson.JSONDecodeError, TypeError) as ex:
+            raise ValueError(str(ex))
+
+    def dumps(obj, sort_keys=False):
+        """ Compact UTF-8 JSON of obj. """
+        try:
+            data = ujson.dumps(obj, ensure_ascii=False, sort_keys=sort_keys,
+                               escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return _stdlib_dumps(obj, sort_keys)
+        # Recent ujson versions write NaN and Infinity.
+        if ('NaN' in data or 'Infinity' in data) and not _finite(obj):
+            raise ValueError(NON_FINITE)
+        return data.encode('utf-8')
+
+else:
+    def loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    dumps = _stdlib_dumps
+
+
+def raw(data):
+    """ Encoded JSON as RawJSON, ValueError when it does not parse. """
+    loads(data)
+    return RawJSON(data)
+
+
+class JSONParser(parsers.JSONParser):
+    """ DRF JSON parser decoding with the codec. """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """
+    DRF JSON renderer encoding with the codec. Indented output and
+    types only the DRF encoder knows are left to DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with metrics.phase('serialize'):
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type, renderer_context):
+        if data is None:
+            return b''
+        if isinstance(data, RawJSON):
+            return bytes(data)
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            return dumps(data)
+        except (TypeError, ValueError):
+            return super().render(data, accepted_media_type, renderer_context)
@@ -0,0 +1,221 @@
+"""
+Per-request timings and Prometheus metrics.
+
+TimingMiddleware gives each request handled by a WSGI thread a Timer,
+and the code on the hot path records how long its phase took:
+
+- queue: waiting for a WSGI thread
+- auth: token authentication
+- core_connect: opening a core connection
+- core: the core call, connect included; for tile batches, the wait
+  for the tiles fetched by the tile executor
+- serialize: rendering the response body
+- total: the Django handler, middleware included
+
+The phases of every request are added to the request_phase_seconds
+histogram by endpoint and sent back in a Server-Timing header. Work done
+outside a request, like background cache refreshes, is timed with
+background() under its own endpoint label. The histogram and the
+numeric values of the stats registry are exposed in the Prometheus text
+format by metrics_response().
+"""
+import bisect
+import contextlib
+import math
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from privadome_frontend.threadpools import current_queue_wait
+
+from . import stats
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_local = threading.local()
+
+
+class Histogram:
+    """ Prometheus histogram with a series per tuple of label values. """
+
+    def __init__(self, name, documentation, labels, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, values, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def expose(self):
+        """ Lines of the histogram in the Prometheus text format. """
+        with self._lock:
+            series = sorted((values, list(counts), total)
+                            for values, (counts, total) in self._series.items())
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        for values, counts, total in series:
+            labels = ','.join('{}="{}"'.format(name, _escape(value))
+                              for name, value in zip(self.labels, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, labels, _number(bound), cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels,
+                                                  _number(total)))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels,
+                                                    cumulative))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+REQUEST_PHASES = Histogram(
+    'privadome_request_phase_seconds',
+    'Time spent in each phase of an API request.', ('endpoint', 'phase'))
+
+
+class Timer:
+    """ Seconds spent in each phase of the current request. """
+    __slots__ = ('phases',)
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+def record(phase, seconds):
+    """ Add seconds to phase of the request of the current thread. """
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.add(phase, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ Record the time spent in the block as phase name. """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+@contextlib.contextmanager
+def background(endpoint):
+    """
+    Time the phases of the work done in the block outside any request
+    and add them to the histogram under endpoint.
+    """
+    previous = getattr(_local, 'timer', None)
+    timer = _local.timer = Timer()
+    try:
+        yield
+    finally:
+        _local.timer = previous
+        for name, seconds in timer.phases.items():
+            REQUEST_PHASES.observe((endpoint, name), seconds)
+
+
+def endpoint_name(request):
+    """ Histogram label of the endpoint a request was routed to. """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.route or match.view_name
+
+
+def server_timing(phases):
+    """ Server-Timing header value of phase durations in seconds. """
+    return ', '.join('{};dur={:.3f}'.format(name, seconds * 1000)
+                     for name, seconds in phases.items())
+
+
+class TimingMiddleware:
+    """
+    Time the phases of every request. Keep it first in MIDDLEWARE so the
+    total covers the others.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.header = getattr(settings, 'PRIVADOME_SERVER_TIMING', True)
+
+    def __call__(self, request):
+        timer = _local.timer = Timer()
+        wait = current_queue_wait()
+        if wait is not None:
+            timer.add('queue', wait)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.timer = None
+        timer.add('total', time.perf_counter() - started)
+
+        endpoint = endpoint_name(request)
+        for name, seconds in timer.phases.items():
+            REQUEST_PHASES.observe((endpoint, name), seconds)
+        if self.header:
+            response['Server-Timing'] = server_timing(timer.phases)
+        return response
+
+
+def stats_lines():
+    """ Numeric values of the stats registry as untyped samples. """
+    lines = []
+    for name, data in sorted(stats.snapshot().items()):
+        _flatten('privadome_' + name, data, lines)
+    return lines
+
+
+def _flatten(name, value, lines):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(name + '_' + _METRIC_CHARS.sub('_', str(key)), item,
+                     lines)
+    elif isinstance(value, bool):
+        lines.append('{} {}'.format(name, int(value)))
+    elif isinstance(value, (int, float)):
+        lines.append('{} {}'.format(name, _number(value)))
+
+
+_METRIC_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def metrics_response():
+    """ Response with every metric in the Prometheus text format. """
+    lines = REQUEST_PHASES.expose() + stats_lines()
+    return HttpResponse('\n'.join(lines) + '\n', content_type=CONTENT_TYPE)
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ Index the user emails for the prefix search of the user list. """
+
+    dependencies = [
+        ('auth', '0009_alter_user_last_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX api_user_email_idx ON auth_user (email)',
+            'DROP INDEX api_user_email_idx'),
+    ]
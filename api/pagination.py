@@ -0,0 +1,30 @@
+""" Pagination of the API listings. """
+from django.db.models import Q
+from rest_framework.pagination import CursorPagination
+
+# Above every character, so field < prefix + PREFIX_END for any match.
+PREFIX_END = '\U0010ffff'
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Keyset pagination of the users by id: a page is fetched with
+    id > the last id of the previous page, whatever the table size.
+    """
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+    def requested(self, request):
+        """ Whether the client asked for a page, not the whole list. """
+        return self.cursor_query_param in request.query_params\
+            or self.page_size_query_param in request.query_params
+
+
+def prefix_filter(field, prefix):
+    """
+    Filter on the values of field starting with prefix, case sensitive.
+    Unlike startswith, which is a LIKE on SQLite, the range can be looked
+    up in an index of field.
+    """
+    return Q(**{field + '__gte': prefix, field + '__lt': prefix + PREFIX_END})
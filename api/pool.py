@@ -0,0 +1,425 @@
+"""
+Pooled procbridge connections.
+
+One bounded pool is kept per (host, port) and shared by every
+WSGI worker thread, so core calls reuse warm sockets instead of
+paying for a TCP connect each time. Frames are encoded and decoded
+with the JSON codec of the proxy pipeline.
+"""
+import collections
+import socket
+import threading
+import time
+
+from procbridge.const import Keys, StatusCode, Versions
+from procbridge.errors import ProtocolError, ServerError
+
+from django.conf import settings
+
+from . import jsoncodec, metrics, stats
+
+HEADER_LENGTH = 11
+
+
+def encode_frame(status_code, body):
+    """ Encode a procbridge frame, a RawJSON body is used as is. """
+    data = body if isinstance(body, jsoncodec.RawJSON)\
+        else jsoncodec.dumps(body)
+    return b''.join((b'pb', Versions.current().value,
+                     bytes([status_code.value]), b'\x00\x00',
+                     len(data).to_bytes(4, byteorder='little'), data))
+
+
+def encode_request(method, payload=None):
+    """
+    Encode a procbridge request frame. A RawJSON payload is embedded
+    without encoding it again.
+    """
+    if isinstance(payload, jsoncodec.RawJSON):
+        return encode_frame(StatusCode.REQUEST, jsoncodec.RawJSON(b''.join((
+            b'{"', Keys.METHOD.value.encode(), b'":', jsoncodec.dumps(method),
+            b',"', Keys.PAYLOAD.value.encode(), b'":', payload, b'}'))))
+    body = {Keys.METHOD.value: method}
+    if payload is not None:
+        body[Keys.PAYLOAD.value] = payload
+    return encode_frame(StatusCode.REQUEST, body)
+
+
+def decode_reply(header, data):
+    """
+    Decode the header and JSON body of a procbridge reply into
+    (status code, payload or error message).
+    """
+    if header[:2] != b'pb':
+        raise ProtocolError('unrecognized protocol')
+    if header[2:4] != Versions.current().value:
+        raise ProtocolError('incompatible protocol version')
+    try:
+        body = jsoncodec.loads(data)
+    except ValueError as ex:
+        raise ProtocolError('invalid body', str(ex))
+    if not isinstance(body, dict):
+        raise ProtocolError('invalid body')
+    if header[4] == StatusCode.GOOD_RESPONSE.value:
+        return StatusCode.GOOD_RESPONSE, body.get(Keys.PAYLOAD.value)
+    if header[4] == StatusCode.BAD_RESPONSE.value:
+        return StatusCode.BAD_RESPONSE, str(body.get(Keys.MESSAGE.value,
+                                                     'unknown server error'))
+    raise ProtocolError('invalid status code')
+
+
+def _read(sock, count, deadline):
+    chunks = []
+    while count:
+        _settimeout(sock, deadline)
+        chunk = sock.recv(count)
+        if not chunk:
+            raise ProtocolError('incomplete data')
+        chunks.append(chunk)
+        count -= len(chunk)
+    return b''.join(chunks)
+
+
+def _settimeout(sock, deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout('deadline exceeded')
+    sock.settimeout(remaining)
+
+
+class PoolTimeout(Exception):
+    """ No connection became available within the wait timeout. """
+
+
+class DeadlineExceeded(Exception):
+    """ A core call did not complete before its deadline. """
+
+
+class _Unanswered(Exception):
+    """
+    A connection failed while the request was sent, or was closed before
+    any byte of the reply: the core cannot have acted on it.
+    """
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class PooledConnection:
+    """ A socket connected to the core, owned by a single pool. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def is_alive(self):
+        """
+        Health check of an idle connection.
+        An idle socket must not be readable, readability means the core
+        either closed the connection or sent unsolicited data.
+        """
+        # A non-blocking peek, select() cannot watch descriptors past
+        # FD_SETSIZE.
+        try:
+            self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of connections to one procbridge server.
+    """
+
+    def __init__(self, host, port, max_size=8, idle_timeout=30.0,
+                 wait_timeout=5.0, connect_timeout=5.0, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+
+        self._idle = collections.deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+        self.timeouts = 0
+        self.deadlines_exceeded = 0
+        self.wait_time = 0.0
+
+    def _connect(self, deadline=None):
+        timeout = self.connect_timeout
+        if deadline is not None:
+            timeout = min(timeout, max(deadline - time.monotonic(), 0.001))
+        with metrics.phase('core_connect'):
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PooledConnection(sock)
+
+    def _evict_idle(self, now):
+        """ Close idle connections unused for longer than idle_timeout. """
+        while self._idle and now - self._idle[0].last_used > self.idle_timeout:
+            self._idle.popleft().close()
+            self.evictions += 1
+
+    def acquire(self, deadline=None):
+        """
+        Take a healthy idle connection or open a new one.
+        Blocks up to wait_timeout, or until deadline when it is sooner,
+        when the pool is exhausted.
+        """
+        started = time.monotonic()
+        wait_timeout = self.wait_timeout
+        if deadline is not None:
+            wait_timeout = min(wait_timeout, deadline - started)
+        with self._cond:
+            while True:
+                self._evict_idle(time.monotonic())
+                while self._idle:
+                    conn = self._idle.pop()
+                    if conn.is_alive():
+                        self._in_use += 1
+                        self.hits += 1
+                        self.wait_time += time.monotonic() - started
+                        conn.reused = True
+                        return conn
+                    conn.close()
+                    self.reconnects += 1
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    self.misses += 1
+                    break
+                remaining = wait_timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout('No connection available to {}:{}'
+                                      .format(self.host, self.port))
+                self._cond.wait(remaining)
+            self.wait_time += time.monotonic() - started
+
+        try:
+            return self._connect(deadline)
+        except OSError:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def release(self, conn, reusable=True):
+        """ Return a connection to the pool, closing it if it is broken. """
+        with self._cond:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_size:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            else:
+                conn.close()
+            self._cond.notify()
+
+    def request(self, method, payload=None, deadline=None):
+        """
+        Send one procbridge request and return the payload of the reply.
+        A reused connection that fails while the request is sent, or is
+        closed before any byte of the reply, is replaced with a fresh one
+        and the request is retried once. Failures after that may follow a
+        request the core acted on and are never retried.
+        The call fails with DeadlineExceeded once deadline, a
+        time.monotonic() value, or the pool timeout has passed.
+        """
+        with self.session(deadline) as session:
+            return session.request(method, payload)
+
+    def session(self, deadline=None):
+        """
+        Check out one connection for a sequence of requests, to be used
+        as a context manager. See Session.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        return Session(self, deadline)
+
+    def _deadline_exceeded(self, method):
+        with self._cond:
+            self.deadlines_exceeded += 1
+        raise DeadlineExceeded('{} to {}:{} timed out'.format(
+            method, self.host, self.port))
+
+    @staticmethod
+    def _roundtrip(conn, method, payload, deadline):
+        """
+        Send a request and read its reply. Raise _Unanswered when the
+        connection fails before the core can have acted on the request.
+        """
+        try:
+            _settimeout(conn.sock, deadline)
+            conn.sock.sendall(encode_request(method, payload))
+            _settimeout(conn.sock, deadline)
+            first = conn.sock.recv(HEADER_LENGTH)
+        except socket.timeout:
+            raise
+        except OSError as ex:
+            raise _Unanswered(ex)
+        if not first:
+            raise _Unanswered(ProtocolError('incomplete data'))
+        header = first + _read(conn.sock, HEADER_LENGTH - len(first), deadline)
+        length = int.from_bytes(header[7:11], byteorder='little')
+        return decode_reply(header, _read(conn.sock, length, deadline))
+
+    def close(self):
+        """ Close every idle connection. """
+        with self._cond:
+            while self._idle:
+                self._idle.popleft().close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'host': self.host,
+                'port': self.port,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'evictions': self.evictions,
+                'timeouts': self.timeouts,
+                'deadlines_exceeded': self.deadlines_exceeded,
+                'wait_time': round(self.wait_time, 6),
+            }
+
+
+class Session:
+    """
+    A pooled connection held for several requests in a row, so a batch
+    of core calls pays for a single checkout. The core may close the
+    connection after a reply, it is then reopened for the next request
+    without giving up the pool slot.
+    """
+
+    def __init__(self, pool, deadline):
+        self.pool = pool
+        self.deadline = deadline
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = self.pool.acquire(self.deadline)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._conn is None:
+            self.pool._release_slot()
+        else:
+            # Every request reads its whole reply, the connection is idle.
+            self.pool.release(self._conn)
+            self._conn = None
+
+    def request(self, method, payload=None):
+        """
+        Send one procbridge request and return the payload of the reply,
+        see ConnectionPool.request().
+        """
+        pool = self.pool
+        if self._conn is None:
+            self._conn = pool._connect(self.deadline)
+        try:
+            code, result = pool._roundtrip(self._conn, method, payload,
+                                           self.deadline)
+        except _Unanswered as ex:
+            # A reused connection the core closed while it was idle.
+            self._drop(ex.error, method, self._conn.reused)
+            with pool._cond:
+                pool.reconnects += 1
+            self._conn = pool._connect(self.deadline)
+            try:
+                code, result = pool._roundtrip(self._conn, method, payload,
+                                               self.deadline)
+            except _Unanswered as ex:
+                self._drop(ex.error, method)
+            except (OSError, ProtocolError) as ex:
+                self._drop(ex, method)
+        except (OSError, ProtocolError) as ex:
+            self._drop(ex, method)
+        self._conn.reused = True
+        if code != StatusCode.GOOD_RESPONSE:
+            raise ServerError(result)
+        return result
+
+    def _drop(self, ex, method, retry=False):
+        """ Close the failed connection, re-raise ex unless retrying. """
+        self._conn.close()
+        self._conn = None
+        if isinstance(ex, socket.timeout):
+            self.pool._deadline_exceeded(method)
+        if not retry:
+            raise ex
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(host, port):
+    """ Return the process-wide pool for (host, port), creating it once. """
+    key = (host, port)
+    pool = _POOLS.get(key)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    host, port,
+                    max_size=getattr(settings, 'PRIVADOME_CORE_POOL_SIZE', 8),
+                    idle_timeout=getattr(settings,
+                                         'PRIVADOME_CORE_POOL_IDLE_TIMEOUT',
+                                         30.0),
+                    wait_timeout=getattr(settings,
+                                         'PRIVADOME_CORE_POOL_WAIT_TIMEOUT',
+                                         5.0),
+                    connect_timeout=getattr(settings,
+                                            'PRIVADOME_CORE_CONNECT_TIMEOUT',
+                                            5.0),
+                    timeout=getattr(settings, 'PRIVADOME_CORE_TIMEOUT', 30.0))
+                _POOLS[key] = pool
+    return pool
+
+
+def close_pools():
+    """ Close the idle connections of every pool. """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.close()
+
+
+def pool_stats():
+    """ Statistics of every pool. """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    return {'{}:{}'.format(pool.host, pool.port): pool.stats()
+            for pool in pools}
+
+
+stats.register('core_pools', pool_stats)
@@ -3,6 +3,8 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied, ValidationError
 
+from .authentication import revoke_user_tokens
+
 
 class UserListSerializer(serializers.ModelSerializer):
     """ Serialize User objects. """
@@ -13,6 +15,25 @@ class UserListSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'email', 'admin')
 
 
+# User columns of the UserListSerializer fields.
+USER_LIST_COLUMNS = ('id', 'username', 'email', 'is_superuser')
+
+
+def user_list_row(row):
+    """
+    UserListSerializer output of a values(*USER_LIST_COLUMNS) row,
+    without building a serializer and its fields.
+    """
+    return {'id': row['id'], 'username': row['username'],
+            'email': row['email'], 'admin': bool(row['is_superuser'])}
+
+
+def user_list_data(user):
+    """ UserListSerializer output of a User. """
+    return {'id': user.pk, 'username': user.username, 'email': user.email,
+            'admin': bool(user.is_superuser)}
+
+
 class UserCreateSerializer(serializers.ModelSerializer):
     """ Serialize incoming User create requests. """
 
@@ -64,6 +85,8 @@ class UserUpdateSerializer(serializers.ModelSerializer):
                 if 'newPassword' in validated_data:
                     instance.set_password(validated_data['newPassword'])
                 instance.save()
+                if 'newPassword' in validated_data:
+                    revoke_user_tokens(instance.pk)
                 return instance
             else:
                 raise PermissionDenied("Incorrect password")
@@ -0,0 +1,44 @@
+""" Signal handlers keeping the in-process caches consistent. """
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import TOKEN_CACHE, revoke_user_tokens
+
+# User fields carried by signed tokens that grant or deny access.
+SIGNED_CLAIM_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    """ Drop a deleted or rotated token from the token cache. """
+    TOKEN_CACHE.invalidate_key(instance.key)
+
+
+@receiver(pre_save, sender=User)
+def user_saving(sender, instance, **kwargs):
+    """
+    Revoke the signed tokens of a user whose access changes,
+    their claims would be stale.
+    """
+    if instance.pk is None:
+        return
+    old = User.objects.filter(pk=instance.pk)\
+        .values(*SIGNED_CLAIM_FIELDS).first()
+    if old is not None and any(old[field] != getattr(instance, field)
+                               for field in SIGNED_CLAIM_FIELDS):
+        revoke_user_tokens(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    """
+    Drop the cached tokens of a changed, deactivated or deleted user,
+    the cached user object would be stale.
+    """
+    TOKEN_CACHE.invalidate_user(instance.pk)
+    if kwargs.get('signal') is post_delete:
+        revoke_user_tokens(instance.pk)
@@ -0,0 +1,21 @@
+""" Runtime statistics registry. """
+import threading
+
+_PROVIDERS = {}
+_LOCK = threading.Lock()
+
+
+def register(name, provider):
+    """
+    Register a callable returning a JSON serializable dict
+    of statistics under the given name.
+    """
+    with _LOCK:
+        _PROVIDERS[name] = provider
+
+
+def snapshot():
+    """ Collect the current statistics of every registered provider. """
+    with _LOCK:
+        providers = list(_PROVIDERS.items())
+    return {name: provider() for name, provider in providers}
@@ -1,10 +1,69 @@
 """ API tests. """
-from rest_framework import status
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
+
+import procbridge
+from procbridge.const import StatusCode
+from procbridge.errors import ProtocolError, ServerError
+
+from twisted.internet import defer, error, task
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.python import failure
+from twisted.web import resource as web_resource, server as web_server, static
+from twisted.web.test.requesthelper import DummyRequest
+
+from rest_framework import exceptions, status
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+
+from privadome_frontend.coreproxy import ApiResource, CoreProxyResource,\
+                                        ProcbridgeClientProtocol,\
+                                        procbridge_request
+from privadome_frontend.staticfiles import CompressedStaticFile,\
+                                          MemoryStaticResource,\
+                                          compress_static
+from privadome_frontend.startup import LazyLoader, LazyResource,\
+                                       import_digest, parse_importtime
+from privadome_frontend import coreproxy, profiler
+from privadome_frontend.profiler import SamplingProfiler
+from privadome_frontend.threadpools import InstrumentedThreadPool,\
+                                          SheddingWSGIResource
+from privadome_frontend.supervisor import WORKERS_ENV, DrainableSite,\
+                                          drain_on_shutdown
+from privadome_frontend.tilestream import TileHub, TileStreamResource
+
+from . import views
+from .serializers import USER_LIST_COLUMNS, UserListSerializer,\
+                         user_list_data, user_list_row
+from .authentication import TOKEN_CACHE, check_revocation_cache,\
+                             token_cache_ttl
+from .cache import StaleWhileRevalidateCache, TTLCache
+from .delta import VersionStore, json_patch
+from .jsoncodec import JSONRenderer, RawJSON, dumps, raw
+from .dispatch import ROUTES, build_routes
+from . import delta, fastpath, metrics, urls
+from .pool import HEADER_LENGTH, ConnectionPool, DeadlineExceeded,\
+                  PooledConnection, PoolTimeout, decode_reply, encode_frame,\
+                  encode_request
+from .circuit import CircuitBreaker, CircuitOpen, client_timeout
+from . import circuit
 
 
 def authenticate_client_admin(client):
@@ -17,6 +76,12 @@ def authenticate_client_regular(client):
     token = Token.objects.get(user__username='regularUser')
     client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
 
+def start_fake_core(delegate):
+    """ Start a procbridge server on a free port, return it and the port. """
+    server = procbridge.Server('127.0.0.1', 0, delegate)
+    server.start()
+    return server, server.socket.getsockname()[1]
+
 
 class UserTests(APITestCase):
     """ User object tests. """
@@ -287,6 +352,83 @@ class UserTests(APITestCase):
                                            'admin': False})
         self.assertEqual(User.objects.count(), 3)
 
+    def test_get_users_paginated(self):
+        """
+        Ensure the users can be listed page by page when asked.
+        """
+        for index in range(12):
+            User.objects.create_user(username='user{}'.format(index),
+                                     email='user{}@test.test'.format(index))
+        authenticate_client_admin(self.client)
+
+        ids = []
+        url = reverse('user-list') + '?limit=5'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 5)
+            ids += [user['id'] for user in response.data['results']]
+            url = response.data['next']
+            listing = [query['sql'] for query in queries.captured_queries
+                       if 'LIMIT 6' in query['sql']]
+            self.assertEqual(len(listing), 1)
+            self.assertNotIn('password', listing[0])
+
+        self.assertEqual(ids, list(User.objects.order_by('id')
+                                   .values_list('id', flat=True)))
+
+    def test_fast_user_serializers(self):
+        """
+        Ensure the user rows render exactly like UserListSerializer.
+        """
+        User.objects.create_superuser(username='rootUser', email='',
+                                      password='rootPassword')
+        users = User.objects.order_by('id')
+        rows = users.values(*USER_LIST_COLUMNS)
+        renderer = JSONRenderer()
+
+        self.assertEqual(
+            renderer.render([user_list_row(row) for row in rows]),
+            renderer.render(UserListSerializer(users, many=True).data))
+        for user in users:
+            self.assertEqual(renderer.render(user_list_data(user)),
+                             renderer.render(UserListSerializer(user).data))
+
+    def test_search_users(self):
+        """
+        Ensure users are filtered on a username or email prefix.
+        """
+        url = reverse('user-list')
+        authenticate_client_admin(self.client)
+
+        response = self.client.get(url, {'search': 'other'}, format='json')
+        self.assertEqual([user['username'] for user in response.data],
+                         ['otherUser'])
+        response = self.client.get(url, {'search': 'regularEmail',
+                                         'limit': 10}, format='json')
+        self.assertEqual([user['username'] for user in response.data['results']],
+                         ['regularUser'])
+
+        authenticate_client_regular(self.client)
+        response = self.client.get(url, {'search': 'other'}, format='json')
+        self.assertEqual(response.data, [])
+
+    def test_get_stats(self):
+        """
+        Ensure only admins can read the runtime statistics.
+        """
+        url = reverse('runtime_stats')
+
+        authenticate_client_regular(self.client)
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        authenticate_client_admin(self.client)
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('core_pools', response.data)
+
 
 class LoginTest(APITestCase):
     """ Login endpoint tests. """
@@ -340,3 +482,1884 @@ class LoginTest(APITestCase):
         response = self.client.post(url, data, format='json')
 
         self.assertNotContains(response, 'token', 400)
+
+
+class SQLiteBackendTest(TestCase):
+    """ Tuned SQLite backend tests. """
+
+    def test_pragmas(self):
+        """
+        Ensure new connections get the busy timeout and synchronous mode.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """ Procbridge connection pool tests. """
+
+    def setUp(self):
+        """ Set up a fake core. """
+        self.server, self.port = start_fake_core(
+            lambda method, payload: {'method': method, 'payload': payload})
+        self.pool = ConnectionPool('127.0.0.1', self.port, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_request(self):
+        """
+        Ensure requests return the payload of the core reply.
+        """
+        result = self.pool.request('read_state', {'a': 1})
+
+        self.assertEqual(result, {'method': 'read_state', 'payload': {'a': 1}})
+        self.assertEqual(self.pool.stats()['misses'], 1)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_reconnect(self):
+        """
+        Ensure connections closed by the core are replaced.
+        """
+        for _ in range(3):
+            result = self.pool.request('read_state')
+            self.assertEqual(result['method'], 'read_state')
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['idle'], 2)
+
+    def test_is_alive(self):
+        """
+        Ensure idle connections are checked, also on descriptors past
+        the reach of select().
+        """
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        high = socket.socket(fileno=os.dup2(ours.fileno(), 1100))
+        ours.close()
+        conn = PooledConnection(high)
+        self.addCleanup(conn.close)
+
+        self.assertTrue(conn.is_alive())
+        theirs.sendall(b'x')
+        self.assertFalse(conn.is_alive())
+        theirs.close()
+        high.recv(1)
+        self.assertFalse(conn.is_alive())
+
+    def test_retry_unanswered_only(self):
+        """
+        Ensure a reused connection is retried when the core closed it
+        before replying, but not once part of the reply was read.
+        """
+        stale = mock.Mock()
+        stale.recv.return_value = b''
+        self.pool._idle.append(PooledConnection(stale))
+        with mock.patch.object(PooledConnection, 'is_alive',
+                               return_value=True):
+            result = self.pool.request('read_state')
+        self.assertEqual(result['method'], 'read_state')
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+
+        broken = mock.Mock()
+        broken.recv.side_effect = [b'pb', b'']
+        self.pool._idle.append(PooledConnection(broken))
+        with mock.patch.object(PooledConnection, 'is_alive',
+                               return_value=True):
+            with self.assertRaises(ProtocolError):
+                self.pool.request('add_group', {'groupname': 'kids'})
+        self.assertEqual(broken.sendall.call_count, 1)
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+
+    def test_exhausted(self):
+        """
+        Ensure acquiring from an exhausted pool times out.
+        """
+        self.pool.wait_timeout = 0.01
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire()
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_deadline(self):
+        """
+        Ensure a core slower than the deadline fails the request in time.
+        """
+        server, port = start_fake_core(lambda method, payload: time.sleep(0.5))
+        pool = ConnectionPool('127.0.0.1', port)
+        started = time.monotonic()
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                pool.request('read_state', deadline=started + 0.1)
+        finally:
+            pool.close()
+            server.stop()
+
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(pool.stats()['deadlines_exceeded'], 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    """ Core circuit breaker tests. """
+
+    def setUp(self):
+        """ Set up a breaker on a fake clock. """
+        self.now = 0.0
+        self.breaker = CircuitBreaker('test', failure_threshold=2,
+                                      reset_timeout=10, clock=lambda: self.now)
+
+    def test_opens_and_recovers(self):
+        """
+        Ensure the circuit opens after consecutive failures, lets one
+        trial call through after the reset timeout and closes on success.
+        """
+        for _ in range(2):
+            self.breaker.before()
+            self.breaker.failure()
+        with self.assertRaises(CircuitOpen) as raised:
+            self.breaker.before()
+        self.assertEqual(raised.exception.retry_after, 10)
+
+        self.now = 10
+        self.breaker.before()
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+        self.breaker.success()
+
+        self.breaker.before()
+        self.assertEqual(self.breaker.stats(), {
+            'state': 'closed', 'failures': 0, 'opened': 1, 'rejected': 2})
+
+    def test_half_open_failure(self):
+        """
+        Ensure a failed trial call opens the circuit again.
+        """
+        for _ in range(2):
+            self.breaker.failure()
+        self.now = 10
+        self.breaker.before()
+        self.breaker.failure()
+
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+
+    def test_half_open_release(self):
+        """
+        Ensure a trial call ended without an outcome gives its slot back
+        instead of leaving the circuit half-open for good.
+        """
+        for _ in range(2):
+            self.breaker.failure()
+        self.now = 10
+        self.breaker.before()
+        self.breaker.release()
+
+        self.breaker.before()
+        self.breaker.success()
+        self.assertEqual(self.breaker.stats()['state'], 'closed')
+
+    def test_client_timeout(self):
+        """
+        Ensure client timeouts are only used when shorter than the core's.
+        """
+        self.assertEqual(client_timeout('2.5'), 2.5)
+        self.assertIsNone(client_timeout('3600'))
+        self.assertIsNone(client_timeout('-1'))
+        self.assertIsNone(client_timeout(b'soon'))
+        self.assertIsNone(client_timeout(None))
+
+
+class CoreFailureTest(APITestCase):
+    """ Core outage handling tests. """
+
+    def setUp(self):
+        """ Set up test bed with a breaker opening on the first failure. """
+        User.objects.create_user(username='adminUser',
+                                 email='adminEmail@test.test',
+                                 password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        authenticate_client_admin(self.client)
+        views.STATE_CACHE.invalidate()
+        breakers = mock.patch.dict(circuit._BREAKERS, {
+            views.PROC_PORT_POLICY: CircuitBreaker('policy', 1, 60)})
+        breakers.start()
+        self.addCleanup(breakers.stop)
+        self.pool = mock.Mock()
+        pools = mock.patch.object(views, 'get_pool', return_value=self.pool)
+        pools.start()
+        self.addCleanup(pools.stop)
+
+    def test_last_known_good(self):
+        """
+        Ensure module state is served from the last good reply while the
+        core is down, and policy changes fail fast.
+        """
+        self.pool.request.return_value = {'modules': ['adblock']}
+        self.client.get(reverse('module_config'))
+
+        views.STATE_CACHE.invalidate()
+        self.pool.request.side_effect = ConnectionRefusedError()
+        response = self.client.get(reverse('module_config'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'modules': ['adblock']})
+        self.assertEqual(response['Warning'], '110 - "Response is Stale"')
+
+        calls = self.pool.request.call_count
+        response = self.client.post(reverse('add_policy_group'),
+                                    {'name': 'kids'}, format='json')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(self.pool.request.call_count, calls)
+
+    def test_core_errors_keep_circuit_closed(self):
+        """
+        Ensure errors reported by the core do not open the circuit.
+        """
+        self.pool.request.side_effect = ServerError('invalid group')
+        for _ in range(2):
+            response = self.client.post(reverse('add_policy_group'),
+                                        {'name': 'kids'}, format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def test_deadline(self):
+        """
+        Ensure the client timeout reaches the core call and a timeout
+        answers 504.
+        """
+        self.pool.request.side_effect = DeadlineExceeded()
+        started = time.monotonic()
+        response = self.client.post(reverse('add_policy_group'),
+                                    {'name': 'kids'}, format='json',
+                                    HTTP_X_REQUEST_TIMEOUT='2')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_504_GATEWAY_TIMEOUT)
+        deadline = self.pool.request.call_args[0][2]
+        self.assertAlmostEqual(deadline, started + 2, delta=0.5)
+
+    def test_tile_deadline(self):
+        """
+        Ensure a single tile request gives up at the client timeout.
+        """
+        views.TILE_CACHE.invalidate()
+        self.addCleanup(views.TILE_CACHE.invalidate)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(views, 'procbridge_call',
+                               side_effect=lambda *args: release.wait(5)):
+            started = time.monotonic()
+            response = self.client.post(reverse('tiles_data'),
+                                        {'name': 'queries'}, format='json',
+                                        HTTP_X_REQUEST_TIMEOUT='0.1')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_deadline_releases_trial(self):
+        """
+        Ensure a half-open trial cut short by the client timeout lets the
+        next call through.
+        """
+        breaker = circuit._BREAKERS[views.PROC_PORT_POLICY]
+        breaker.failure()
+        breaker.opened_at -= 60
+        self.pool.request.side_effect = DeadlineExceeded()
+        self.client.post(reverse('add_policy_group'), {'name': 'kids'},
+                         format='json', HTTP_X_REQUEST_TIMEOUT='2')
+
+        self.pool.request.side_effect = None
+        self.pool.request.return_value = {'group': {}}
+        response = self.client.post(reverse('add_policy_group'),
+                                    {'name': 'kids'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(breaker.stats()['state'], 'closed')
+
+
+class FakePolicyCore:
+    """ Procbridge delegate keeping policy levels like the core does. """
+
+    def __init__(self):
+        self.state = {'network': {'module_policies': {}},
+                      'group': {}, 'address': {}}
+        self.calls = []
+
+    def __call__(self, method, payload):
+        self.calls.append(method)
+        groups, addresses = self.state['group'], self.state['address']
+        if method == 'add_group':
+            if payload['groupname'] in groups:
+                raise ValueError('Group exists')
+            groups[payload['groupname']] = {
+                'members': payload.get('members', []), 'module_policies': {}}
+        elif method == 'add_client':
+            if payload['address'] in addresses:
+                raise ValueError('Address exists')
+            addresses[payload['address']] = {'module_policies': {}}
+        elif method == 'delete_group':
+            del groups[payload['groupname']]
+        elif method == 'delete_client':
+            del addresses[payload['address']]
+        elif method == 'update_group_policy':
+            groups[payload['groupname']]['module_policies'] =\
+                payload['module_policies']
+        elif method == 'update_client_policy':
+            addresses[payload['address']]['module_policies'] =\
+                payload['module_policies']
+        elif method == 'update_network_policy':
+            self.state['network']['module_policies'] = payload
+        return self.state
+
+
+class BulkPolicyTest(APITestCase):
+    """ Bulk policy endpoint tests. """
+
+    def setUp(self):
+        """ Set up test bed with a fake core keeping policy levels. """
+        User.objects.create_user(username='adminUser',
+                                 email='adminEmail@test.test',
+                                 password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        authenticate_client_admin(self.client)
+        self.core = FakePolicyCore()
+        self.core.state['address']['10.0.0.1'] = {
+            'module_policies': {'adblock': {'policy_records': []}}}
+        server, port = start_fake_core(self.core)
+        self.addCleanup(server.stop)
+        self.pool = ConnectionPool('127.0.0.1', port)
+        self.addCleanup(self.pool.close)
+        pools = mock.patch.object(views, 'get_pool', return_value=self.pool)
+        pools.start()
+        self.addCleanup(pools.stop)
+        breakers = mock.patch.dict(circuit._BREAKERS, clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
+
+    def bulk(self, operations, **data):
+        return self.client.post(reverse('policy_bulk'),
+                                dict(data, operations=operations),
+                                format='json')
+
+    def test_results(self):
+        """
+        Ensure every operation is applied in order and reported on,
+        whether the others fail or not.
+        """
+        response = self.bulk([
+            {'op': 'add_client', 'payload': {'address': '10.0.0.2'}},
+            {'op': 'add_client', 'payload': {'address': '10.0.0.1'}},
+            {'op': 'update_client_policy',
+             'payload': {'address': '10.0.0.2', 'module_policies': {'a': 1}}},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['ok', 'error', 'ok'])
+        self.assertEqual(response.data['results'][1]['error'], 'Address exists')
+        self.assertEqual(response.data['state']['address']['10.0.0.2'],
+                         {'module_policies': {'a': 1}})
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    def test_atomic_rollback(self):
+        """
+        Ensure a failed atomic request undoes the operations applied
+        before the failure and skips the rest.
+        """
+        before = json.loads(json.dumps(self.core.state))
+        response = self.bulk([
+            {'op': 'add_group',
+             'payload': {'groupname': 'kids', 'members': ['10.0.0.1']}},
+            {'op': 'delete_client', 'payload': {'address': '10.0.0.1'}},
+            {'op': 'update_network_policy', 'payload': {'adblock': {}}},
+            {'op': 'delete_group', 'payload': {'groupname': 'guests'}},
+            {'op': 'add_client', 'payload': {'address': '10.0.0.3'}},
+        ], atomic=True)
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['rolled_back', 'rolled_back', 'rolled_back',
+                          'error', 'skipped'])
+        self.assertEqual(self.core.state, before)
+        self.assertEqual(response.data['state'], before)
+
+    def test_validation(self):
+        """
+        Ensure invalid operations are all reported and none is applied.
+        """
+        response = self.bulk([
+            {'op': 'add_client', 'payload': {'address': '10.0.0.2'}},
+            {'op': 'reboot', 'payload': {}},
+            {'op': 'delete_group', 'payload': {'address': '10.0.0.2'}},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data['operations']), {'1', '2'})
+        self.assertEqual(self.core.calls, [])
+
+
+class MetricsTest(APITestCase):
+    """ Request timing and metrics endpoint tests. """
+
+    def setUp(self):
+        """ Set up test bed with an admin and a regular user. """
+        User.objects.create_superuser(username='adminUser',
+                                      email='adminEmail@test.test',
+                                      password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        User.objects.create_user(username='regularUser',
+                                 email='regularEmail@test.test',
+                                 password='regularPassword')
+        Token.objects.create(key="regularTokenKey", user_id=2)
+        views.STATE_CACHE.invalidate()
+        metrics.REQUEST_PHASES.clear()
+
+    def test_histogram(self):
+        """
+        Ensure observations are counted in cumulative buckets.
+        """
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('phase',),
+                                      buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2):
+            histogram.observe(('core',), seconds)
+
+        self.assertEqual(histogram.expose()[2:], [
+            'test_seconds_bucket{phase="core",le="0.1"} 2',
+            'test_seconds_bucket{phase="core",le="1.0"} 3',
+            'test_seconds_bucket{phase="core",le="+Inf"} 4',
+            'test_seconds_sum{phase="core"} 2.65',
+            'test_seconds_count{phase="core"} 4',
+        ])
+
+    def test_request_phases(self):
+        """
+        Ensure the phases of a request are sent back in Server-Timing and
+        exposed on the metrics endpoint with the runtime statistics.
+        """
+        authenticate_client_admin(self.client)
+        pool = mock.Mock()
+        pool.request.return_value = {'modules': []}
+        with mock.patch.object(views, 'get_pool', return_value=pool):
+            response = self.client.get(reverse('module_config'))
+
+        phases = [timing.split(';')[0]
+                  for timing in response['Server-Timing'].split(', ')]
+        self.assertEqual(sorted(phases),
+                         ['auth', 'core', 'serialize', 'total'])
+
+        response = self.client.get(reverse('runtime_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.decode().splitlines()
+        self.assertIn('privadome_request_phase_seconds_count'
+                      '{endpoint="module_config",phase="core"} 1', lines)
+        self.assertTrue(any(line.startswith('privadome_token_cache_hits ')
+                            for line in lines))
+
+    def test_background_phases(self):
+        """
+        Ensure a tile batch times the wait for its tiles and background
+        cache refreshes are timed under their own label.
+        """
+        authenticate_client_admin(self.client)
+        views.TILE_CACHE.invalidate()
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'tile': 1}):
+            response = self.client.post(reverse('tiles_batch'),
+                                        {'names': ['queries']}, format='json')
+        self.assertIn('core;dur=', response['Server-Timing'])
+
+        views.TILE_CACHE._refresh('queries',
+                                  lambda: metrics.record('core', 0.5))
+        self.assertIn('privadome_request_phase_seconds_count'
+                      '{endpoint="tiles_refresh",phase="core"} 1',
+                      metrics.REQUEST_PHASES.expose())
+        views.TILE_CACHE.invalidate()
+
+    def test_metrics_admin_only(self):
+        """
+        Ensure regular users cannot read the metrics.
+        """
+        authenticate_client_regular(self.client)
+        response = self.client.get(reverse('runtime_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+def spin(stop):
+    """ Keep a CPU busy until stop is set. """
+    while not stop.is_set():
+        sum(range(100))
+
+
+class ProfilerTest(SimpleTestCase):
+    """ Sampling profiler tests. """
+
+    def setUp(self):
+        """ Set up a busy and an idle thread. """
+        self.stop = threading.Event()
+        self.addCleanup(self.stop.set)
+        for target, name in ((spin, 'busy-1'), (self.stop.wait, 'idle-1')):
+            thread = threading.Thread(target=target, name=name,
+                                      args=(self.stop,) if target is spin
+                                      else (), daemon=True)
+            thread.start()
+
+    def test_sample(self):
+        """
+        Ensure stacks are counted from the thread root, by thread group,
+        and idle threads are left out.
+        """
+        sampler = SamplingProfiler()
+        for _ in range(5):
+            sampler.sample(exclude=threading.get_ident())
+
+        stacks = sampler.collapsed().splitlines()
+        busy = [line for line in stacks if line.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertIn(';spin (test.py:', busy[0])
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in busy), 5)
+        self.assertFalse([line for line in stacks if line.startswith('idle;')])
+
+        sampler = SamplingProfiler(idle=True)
+        sampler.sample()
+        self.assertIn('idle;', sampler.collapsed())
+
+
+class ProfileEndpointTest(APITestCase):
+    """ Profile endpoint tests. """
+
+    def setUp(self):
+        """ Set up test bed with an admin and a profile directory. """
+        User.objects.create_superuser(username='adminUser',
+                                      email='adminEmail@test.test',
+                                      password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        authenticate_client_admin(self.client)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(profiler.stop_profile)
+
+    def test_profile(self):
+        """
+        Ensure a profile runs alone and leaves a collapsed stack file.
+        """
+        url = reverse('runtime_profile')
+        with override_settings(PRIVADOME_PROFILE_DIR=self.directory,
+                               PRIVADOME_PROFILE_INTERVAL=0.001):
+            response = self.client.post(url, {'seconds': 5}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertTrue(response.data['running'])
+            response = self.client.post(url, {'seconds': 5}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        time.sleep(0.05)
+        response = self.client.delete(url)
+        self.assertFalse(response.data['running'])
+        self.assertEqual(response.data['pid'], os.getpid())
+        self.assertGreater(response.data['samples'], 0)
+        with open(response.data['path']) as f:
+            self.assertIn('MainThread;', f.read())
+
+        response = self.client.get(url, {'download': ''})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'MainThread;', response.content)
+
+    def test_distinct_files(self):
+        """
+        Ensure profiles started within the same second get their own file.
+        """
+        paths = set()
+        for _ in range(2):
+            paths.add(profiler.start_profile(0.01, directory=self.directory)
+                      .path)
+            profiler.stop_profile()
+
+        self.assertEqual(len(paths), 2)
+
+    def test_seconds_limit(self):
+        """
+        Ensure profiles longer than the limit are refused.
+        """
+        response = self.client.post(reverse('runtime_profile'),
+                                    {'seconds': 3600}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_object(self):
+        """
+        Ensure bodies other than JSON objects are refused.
+        """
+        for data in ([], 5):
+            response = self.client.post(reverse('runtime_profile'), data,
+                                        format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class ProcbridgeClientProtocolTest(SimpleTestCase):
+    """ Reactor procbridge client tests. """
+
+    def connect(self):
+        """ Connect a client protocol to a fake transport. """
+        client = ProcbridgeClientProtocol('read_state', {'a': 1})
+        transport = StringTransport()
+        client.makeConnection(transport)
+        return client, transport
+
+    def test_request(self):
+        """
+        Ensure the request frame is sent and a split reply is decoded.
+        """
+        client, transport = self.connect()
+        self.assertEqual(transport.value(), encode_frame(
+            StatusCode.REQUEST, {'method': 'read_state', 'payload': {'a': 1}}))
+
+        reply = encode_frame(StatusCode.GOOD_RESPONSE, {'payload': [1, 2]})
+        results = []
+        client.deferred.addCallback(results.append)
+        client.dataReceived(reply[:5])
+        self.assertEqual(results, [])
+        client.dataReceived(reply[5:])
+
+        self.assertEqual(results, [[1, 2]])
+        self.assertTrue(transport.disconnecting)
+
+    def test_bad_response(self):
+        """
+        Ensure core errors fail the request.
+        """
+        client, _ = self.connect()
+        failures = []
+        client.deferred.addErrback(failures.append)
+        client.dataReceived(encode_frame(StatusCode.BAD_RESPONSE,
+                                         {'message': 'no such method'}))
+
+        self.assertTrue(failures[0].check(ServerError))
+
+    def test_cancel_aborts(self):
+        """
+        Ensure cancelling a request aborts its connection.
+        """
+        client, transport = self.connect()
+        client.deferred.addErrback(lambda failure: None)
+        client.deferred.cancel()
+
+        self.assertTrue(transport.disconnected)
+
+    def test_connect_timeout(self):
+        """
+        Ensure a request timing out while connecting stops the connection
+        attempt and fails once.
+        """
+        reactor = MemoryReactorClock()
+        failures = []
+        procbridge_request(reactor, '127.0.0.1', 8077, 'read_state',
+                           timeout=5).addErrback(failures.append)
+        reactor.advance(5)
+
+        self.assertTrue(failures[0].check(defer.TimeoutError))
+        self.assertTrue(reactor.connectors[0].stoppedConnecting)
+
+
+class InlineThreadPool:
+    """ Thread pool running every call at once in the calling thread. """
+
+    def callInThreadWithCallback(self, onResult, function, *args, **kwargs):
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+class InlineMemoryReactor(MemoryReactorClock):
+    """ Memory reactor running calls from threads at once. """
+
+    def callFromThread(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+
+class InlineExecutor:
+    """ Executor running every call at once in the calling thread. """
+
+    def __init__(self):
+        self.calls = 0
+
+    def submit(self, function, *args):
+        self.calls += 1
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+class CoreProxyResourceTest(SimpleTestCase):
+    """ Reactor core proxy tests. """
+
+    def setUp(self):
+        """ Set up a proxy on a memory reactor with a stub core. """
+        self.reactor = InlineMemoryReactor()
+        self.proxy = CoreProxyResource(self.reactor, InlineThreadPool())
+        self.executor = InlineExecutor()
+        versions = VersionStore()
+        for patch in (
+                mock.patch.object(coreproxy, 'authenticate',
+                                  return_value='user'),
+                mock.patch.dict(circuit._BREAKERS, {
+                    views.PROC_PORT_POLICY: CircuitBreaker('policy', 1, 60),
+                    views.PROC_PORT_DATA: CircuitBreaker('data', 1, 60)}),
+                mock.patch.object(coreproxy, 'TILE_EXECUTOR', self.executor),
+                mock.patch.object(coreproxy, 'VERSIONS', versions),
+                mock.patch.object(delta, 'VERSIONS', versions)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        for cache in (views.STATE_CACHE, views.SCHEMA_CACHE, views.TILE_CACHE):
+            cache.invalidate()
+            self.addCleanup(cache.invalidate)
+        core = mock.patch.object(coreproxy, 'procbridge_request',
+                                 return_value=defer.succeed({'modules': []}))
+        self.core = core.start()
+        self.addCleanup(core.stop)
+
+    def render(self, path, method=b'GET', body=b'', timeout=None,
+               etag=None):
+        """ Render a request of path, relative to /api. """
+        segments = path.split(b'/')
+        request = DummyRequest(segments[1:])
+        request.prepath = segments[:1]
+        request.method = method
+        request.content = io.BytesIO(body)
+        request.requestHeaders.setRawHeaders(b'authorization', [b'Token t'])
+        if timeout is not None:
+            request.requestHeaders.setRawHeaders(b'x-request-timeout',
+                                                 [timeout])
+        if etag is not None:
+            request.requestHeaders.setRawHeaders(b'if-none-match', [etag])
+        result = self.proxy.render(request)
+        if result is not web_server.NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+        return request
+
+    @staticmethod
+    def body(request):
+        """ Decoded JSON body of a rendered request. """
+        return json.loads(b''.join(request.written))
+
+    def test_forward(self):
+        """
+        Ensure routed requests are answered with the reply of the core.
+        """
+        request = self.render(b'modules/config')
+
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(self.body(request), {'modules': []})
+        self.assertEqual(self.core.call_args[0][2:5],
+                         (views.PROC_PORT_POLICY, 'read_state', None))
+
+    def test_wrong_method(self):
+        """
+        Ensure routes answer 405 to other methods, without the core.
+        """
+        request = self.render(b'modules/config', b'POST')
+
+        self.assertEqual(request.responseCode, 405)
+        self.assertFalse(self.core.called)
+
+    def test_unauthenticated(self):
+        """
+        Ensure requests without a valid token answer 401 with a challenge.
+        """
+        coreproxy.authenticate.side_effect = exceptions.NotAuthenticated()
+        request = self.render(b'modules/config')
+
+        self.assertEqual(request.responseCode, 401)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'www-authenticate'), [b'Token'])
+        self.assertFalse(self.core.called)
+
+    def test_circuit_open(self):
+        """
+        Ensure the core is not called while its circuit is open.
+        """
+        circuit._BREAKERS[views.PROC_PORT_POLICY].failure()
+        request = self.render(b'modules/config')
+
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'retry-after'), [b'60'])
+        self.assertFalse(self.core.called)
+
+    def test_timeout(self):
+        """
+        Ensure a core that does not answer in the client timeout gives 504
+        and leaves the circuit closed.
+        """
+        self.core.side_effect = procbridge_request
+        request = self.render(b'modules/config', timeout=b'2')
+        self.reactor.advance(2)
+
+        self.assertEqual(request.responseCode, 504)
+        self.assertEqual(
+            circuit._BREAKERS[views.PROC_PORT_POLICY].stats()['state'],
+            'closed')
+
+    def test_client_gone(self):
+        """
+        Ensure the core call is cancelled when the client disconnects.
+        """
+        cancelled = []
+        self.core.return_value = defer.Deferred(cancelled.append)
+        request = self.render(b'modules/addpolicy/group', b'POST',
+                              b'{"name": "kids"}')
+        request.processingFailed(failure.Failure(error.ConnectionDone()))
+
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(request.written, [])
+
+    def test_cached_reads(self):
+        """
+        Ensure module state is loaded once for concurrent clients, served
+        from the state cache with its ETag and dropped by policy changes.
+        """
+        reply = defer.Deferred()
+        self.core.return_value = reply
+        first = self.render(b'modules/config')
+        second = self.render(b'modules/config')
+        reply.callback({'modules': ['adblock']})
+
+        self.assertEqual(self.core.call_count, 1)
+        for request in (first, second):
+            self.assertEqual(request.responseCode, 200)
+            self.assertEqual(self.body(request), {'modules': ['adblock']})
+        etag = first.responseHeaders.getRawHeaders(b'etag')[0]
+
+        request = self.render(b'modules/config', etag=etag)
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(request.written, [])
+        self.assertEqual(self.core.call_count, 1)
+
+        self.core.return_value = defer.succeed({})
+        self.render(b'modules/addpolicy/group', b'POST', b'{"name": "kids"}')
+        self.core.return_value = defer.succeed({'modules': []})
+        request = self.render(b'modules/config')
+        self.assertEqual(self.body(request), {'modules': []})
+        self.assertEqual(self.core.call_count, 3)
+
+    def test_last_known_good(self):
+        """
+        Ensure a read is answered with the last good payload while the
+        core is down.
+        """
+        self.core.return_value = defer.succeed({'modules': ['adblock']})
+        self.render(b'modules/config')
+        views.STATE_CACHE.invalidate()
+        self.core.return_value = defer.fail(ConnectionRefusedError())
+        request = self.render(b'modules/config')
+
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(self.body(request), {'modules': ['adblock']})
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'warning'),
+                         [b'110 - "Response is Stale"'])
+
+    def test_tile(self):
+        """
+        Ensure tiles are fetched through the tile cache and served on the
+        reactor while they are fresh.
+        """
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'tile': 1}) as call:
+            responses = [self.render(b'tiles/data', b'POST',
+                                     b'{"name": "queries"}')
+                         for _ in range(2)]
+
+        self.assertEqual(call.call_count, 1)
+        self.assertEqual(self.executor.calls, 1)
+        self.assertEqual(
+            [(request.responseCode, self.body(request),
+              request.responseHeaders.getRawHeaders(b'x-cache'))
+             for request in responses],
+            [(200, {'tile': 1}, [b'MISS']), (200, {'tile': 1}, [b'HIT'])])
+        self.assertFalse(self.core.called)
+
+    def test_routing(self):
+        """
+        Ensure core routes reach the proxy and every other path is handed
+        back to WSGI with its path segment.
+        """
+        wsgi, core_wsgi = web_resource.Resource(), web_resource.Resource()
+        api = ApiResource(wsgi, self.proxy)
+        request = DummyRequest([b'config'])
+        request.prepath = [b'api', b'modules']
+        self.assertIs(api.getChild(b'modules', request), self.proxy)
+        self.assertEqual(request.prepath, [b'api', b'modules'])
+
+        request = DummyRequest([b''])
+        request.prepath = [b'api', b'users']
+        self.assertIs(api.getChild(b'users', request), wsgi)
+        self.assertEqual((request.prepath, request.postpath),
+                         ([b'api'], [b'users', b'']))
+
+        api = ApiResource(wsgi, core_wsgi_resource=core_wsgi)
+        request = DummyRequest([b'config', b''])
+        request.prepath = [b'api', b'modules']
+        self.assertIs(api.getChild(b'modules', request), core_wsgi)
+        self.assertEqual(request.postpath, [b'modules', b'config', b''])
+
+
+class JSONCodecTest(SimpleTestCase):
+    """ JSON codec tests. """
+
+    def test_raw_request_frame(self):
+        """
+        Ensure pass-through bodies are framed like encoded payloads.
+        """
+        body = b'{"name":"kids","clients":["10.0.0.2"]}'
+
+        self.assertEqual(encode_request('add_group', raw(body)),
+                         encode_request('add_group',
+                                        {'name': 'kids',
+                                         'clients': ['10.0.0.2']}))
+        with self.assertRaises(ValueError):
+            raw(b'{"name":')
+
+    def test_renderer(self):
+        """
+        Ensure the renderer is compact, keeps non-ASCII text and leaves
+        datetimes to the DRF encoder.
+        """
+        renderer = JSONRenderer()
+        when = datetime.datetime(2020, 1, 2, 3, 4, 5, 678901)
+
+        self.assertEqual(renderer.render({'a': 'é', 'b': [1, 2]}),
+                         '{"a":"é","b":[1,2]}'.encode('utf-8'))
+        self.assertEqual(renderer.render({'at': when}),
+                         b'{"at":"2020-01-02T03:04:05.678901"}')
+        self.assertEqual(renderer.render(RawJSON(b'{"a": 1}')), b'{"a": 1}')
+
+    def test_non_finite(self):
+        """
+        Ensure NaN and infinities are refused like the strict DRF encoder
+        does, whatever the backend.
+        """
+        for value in (float('nan'), float('inf'), float('-inf')):
+            with self.assertRaises(ValueError):
+                dumps({'a': [value]})
+            with self.assertRaises(ValueError):
+                JSONRenderer().render({'a': [value]})
+        self.assertEqual(dumps({'a': None, 'b': 'NaN'}),
+                         b'{"a":null,"b":"NaN"}')
+
+    def test_reply_not_object(self):
+        """
+        Ensure core replies whose body is not an object are refused.
+        """
+        header = encode_frame(StatusCode.GOOD_RESPONSE, [1])[:HEADER_LENGTH]
+        with self.assertRaises(ProtocolError):
+            decode_reply(header, b'[1]')
+
+
+class TTLCacheTest(SimpleTestCase):
+    """ Core response cache tests. """
+
+    def test_hit_and_invalidate(self):
+        """
+        Ensure cached values are reused until invalidated.
+        """
+        cache = TTLCache('test', 60)
+        loads = []
+        loader = lambda: loads.append(1) or len(loads)
+
+        self.assertEqual(cache.get_or_load('key', loader), 1)
+        self.assertEqual(cache.get_or_load('key', loader), 1)
+        cache.invalidate()
+        self.assertEqual(cache.get_or_load('key', loader), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_single_flight(self):
+        """
+        Ensure concurrent misses produce a single load.
+        """
+        cache = TTLCache('test', 60)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.1)
+            return 'state'
+
+        results = []
+        workers = [threading.Thread(
+            target=lambda: results.append(cache.get_or_load('key', loader)))
+                   for _ in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ['state'] * 10)
+
+
+class ModuleConfigCacheTest(APITestCase):
+    """ Module state caching tests. """
+
+    def setUp(self):
+        """ Set up test bed. """
+        User.objects.create_user(username='adminUser',
+                                 email='adminEmail@test.test',
+                                 password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        views.STATE_CACHE.invalidate()
+
+    def test_policy_change_invalidates(self):
+        """
+        Ensure the state is cached until a policy view changes it.
+        """
+        authenticate_client_admin(self.client)
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'state': 1}) as call:
+            self.client.get(reverse('module_config'))
+            response = self.client.get(reverse('module_config'))
+            self.assertEqual(response.data, {'state': 1})
+            self.assertEqual(call.call_count, 1)
+
+            self.client.post(reverse('add_policy_group'), {'name': 'group'},
+                             format='json')
+            self.client.get(reverse('module_config'))
+            self.assertEqual(call.call_count, 3)
+
+    def test_not_modified(self):
+        """
+        Ensure an unchanged state is revalidated with its ETag.
+        """
+        authenticate_client_admin(self.client)
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'state': 1}):
+            response = self.client.get(reverse('module_config'))
+            response = self.client.get(reverse('module_config'),
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_delta(self):
+        """
+        Ensure a JSON patch is sent relative to a known version.
+        """
+        authenticate_client_admin(self.client)
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'state': 1, 'groups': ['a']}):
+            version = self.client.get(reverse('module_config'))['ETag']
+        views.STATE_CACHE.invalidate()
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'state': 2, 'groups': ['a']}):
+            response = self.client.get(reverse('module_config'),
+                                       {'since': version.strip('"')})
+
+        self.assertEqual(response.data['since'], version)
+        self.assertEqual(response.data['patch'],
+                         [{'op': 'replace', 'path': '/state', 'value': 2}])
+
+    def test_json_patch(self):
+        """
+        Ensure patches add, remove and replace members.
+        """
+        patch = json_patch({'a': 1, 'b': {'c': [1]}, 'd/e': 0},
+                           {'a': 1, 'b': {'c': [2]}, 'f': None})
+
+        self.assertEqual(patch, [
+            {'op': 'remove', 'path': '/d~1e'},
+            {'op': 'replace', 'path': '/b/c', 'value': [2]},
+            {'op': 'add', 'path': '/f', 'value': None}])
+
+
+class DispatchTest(APITestCase):
+    """ Dict dispatch of the core proxy endpoints tests. """
+
+    def setUp(self):
+        """ Set up test bed. """
+        User.objects.create_user(username='adminUser',
+                                 email='adminEmail@test.test',
+                                 password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        views.STATE_CACHE.invalidate()
+
+    def test_routes(self):
+        """
+        Ensure every module endpoint is in the dispatch table.
+        """
+        self.assertEqual(ROUTES['/modules/config/'].url_name, 'module_config')
+        self.assertEqual(len([path for path in ROUTES
+                              if path.startswith('/modules/')]), 10)
+
+    def test_dispatch_skips_resolver(self):
+        """
+        Ensure module endpoints are answered without URL resolving.
+        """
+        authenticate_client_admin(self.client)
+        with mock.patch.object(views, 'procbridge_call',
+                               return_value={'a': 1}),\
+                mock.patch('django.urls.resolvers.URLResolver.resolve',
+                           side_effect=AssertionError('resolved')):
+            response = self.client.get(reverse('module_config'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'a': 1})
+
+    def test_anchored(self):
+        """
+        Ensure module paths do not match under other prefixes.
+        """
+        authenticate_client_admin(self.client)
+        response = self.client.get('/users/modules/config/')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_fast_proxy(self):
+        """
+        Ensure the minimal policy handlers answer like the DRF views.
+        """
+        url = reverse('add_policy_group')
+        fast = build_routes(urls.urlpatterns, handlers=fastpath.HANDLERS)
+        body = {'name': 'kids'}
+        responses = []
+        for routes in ({}, fast):
+            with mock.patch.dict(ROUTES, routes),\
+                    mock.patch.object(views, 'procbridge_call',
+                                      return_value={'ok': 'é'}) as call:
+                self.client.credentials()
+                unauthenticated = self.client.post(url, body, format='json')
+                authenticate_client_admin(self.client)
+                views.STATE_CACHE.get_or_load('read_state', lambda: 1)
+                response = self.client.post(url, body, format='json')
+            self.assertEqual(call.call_args[0][:2],
+                             ('add_group', b'{"name":"kids"}'))
+            self.assertEqual(views.STATE_CACHE.stats()['entries'], 0)
+            responses.append((unauthenticated.status_code,
+                              unauthenticated['WWW-Authenticate'],
+                              response.status_code, response.content))
+
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual(responses[1][:3], (401, 'Token', 200))
+
+
+class TilesBatchTest(APITestCase):
+    """ Batched tile data tests. """
+
+    def setUp(self):
+        """ Set up test bed. """
+        User.objects.create_user(username='adminUser',
+                                 email='adminEmail@test.test',
+                                 password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        views.TILE_CACHE.invalidate()
+
+    def test_batch(self):
+        """
+        Ensure each distinct tile is fetched once and errors are per tile.
+        """
+        def core(name, body, port):
+            if name == 'broken':
+                raise LookupError('Error')
+            return {'tile': name}
+
+        authenticate_client_admin(self.client)
+        with mock.patch.object(views, 'procbridge_call',
+                               side_effect=core) as call:
+            response = self.client.post(
+                reverse('tiles_batch'),
+                {'names': ['queries', 'blocked', 'queries', 'broken']},
+                format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(response.data['tiles'],
+                         {'queries': {'tile': 'queries'},
+                          'blocked': {'tile': 'blocked'}})
+        self.assertEqual(list(response.data['errors']), ['broken'])
+        self.assertEqual(response.data['cache'],
+                         {'queries': 'miss', 'blocked': 'miss'})
+
+    def test_batch_invalid(self):
+        """
+        Ensure a batch must name its tiles.
+        """
+        authenticate_client_admin(self.client)
+        response = self.client.post(reverse('tiles_batch'), {'names': []},
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_tile_invalid(self):
+        """
+        Ensure a single tile request must name its tile with a string.
+        """
+        authenticate_client_admin(self.client)
+        for data in ({}, {'name': 42}, {'name': ''}, ['queries']):
+            response = self.client.post(reverse('tiles_data'), data,
+                                        format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class StaleWhileRevalidateCacheTest(SimpleTestCase):
+    """ Tile cache tests. """
+
+    class InlineExecutor:
+        """ Run submitted refreshes immediately. """
+
+        def submit(self, function, *args):
+            function(*args)
+
+    def test_freshness(self):
+        """
+        Ensure fresh entries hit and stale entries are refreshed.
+        """
+        cache = StaleWhileRevalidateCache('test', self.InlineExecutor(),
+                                          freshness={'slow': 60},
+                                          default_freshness=0.05)
+        loads = []
+        loader = lambda: loads.append(1) or len(loads)
+
+        self.assertEqual(cache.get('fast', loader), (1, 'miss'))
+        self.assertEqual(cache.get('fast', loader), (1, 'hit'))
+        time.sleep(0.06)
+        self.assertEqual(cache.get('fast', loader), (1, 'stale'))
+        self.assertEqual(cache.get('fast', loader), (2, 'hit'))
+
+        self.assertEqual(cache.get('slow', loader), (3, 'miss'))
+        time.sleep(0.06)
+        self.assertEqual(cache.get('slow', loader), (3, 'hit'))
+
+    def test_lru_bound(self):
+        """
+        Ensure the least recently used entries are evicted.
+        """
+        cache = StaleWhileRevalidateCache('test', self.InlineExecutor(),
+                                          max_entries=2, default_freshness=60)
+        cache.get('a', lambda: 'a')
+        cache.get('b', lambda: 'b')
+        cache.get('a', lambda: 'a')
+        cache.get('c', lambda: 'c')
+
+        self.assertEqual(cache.get('a', lambda: 'new')[1], 'hit')
+        self.assertEqual(cache.get('b', lambda: 'new'), ('new', 'miss'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_byte_bound(self):
+        """
+        Ensure entries are evicted once their JSON outgrows max_bytes,
+        and values larger than the whole budget are not kept.
+        """
+        cache = StaleWhileRevalidateCache('test', self.InlineExecutor(),
+                                          max_bytes=25, default_freshness=60)
+        cache.get('a', lambda: 'x' * 8)
+        cache.get('b', lambda: 'x' * 8)
+        self.assertEqual(cache.stats()['bytes'], 20)
+        cache.get('c', lambda: 'x' * 8)
+
+        self.assertEqual(cache.stats()['bytes'], 20)
+        self.assertEqual(cache.get('a', lambda: 'new'), ('new', 'miss'))
+        cache.get('huge', lambda: 'x' * 100)
+        self.assertEqual(cache.get('huge', lambda: 'y')[1], 'miss')
+        self.assertLessEqual(cache.stats()['bytes'], 25)
+
+
+class TileHubTest(SimpleTestCase):
+    """ Tile stream fan-out tests. """
+
+    class Subscriber:
+        """ Record the events sent to a viewer. """
+
+        def __init__(self):
+            self.events = []
+
+        def send(self, encoded):
+            self.events.append(encoded)
+
+    def setUp(self):
+        """ Set up a hub polling a fake core on a fake clock. """
+        self.clock = task.Clock()
+        self.fetches = []
+        self.value = 1
+
+        def fetch(name):
+            self.fetches.append(name)
+            return defer.succeed(self.value)
+
+        self.breaker = CircuitBreaker('data', 2, 60, clock=self.clock.seconds)
+        self.hub = TileHub(self.clock, 2, fetch, self.breaker)
+
+    def test_fan_out(self):
+        """
+        Ensure each tile is polled once per interval for all viewers
+        and only changes are pushed.
+        """
+        first, second = self.Subscriber(), self.Subscriber()
+        self.hub.subscribe(first, ['queries'])
+        self.hub.subscribe(second, ['queries'])
+        self.clock.advance(2)
+
+        self.assertEqual(self.fetches, ['queries', 'queries'])
+        self.assertEqual(len(first.events), 1)
+        self.assertEqual(second.events, first.events)
+
+        self.value = 2
+        self.clock.advance(2)
+        self.assertEqual(len(first.events), 2)
+        self.assertEqual(len(second.events), 2)
+
+    def test_unsubscribe(self):
+        """
+        Ensure tiles without viewers are no longer polled.
+        """
+        viewer = self.Subscriber()
+        self.hub.subscribe(viewer, ['queries'])
+        self.hub.unsubscribe(viewer)
+        self.clock.advance(10)
+
+        self.assertEqual(self.fetches, ['queries'])
+        self.assertEqual(self.hub.stats(), {'tiles': 0, 'subscribers': 0})
+
+    def test_core_down(self):
+        """
+        Ensure polling stops while the data circuit is open, resumes
+        after the reset timeout and errors are logged once per outage.
+        """
+        self.hub.fetch = lambda name: (self.fetches.append(name)
+                                       or defer.fail(ConnectionRefusedError()))
+        viewer = self.Subscriber()
+        with mock.patch('builtins.print') as log:
+            self.hub.subscribe(viewer, ['queries'])
+            for _ in range(10):
+                self.clock.advance(2)
+            self.assertEqual(len(self.fetches), 2)
+
+            self.hub.fetch = lambda name: (self.fetches.append(name)
+                                           or defer.succeed(1))
+            self.clock.advance(60)
+
+        self.assertEqual(len(self.fetches), 3)
+        self.assertEqual(self.breaker.stats()['state'], 'closed')
+        self.assertEqual(len(viewer.events), 1)
+        self.assertEqual(log.call_count, 2)
+
+    def test_invalid_names(self):
+        """
+        Ensure tile names that are not UTF-8 are refused.
+        """
+        stream = TileStreamResource(self.clock, None, self.hub)
+        request = DummyRequest([b'stream'])
+        request.args = {b'names': [b'\xff']}
+        stream.render_GET(request)
+
+        self.assertEqual(request.responseCode, 400)
+
+
+class TokenCacheTest(APITestCase):
+    """ Token authentication cache tests. """
+
+    def setUp(self):
+        """ Set up test bed. """
+        TOKEN_CACHE.clear()
+        self.user = User.objects.create_user(username='adminUser',
+                                             email='adminEmail@test.test',
+                                             password='adminPassword')
+        Token.objects.create(key="adminTokenKey", user_id=1)
+        self.url = reverse('user-list')
+        authenticate_client_admin(self.client)
+
+    def test_cached(self):
+        """
+        Ensure repeated requests do not look the token up again.
+        """
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_disabled_with_workers(self):
+        """
+        Ensure tokens are not cached when several workers serve the API.
+        """
+        with mock.patch.dict(os.environ, {WORKERS_ENV: '4'}):
+            self.assertEqual(token_cache_ttl(), 0)
+        with mock.patch.dict(os.environ, {WORKERS_ENV: '1'}):
+            self.assertEqual(token_cache_ttl(), 60)
+
+    def test_token_deleted(self):
+        """
+        Ensure deleted tokens are no longer accepted.
+        """
+        self.client.get(self.url)
+        Token.objects.filter(key='adminTokenKey').delete()
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_deactivated(self):
+        """
+        Ensure tokens of deactivated users are no longer accepted.
+        """
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(PRIVADOME_AUTH_TOKENS='signed')
+class SignedTokenTest(APITestCase):
+    """ Signed token authentication tests. """
+
+    def setUp(self):
+        """ Set up test bed. """
+        User.objects.create_user(username='regularUser',
+                                 email='regularEmail@test.test',
+                                 password='regularPassword')
+        response = self.client.post(reverse('login'),
+                                    {'username': 'regularUser',
+                                     'password': 'regularPassword'},
+                                    format='json')
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + response.json()['token'])
+
+    def test_no_database(self):
+        """
+        Ensure signed tokens are verified without database access.
+        """
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('runtime_stats'))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Token.objects.count(), 0)
+
+    def test_list_self(self):
+        """
+        Ensure the user rebuilt from the token sees itself.
+        """
+        response = self.client.get(reverse('user-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['username'], 'regularUser')
+
+    def test_logout(self):
+        """
+        Ensure logged out tokens are revoked.
+        """
+        response = self.client.post(reverse('logout'))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(reverse('user-list'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change(self):
+        """
+        Ensure password changes revoke the tokens issued before.
+        """
+        response = self.client.patch(reverse('user-detail', args=[1]),
+                                     {'oldPassword': 'regularPassword',
+                                      'newPassword': 'modifiedPassword'},
+                                     format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse('user-list'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_invalid(self):
+        """
+        Ensure tampered tokens are rejected.
+        """
+        self.client.credentials(HTTP_AUTHORIZATION='Token forged:token')
+        response = self.client.get(reverse('user-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_shared_cache_required(self):
+        """
+        Ensure signed tokens are refused with a per-process cache, where
+        revocations would not reach the other workers.
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            check_revocation_cache()
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.memcached.'
+                           'MemcachedCache',
+                'LOCATION': '127.0.0.1:11211'}}):
+            check_revocation_cache()
+
+
+class InstrumentedThreadPoolTest(SimpleTestCase):
+    """ WSGI thread pool instrumentation and load shedding tests. """
+
+    def setUp(self):
+        """ Start a pool with a single thread and a queue of one call. """
+        self.pool = InstrumentedThreadPool(1, 1, 'test', max_queue=1)
+        self.pool.start()
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        if not self.pool.joined:
+            self.pool.stop()
+
+    def block(self):
+        self.started.set()
+        self.release.wait()
+
+    def test_metrics(self):
+        """
+        Ensure running and queued calls are counted.
+        """
+        self.pool.callInThread(self.block)
+        self.started.wait(1)
+        self.pool.callInThread(lambda: None)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['active'], 1)
+        self.assertEqual(stats['queued'], 1)
+        self.assertTrue(self.pool.saturated())
+
+        self.release.set()
+        self.pool.stop()
+        self.assertEqual(self.pool.stats()['completed'], 2)
+
+    def test_shedding(self):
+        """
+        Ensure requests are answered with 503 while the pool is saturated.
+        """
+        self.pool.callInThread(self.block)
+        self.started.wait(1)
+        self.pool.callInThread(lambda: None)
+        request = DummyRequest([b'users', b''])
+
+        resource = SheddingWSGIResource(None, self.pool, None)
+        body = resource.render(request)
+
+        self.assertEqual(request.responseCode, 503)
+        self.assertIn(b'busy', body)
+        self.assertEqual(self.pool.stats()['rejected'], 1)
+
+
+class CompressedStaticFileTest(SimpleTestCase):
+    """ Static bundle serving tests. """
+
+    def setUp(self):
+        """ Set up a static directory with a hashed bundle and an index. """
+        self.directory = tempfile.mkdtemp()
+        self.bundle = b'console.log("privadome");' * 100
+        for name, data in (('main.b2a9b0443009afec47a7.js', self.bundle),
+                           ('index.html', b'<html></html>' * 10),
+                           ('logo.png', b'png')):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, name, encoding=None):
+        """ Render a static file, return the request and the body. """
+        request = DummyRequest([name.encode()])
+        if encoding is not None:
+            request.requestHeaders.setRawHeaders(b'accept-encoding', [encoding])
+        resource = CompressedStaticFile(os.path.join(self.directory, name))
+        resource.render_GET(request)
+        return request, b''.join(request.written)
+
+    def test_compress_static(self):
+        """
+        Ensure variants are written for compressible files only, once.
+        """
+        written = compress_static(self.directory)
+
+        self.assertIn(os.path.join(self.directory,
+                                   'main.b2a9b0443009afec47a7.js.gz'), written)
+        self.assertFalse(any(path.endswith('logo.png.gz') for path in written))
+        self.assertEqual(compress_static(self.directory), [])
+
+    def test_precompressed(self):
+        """
+        Ensure accepted precompressed variants are served as immutable.
+        """
+        compress_static(self.directory)
+        request, body = self.render('main.b2a9b0443009afec47a7.js',
+                                    b'br;q=0, gzip')
+
+        self.assertEqual(gzip.decompress(body), self.bundle)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'content-encoding'), [b'gzip'])
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'cache-control'), [b'public, max-age=31536000, immutable'])
+
+    def test_identity(self):
+        """
+        Ensure clients not accepting compression get the original file.
+        """
+        compress_static(self.directory)
+        request, body = self.render('index.html')
+
+        self.assertEqual(body, b'<html></html>' * 10)
+        self.assertIsNone(request.responseHeaders.getRawHeaders(
+            b'content-encoding'))
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'cache-control'), [b'no-cache'])
+
+    def render_memory(self, resource, path, headers=()):
+        """ Render a path of a MemoryStaticResource. """
+        request = DummyRequest([])
+        request.prepath = path.encode().split(b'/')
+        for name, value in headers:
+            request.requestHeaders.setRawHeaders(name, [value])
+        body = resource.render(request)
+        return request, body
+
+    def test_memory_static(self):
+        """
+        Ensure the in-memory resource serves variants and falls back to
+        the index for unknown paths.
+        """
+        compress_static(self.directory)
+        resource = MemoryStaticResource(self.directory)
+
+        request, body = self.render_memory(
+            resource, 'main.b2a9b0443009afec47a7.js',
+            [(b'accept-encoding', b'gzip')])
+        self.assertEqual(gzip.decompress(body), self.bundle)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'cache-control'), [b'public, max-age=31536000, immutable'])
+
+        request, body = self.render_memory(resource, 'settings/users/1')
+        self.assertEqual(body, b'<html></html>' * 10)
+
+    def test_memory_static_range(self):
+        """
+        Ensure byte ranges are answered with partial content.
+        """
+        resource = MemoryStaticResource(self.directory)
+
+        request, body = self.render_memory(resource, 'logo.png',
+                                           [(b'range', b'bytes=1-')])
+        self.assertEqual(request.responseCode, 206)
+        self.assertEqual(body, b'ng')
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            b'content-range'), [b'bytes 1-2/3'])
+
+        request, body = self.render_memory(resource, 'logo.png',
+                                           [(b'range', b'bytes=5-')])
+        self.assertEqual(request.responseCode, 416)
+
+    def test_memory_static_reload(self):
+        """
+        Ensure changed files are reloaded.
+        """
+        resource = MemoryStaticResource(self.directory)
+        path = os.path.join(self.directory, 'logo.png')
+        with open(path, 'wb') as f:
+            f.write(b'new png')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+        resource.load()
+
+        self.assertEqual(resource.reloads, 1)
+        self.assertEqual(self.render_memory(resource, 'logo.png')[1],
+                         b'new png')
+
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(b'old png'))
+        os.utime(path + '.gz', (time.time() - 10, time.time() - 10))
+        resource.load()
+        for _ in range(3):
+            resource.load()
+
+        self.assertEqual(resource.reloads, 2)
+
+
+class ManualThreadReactor:
+    """ Reactor running thread pool calls when the test says so. """
+
+    def __init__(self):
+        self.calls = []
+
+    def getThreadPool(self):
+        return self
+
+    def callInThreadWithCallback(self, onResult, function, *args, **kwargs):
+        self.calls.append((onResult, function, args, kwargs))
+
+    def callFromThread(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+    def run_calls(self):
+        calls, self.calls = self.calls, []
+        for onResult, function, args, kwargs in calls:
+            try:
+                onResult(True, function(*args, **kwargs))
+            except Exception as ex:
+                onResult(False, ex)
+
+
+class WorkerDrainTest(SimpleTestCase):
+    """ Worker shutdown tests. """
+
+    class PendingResource(web_resource.Resource):
+        """ Resource leaving its requests to the test. """
+        isLeaf = True
+
+        def __init__(self):
+            super().__init__()
+            self.requests = []
+
+        def render(self, request):
+            self.requests.append(request)
+            return web_server.NOT_DONE_YET
+
+    def setUp(self):
+        """ Set up a worker site on a memory reactor. """
+        self.reactor = MemoryReactorClock()
+        self.resource = self.PendingResource()
+        self.site = DrainableSite(self.resource, reactor=self.reactor)
+        self.port = mock.Mock()
+        self.port.stopListening.return_value = defer.succeed(None)
+        drain_on_shutdown(self.reactor, self.port, self.site, 30)
+
+    def connect(self):
+        """ Open a connection to the site and send a request. """
+        protocol = self.site.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n')
+        return protocol, transport
+
+    def shutdown(self):
+        """ Run the shutdown trigger, return its results. """
+        (trigger, args, kwargs), = self.reactor.triggers['before']['shutdown']
+        results = []
+        trigger(*args, **kwargs).addBoth(results.append)
+        return results
+
+    def test_request_in_progress(self):
+        """
+        Ensure a stopping worker stops listening and writes the response
+        of its request in progress before the reactor stops.
+        """
+        protocol, transport = self.connect()
+        idle, idle_transport = self.connect()
+        self.resource.requests[1].finish()
+        results = self.shutdown()
+
+        self.port.stopListening.assert_called_once_with()
+        self.assertFalse(transport.disconnecting)
+        request = self.resource.requests[0]
+        request.write(b'ok')
+        request.finish()
+
+        self.assertTrue(transport.value().endswith(b'ok\r\n0\r\n\r\n'))
+        self.assertTrue(transport.disconnecting)
+        self.assertTrue(idle_transport.disconnecting)
+        idle.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(results, [])
+        protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(results, [[None, None]])
+
+    def test_timeout(self):
+        """
+        Ensure a request that does not finish only delays the shutdown
+        by the timeout.
+        """
+        self.connect()
+        results = self.shutdown()
+
+        self.reactor.advance(29)
+        self.assertEqual(results, [])
+        self.reactor.advance(1)
+        self.assertEqual(results, [[None, None]])
+
+
+class LazyStartupTest(SimpleTestCase):
+    """ Lazy startup tests. """
+
+    def setUp(self):
+        """ Set up a loader building a single api resource. """
+        self.reactor = ManualThreadReactor()
+        self.root = web_resource.Resource()
+        self.failing = False
+        self.loader = LazyLoader(self.reactor, self.root, self.load,
+                                 lambda: {b'api': static.Data(b'ok',
+                                                              'text/plain')})
+        self.root.putChild(b'api', LazyResource(self.loader, b'api'))
+
+    def load(self):
+        if self.failing:
+            raise RuntimeError('no django')
+
+    def test_request_waits_for_load(self):
+        """
+        Ensure a request arriving before the API is loaded is answered
+        once it is, and that the loaded resource replaces the placeholder.
+        """
+        request = DummyRequest([])
+        self.root.children[b'api'].render(request)
+        self.assertFalse(request.finished)
+
+        self.reactor.run_calls()
+
+        self.assertEqual(request.written, [b'ok'])
+        self.assertTrue(request.finished)
+        self.assertIsInstance(self.root.children[b'api'], static.Data)
+        self.assertTrue(self.loader.stats()['loaded'])
+
+    def test_failed_load(self):
+        """
+        Ensure a failed load answers 503 and is retried.
+        """
+        self.failing = True
+        request = DummyRequest([b'users'])
+        self.root.children[b'api'].render(request)
+        with mock.patch('privadome_frontend.startup.log') as log:
+            self.reactor.run_calls()
+        log.err.assert_called_once()
+
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(self.loader.failures, 1)
+
+        self.failing = False
+        self.root.children[b'api'].render(DummyRequest([]))
+        self.reactor.run_calls()
+        self.assertTrue(self.loader.stats()['loaded'])
+
+    def test_import_digest(self):
+        """
+        Ensure -X importtime reports are digested per package.
+        """
+        report = """import time: self [us] | cumulative | imported package
+import time:       100 |        100 |     django.utils
+import time:       300 |        400 |   django
+import time:        50 |        450 | privadome_frontend.api
+"""
+        digest = import_digest(parse_importtime(report))
+
+        self.assertEqual(digest['modules'], 3)
+        self.assertEqual(digest['total_ms'], 0.5)
+        self.assertEqual(digest['packages'][0], ('django', 0.4))
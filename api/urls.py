@@ -1,12 +1,25 @@
 """ API endpoints URL. """
+import functools
+
 from django.conf.urls import url, include
+from django.views.decorators.csrf import csrf_exempt
 
 from rest_framework.routers import DefaultRouter
-from rest_framework.schemas import get_schema_view
 
 from . import views
 
-SCHEMA_VIEW = get_schema_view(title='API')
+
+@functools.lru_cache(maxsize=None)
+def get_schema_view():
+    """ The schema view, built on the first schema request. """
+    from rest_framework.schemas import get_schema_view
+    return get_schema_view(title='API')
+
+
+@csrf_exempt
+def SCHEMA_VIEW(request, *args, **kwargs):
+    return get_schema_view()(request, *args, **kwargs)
+
 
 ROUTER = DefaultRouter()
 ROUTER.register(r'users', views.UserViewSet)
@@ -21,43 +34,67 @@ urlpatterns += [
 ]
 
 urlpatterns += [
-    url(r'tiles/data/', views.tiles_data)
+    url(r'logout/', views.Logout.as_view(), name='logout')
+]
+
+urlpatterns += [
+    url(r'^tiles/data/$', views.tiles_data, name='tiles_data')
+]
+
+urlpatterns += [
+    url(r'^tiles/batch/$', views.tiles_batch, name='tiles_batch')
+]
+
+urlpatterns += [
+    url(r'^modules/config/$', views.module_config, name='module_config')
+]
+
+urlpatterns += [
+    url(r'^modules/info/$', views.module_schema, name='module_schema')
+]
+
+urlpatterns += [
+    url(r'^modules/addpolicy/group/$', views.add_policy_group, name='add_policy_group')
+]
+
+urlpatterns += [
+    url(r'^modules/addpolicy/address/$', views.add_policy_address, name='add_policy_address')
 ]
 
 urlpatterns += [
-    url(r'modules/config/', views.module_config, name='module_config')
+    url(r'^modules/deletepolicy/group/$', views.delete_policy_group, name='delete_policy_group')
 ]
 
 urlpatterns += [
-    url(r'modules/info/', views.module_schema, name='module_schema')
+    url(r'^modules/deletepolicy/address/$', views.delete_policy_address, name='delete_policy_address')
 ]
 
 urlpatterns += [
-    url(r'modules/addpolicy/group/', views.add_policy_group, name='add_policy_group')
+    url(r'^modules/updatepolicy/network/$', views.update_policy_network, name='update_policy_network')
 ]
 
 urlpatterns += [
-    url(r'modules/addpolicy/address/', views.add_policy_address, name='add_policy_address')
+    url(r'^modules/updatepolicy/group/$', views.update_policy_group, name='update_policy_group')
 ]
 
 urlpatterns += [
-    url(r'modules/deletepolicy/group/', views.delete_policy_group, name='delete_policy_group')
+    url(r'^modules/updatepolicy/address/$', views.update_policy_address, name='update_policy_address')
 ]
 
 urlpatterns += [
-    url(r'modules/deletepolicy/address/', views.delete_policy_address, name='delete_policy_address')
+    url(r'^modules/bulk/$', views.policy_bulk, name='policy_bulk')
 ]
 
 urlpatterns += [
-    url(r'modules/updatepolicy/network/', views.update_policy_network, name='update_policy_network')
+    url(r'stats/', views.runtime_stats, name='runtime_stats')
 ]
 
 urlpatterns += [
-    url(r'modules/updatepolicy/group/', views.update_policy_group, name='update_policy_group')
+    url(r'^metrics/?$', views.runtime_metrics, name='runtime_metrics')
 ]
 
 urlpatterns += [
-    url(r'modules/updatepolicy/address/', views.update_policy_address, name='update_policy_address')
+    url(r'^profile/$', views.runtime_profile, name='runtime_profile')
 ]
 
 urlpatterns += [
@@ -2,32 +2,75 @@
 import pdb
 
 import datetime
+import math
+import time
 
-import procbridge
-import json
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from procbridge.errors import ServerError
 
 from rest_framework import permissions, viewsets, mixins, status
 from rest_framework.response import Response
-from rest_framework.parsers import JSONParser
 from rest_framework.reverse import reverse
 from rest_framework.decorators import api_view, parser_classes, permission_classes
-from rest_framework.exceptions import PermissionDenied, server_error
+from rest_framework.exceptions import PermissionDenied, ValidationError,\
+                                      server_error
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework.views import APIView
 from rest_framework.authtoken.models import Token
 
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.http import HttpResponse
+
+from privadome_frontend import profiler
 
 from .serializers import UserListSerializer,\
                          UserCreateSerializer,\
-                         UserUpdateSerializer
+                         UserUpdateSerializer,\
+                         USER_LIST_COLUMNS, user_list_data, user_list_row
 
 from .permissions import IsAdminOrSelf
+from .pagination import UserCursorPagination, prefix_filter
+from .authentication import issue_signed_token, revoke_signed_token,\
+                            signed_tokens_enabled
+from .jsoncodec import JSONParser, raw
+from .pool import DeadlineExceeded, get_pool
+from .delta import VERSIONS, versioned_response
+from .circuit import CircuitOpen, get_breaker, request_deadline
+from . import bulk
+from .cache import SingleFlight, StaleWhileRevalidateCache, TTLCache
+from . import metrics, stats
 
 PROC_HOST = settings.PRIVADOME_CORE_HOST
 PROC_PORT_POLICY = 8077
 PROC_PORT_DATA = 8090
 
+STATE_CACHE = TTLCache(
+    'read_state',
+    getattr(settings, 'PRIVADOME_STATE_CACHE_TTL', 5),
+    getattr(settings, 'PRIVADOME_CORE_CACHE_SINGLE_FLIGHT', True))
+SCHEMA_CACHE = TTLCache(
+    'get_module_configs',
+    getattr(settings, 'PRIVADOME_SCHEMA_CACHE_TTL', 300),
+    getattr(settings, 'PRIVADOME_CORE_CACHE_SINGLE_FLIGHT', True))
+
+BULK_MAX = getattr(settings, 'PRIVADOME_BULK_MAX', 500)
+TILE_BATCH_MAX = getattr(settings, 'PRIVADOME_TILE_BATCH_MAX', 50)
+TILE_FLIGHT = SingleFlight()
+TILE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PRIVADOME_TILE_BATCH_WORKERS', 4),
+    thread_name_prefix='tiles')
+TILE_CACHE = StaleWhileRevalidateCache(
+    'tiles', TILE_EXECUTOR,
+    max_entries=getattr(settings, 'PRIVADOME_TILE_CACHE_SIZE', 256),
+    max_bytes=getattr(settings, 'PRIVADOME_TILE_CACHE_BYTES',
+                      64 * 1024 * 1024),
+    freshness=getattr(settings, 'PRIVADOME_TILE_FRESHNESS', {}),
+    default_freshness=getattr(settings, 'PRIVADOME_TILE_DEFAULT_FRESHNESS', 1),
+    stale_window=getattr(settings, 'PRIVADOME_TILE_STALE_WINDOW', 10))
+
 
 # Create your views here.
 @api_view(['GET'])
@@ -37,6 +80,61 @@ def api_root(request, format=None):
         'users': reverse('user-list', request=request, format=format),
     })
 
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def runtime_stats(request):
+    """ Runtime statistics of the core connection pools. """
+    return Response(stats.snapshot())
+
+@api_view(['GET', 'POST', 'DELETE'])
+@permission_classes((IsAdminUser,))
+def runtime_profile(request):
+    """
+    Start (POST), end (DELETE) or check (GET) a sampling profile of the
+    server process. GET ?download returns the collapsed stacks of the
+    last profile. With --workers, only the worker serving the request
+    is profiled; see profiler.py.
+    """
+    if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            raise ValidationError('The body must be a JSON object.')
+        seconds = request.data.get('seconds', 30)
+        limit = getattr(settings, 'PRIVADOME_PROFILE_MAX_SECONDS', 300)
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float))\
+                or not 0 < seconds <= limit:
+            raise ValidationError({'seconds': 'A number of seconds up to {}'
+                                              ' is required.'.format(limit)})
+        try:
+            profile = profiler.start_profile(
+                seconds, getattr(settings, 'PRIVADOME_PROFILE_INTERVAL', 0.01),
+                bool(request.data.get('idle', False)),
+                getattr(settings, 'PRIVADOME_PROFILE_DIR', None))
+        except profiler.ProfileRunning as e:
+            return Response({'detail': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(profile.stats(), status=status.HTTP_202_ACCEPTED)
+
+    if request.method == 'DELETE':
+        profile = profiler.stop_profile()
+    else:
+        profile = profiler.current_profile()
+    if profile is None:
+        return Response({'detail': 'No profile was taken.'},
+                        status=status.HTTP_404_NOT_FOUND)
+    if 'download' in request.query_params:
+        if profile.running or profile.error:
+            return Response({'detail': 'The profile is not available.'},
+                            status=status.HTTP_409_CONFLICT)
+        return HttpResponse(profile.collapsed(),
+                            content_type='text/plain; charset=utf-8')
+    return Response(profile.stats())
+
+@api_view(['GET'])
+@permission_classes((AllowAny,) if getattr(settings, 'PRIVADOME_METRICS_PUBLIC',
+                                           False) else (IsAdminUser,))
+def runtime_metrics(request):
+    """ Request timings and runtime statistics for Prometheus. """
+    return metrics.metrics_response()
+
 @api_view(['GET'])
 def api_procbridge_test(request, format=None):
     """ Procbridge test. """
@@ -52,6 +150,8 @@ class ObtainExpiringAuthToken(ObtainAuthToken):
                                            context={'request': request})
         if serializer.is_valid(raise_exception=True):
             user = serializer.validated_data['user']
+            if signed_tokens_enabled():
+                return Response({'token': issue_signed_token(user)})
             token, created = Token.objects.get_or_create(user=user)
 
             utc_now = datetime.datetime.utcnow()
@@ -65,6 +165,20 @@ class ObtainExpiringAuthToken(ObtainAuthToken):
             return Response({'token': token.key})
 
 
+class Logout(APIView):
+    """
+    Revoke the token of the request.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        if isinstance(request.auth, Token):
+            request.auth.delete()
+        elif isinstance(request.auth, dict):
+            revoke_signed_token(request.auth)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class UserViewSet(mixins.CreateModelMixin,
                   mixins.ListModelMixin,
                   mixins.UpdateModelMixin,
@@ -79,15 +193,31 @@ class UserViewSet(mixins.CreateModelMixin,
     queryset = User.objects.all()
     permission_classes = (permissions.IsAuthenticated, IsAdminOrSelf)
     serializer_class = UserListSerializer
+    pagination_class = UserCursorPagination
 
     def list(self, request, *args, **kwargs):
-        if request.user and request.user.is_superuser:
-            queryset = User.objects.all()
-        else:
-            queryset = User.objects.filter(username=request.user.username)
-
-        serializer = UserListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        """
+        List the users, all of them unless a page is asked for with
+        ?limit or ?cursor. ?search filters on a username or email prefix.
+        """
+        rows = self.list_queryset(request)
+        if not self.paginator.requested(request):
+            return Response([user_list_row(row) for row in rows])
+
+        page = self.paginate_queryset(rows)
+        return self.get_paginated_response([user_list_row(row) for row in page])
+
+    @staticmethod
+    def list_queryset(request):
+        """ values() rows of the users listed to the user of request. """
+        queryset = User.objects.order_by('id')
+        if not (request.user and request.user.is_superuser):
+            queryset = queryset.filter(pk=request.user.pk)
+        search = request.query_params.get('search')
+        if search:
+            queryset = queryset.filter(prefix_filter('username', search)
+                                       | prefix_filter('email', search))
+        return queryset.values(*USER_LIST_COLUMNS)
 
     def create(self, request, *args, **kwargs):
         if not (request.user and request.user.is_superuser):
@@ -99,9 +229,7 @@ class UserViewSet(mixins.CreateModelMixin,
 
         instance = create_serializer.save()
 
-        read_serializer = UserListSerializer(instance)
-
-        return Response(read_serializer.data, status=status.HTTP_201_CREATED)
+        return Response(user_list_data(instance), status=status.HTTP_201_CREATED)
 
     #def update(self, request, pk=None, *args, **kwargs):
     def update(self, request, *args, **kwargs):
@@ -118,9 +246,7 @@ class UserViewSet(mixins.CreateModelMixin,
             # forcibly invalidate the prefetch cache on the instance.
             new_instance._prefetched_objects_cache = {}
 
-        read_serializer = UserListSerializer(new_instance)
-
-        return Response(read_serializer.data)
+        return Response(user_list_data(new_instance))
 
 @api_view(['POST'])
 @parser_classes((JSONParser,))
@@ -129,27 +255,87 @@ def tiles_data(request):
     """
     Get data for a specific tile
     """
+    name = request.data.get('name') if isinstance(request.data, dict) else None
+    if not isinstance(name, str) or not name:
+        raise ValidationError({'name': 'A tile name is required.'})
+    deadline = request_deadline(request)
     try:
-        if 'name' in request.data:
-            response = generic_procbridge_request(request.data['name'], None, PROC_PORT_DATA)
+        if deadline is None:
+            response, cache_state = fetch_tile(name)
         else:
-            raise ProcessLookupError("Invalid request")
+            # Like tiles_batch, the tile still reaches the cache when the
+            # client stops waiting for it.
+            future = TILE_EXECUTOR.submit(fetch_tile, name)
+            with metrics.phase('core'):
+                try:
+                    response, cache_state = future.result(
+                        max(0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    raise DeadlineExceeded('{} timed out'.format(name))
     except Exception as e:
         print(e)
-        return server_error(request)
+        return last_known_good(request, 'tile:' + name, e,
+                               request.data.get('since'))
+    response = versioned_response(request, 'tile:' + name, response,
+                                  request.data.get('since'))
+    response['X-Cache'] = cache_state.upper()
     return response
 
+@api_view(['POST'])
+@parser_classes((JSONParser,))
+@permission_classes((permissions.IsAuthenticated,))
+def tiles_batch(request):
+    """
+    Get data for a list of tiles in one request
+    """
+    names = request.data.get('names') if isinstance(request.data, dict) else None
+    if not isinstance(names, list) or not names\
+            or not all(isinstance(name, str) for name in names):
+        raise ValidationError({'names': 'A non-empty list of tile names'
+                                        ' is required.'})
+    if len(names) > TILE_BATCH_MAX:
+        raise ValidationError({'names': 'At most {} tiles can be requested'
+                                        ' at once.'.format(TILE_BATCH_MAX)})
+
+    deadline = request_deadline(request)
+    futures = {name: TILE_EXECUTOR.submit(fetch_tile, name)
+               for name in dict.fromkeys(names)}
+    tiles = {}
+    errors = {}
+    cache = {}
+    for name, future in futures.items():
+        try:
+            # The core calls run on the executor, outside this request.
+            with metrics.phase('core'):
+                tiles[name], cache[name] = future.result(
+                    None if deadline is None
+                    else max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            errors[name] = 'Timeout'
+        except CircuitOpen:
+            errors[name] = 'Core unavailable'
+        except Exception as e:
+            print(e)
+            errors[name] = 'Server Error'
+    return Response({'tiles': tiles, 'errors': errors, 'cache': cache},
+                    status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes((permissions.IsAuthenticated,))
 def module_config(request):
     """
     Get the current module configurations
     """
+    deadline = request_deadline(request)
     try:
-        response = generic_procbridge_request('read_state')
-    except:
-        return server_error(request)
-    return response
+        response = STATE_CACHE.get_or_load(
+            'read_state',
+            lambda: procbridge_call('read_state', deadline=deadline))
+    except Exception as e:
+        return last_known_good(request, 'read_state', e,
+                               request.query_params.get('since'))
+    return versioned_response(request, 'read_state', response,
+                              request.query_params.get('since'))
 
 @api_view(['GET'])
 @permission_classes((permissions.IsAuthenticated,))
@@ -157,11 +343,16 @@ def module_schema(request):
     """
     Get the schema information of modules
     """
+    deadline = request_deadline(request)
     try:
-        response = generic_procbridge_request('get_module_configs')
-    except:
-        return server_error(request)
-    return response
+        response = SCHEMA_CACHE.get_or_load(
+            'get_module_configs',
+            lambda: procbridge_call('get_module_configs', deadline=deadline))
+    except Exception as e:
+        return last_known_good(request, 'get_module_configs', e,
+                               request.query_params.get('since'))
+    return versioned_response(request, 'get_module_configs', response,
+                              request.query_params.get('since'))
 
 @api_view(['POST'])
 @parser_classes((JSONParser,))
@@ -171,7 +362,8 @@ def add_policy_group(request):
     Add a group policy level
     """
     try:
-        response = generic_procbridge_request('add_group', request.body)
+        response = policy_procbridge_request('add_group', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
@@ -184,7 +376,8 @@ def add_policy_address(request):
     Add an address policy level
     """
     try:
-        response = generic_procbridge_request('add_client', request.body)
+        response = policy_procbridge_request('add_client', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
@@ -197,7 +390,8 @@ def delete_policy_group(request):
     Delete a group policy level
     """
     try:
-        response = generic_procbridge_request('delete_group', request.body)
+        response = policy_procbridge_request('delete_group', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
@@ -210,7 +404,8 @@ def delete_policy_address(request):
     Delete an address policy level
     """
     try:
-        response = generic_procbridge_request('delete_client', request.body)
+        response = policy_procbridge_request('delete_client', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
@@ -223,7 +418,8 @@ def update_policy_network(request):
     Update the network policy level
     """
     try:
-        response = generic_procbridge_request('update_network_policy', request.body)
+        response = policy_procbridge_request('update_network_policy', request.body,
+                                              request_deadline(request))
     except Exception as e:
         print(e)
         return server_error(request)
@@ -237,7 +433,8 @@ def update_policy_group(request):
     Update a group policy level
     """
     try:
-        response = generic_procbridge_request('update_group_policy', request.body)
+        response = policy_procbridge_request('update_group_policy', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
@@ -250,21 +447,137 @@ def update_policy_address(request):
     Update an address policy level
     """
     try:
-        response = generic_procbridge_request('update_client_policy', request.body)
+        response = policy_procbridge_request('update_client_policy', request.body,
+                                              request_deadline(request))
     except:
         return server_error(request)
     return response
 
-def generic_procbridge_request(api_identifier, body=None, port=PROC_PORT_POLICY):
+@api_view(['POST'])
+@parser_classes((JSONParser,))
+@permission_classes((permissions.IsAuthenticated,))
+def policy_bulk(request):
+    """
+    Apply a list of policy changes in order, optionally all or nothing
+    """
+    operations, atomic = bulk.validate(request.data, BULK_MAX)
+    try:
+        with metrics.phase('core'):
+            code, data = bulk.apply(get_pool(PROC_HOST, PROC_PORT_POLICY),
+                                    get_breaker(PROC_PORT_POLICY),
+                                    operations, atomic,
+                                    request_deadline(request))
+    except Exception as e:
+        return core_error_response(request, e)
+    finally:
+        STATE_CACHE.invalidate()
+    return Response(data, status=code)
+
+def procbridge_call(api_identifier, body=None, port=PROC_PORT_POLICY,
+                    deadline=None):
     """
-    Generic request function to the procbridge server
+    Send a request to the procbridge server over a pooled connection
+    and return the payload of the reply.
+    Raise CircuitOpen without calling the core while its circuit is open
+    and DeadlineExceeded when it does not answer before deadline.
     """
     try:
-        client = procbridge.Client(PROC_HOST, port)
-        if body is None:
-            response = client.request(api_identifier)
+        payload = None if body is None else raw(body)
+    except ValueError:
+        raise LookupError('Error')
+    breaker = get_breaker(port)
+    breaker.before()
+    try:
+        with metrics.phase('core'):
+            result = get_pool(PROC_HOST, port).request(api_identifier,
+                                                       payload, deadline)
+    except ServerError:
+        # The core answered, it is up.
+        breaker.success()
+        raise LookupError('Error')
+    except DeadlineExceeded:
+        # Only the core timeout counts, not a shorter one of the client.
+        if deadline is None:
+            breaker.failure()
         else:
-            response = client.request(api_identifier, json.loads(body))
+            breaker.release()
+        raise
     except:
+        breaker.failure()
         raise LookupError('Error')
+    breaker.success()
+    return result
+
+def fetch_tile(name):
+    """
+    Get the data of a tile through the shared tile cache.
+    Return the data and whether it was a cache hit, stale hit or miss.
+    """
+    return TILE_CACHE.get(name, lambda: load_tile(name))
+
+def load_tile(name):
+    """
+    Get the data of a tile from the procbridge data server.
+    Identical requests in flight share a single core call.
+    """
+    return TILE_FLIGHT.do(name,
+                          lambda: procbridge_call(name, None, PROC_PORT_DATA))
+
+def policy_procbridge_request(api_identifier, body, deadline=None):
+    """
+    Request a policy change from the procbridge server and drop the
+    cached module state it invalidates
+    """
+    try:
+        return generic_procbridge_request(api_identifier, body,
+                                          deadline=deadline)
+    finally:
+        STATE_CACHE.invalidate()
+
+def generic_procbridge_request(api_identifier, body=None, port=PROC_PORT_POLICY,
+                               deadline=None):
+    """
+    Generic request function to the procbridge server
+    """
+    try:
+        response = procbridge_call(api_identifier, body, port, deadline)
+    except (CircuitOpen, DeadlineExceeded) as ex:
+        return core_error_response(None, ex)
     return Response(response, status=status.HTTP_200_OK)
+
+def core_error(ex):
+    """
+    Status, body and headers answering a core call that failed with an
+    open circuit (503) or a timeout (504), None for other errors.
+    """
+    if isinstance(ex, CircuitOpen):
+        return (status.HTTP_503_SERVICE_UNAVAILABLE,
+                {'detail': 'Core unavailable, try again later.'},
+                {'Retry-After': str(max(1, math.ceil(ex.retry_after)))})
+    if isinstance(ex, DeadlineExceeded):
+        return (status.HTTP_504_GATEWAY_TIMEOUT,
+                {'detail': 'Core request timed out.'}, {})
+    return None
+
+def core_error_response(request, ex):
+    """
+    Response to a failed core call: 503 while the circuit is open,
+    504 when the core did not answer in time, 500 otherwise.
+    """
+    error = core_error(ex)
+    if error is None:
+        return server_error(request)
+    code, data, headers = error
+    return Response(data, status=code, headers=headers)
+
+def last_known_good(request, key, ex, since=None):
+    """
+    Answer a read endpoint whose core call failed with the last payload
+    served for key, or with the error when there is none.
+    """
+    payload = VERSIONS.latest(key)
+    if payload is None:
+        return core_error_response(request, ex)
+    response = versioned_response(request, key, payload, since)
+    response['Warning'] = '110 - "Response is Stale"'
+    return response
@@ -27,6 +27,93 @@ DEBUG = True
 
 PRIVADOME_CORE_HOST = "127.0.0.1"
 
+# Connection pool towards the PrivaDome core, one pool per port.
+PRIVADOME_CORE_POOL_SIZE = 8
+PRIVADOME_CORE_POOL_IDLE_TIMEOUT = 30
+PRIVADOME_CORE_POOL_WAIT_TIMEOUT = 5
+PRIVADOME_CORE_CONNECT_TIMEOUT = 5
+PRIVADOME_CORE_TIMEOUT = 30
+
+# Consecutive connection failures or timeouts that open the circuit of a
+# core port, and seconds before a trial call is let through again.
+PRIVADOME_CIRCUIT_FAILURES = 5
+PRIVADOME_CIRCUIT_RESET_TIMEOUT = 10
+
+# Seconds the module state (read_state) and schema (get_module_configs)
+# are cached. Policy changes made through the API invalidate the state;
+# with --workers, in the worker that made them only, the others see the
+# change once their state expires.
+PRIVADOME_STATE_CACHE_TTL = 5
+PRIVADOME_SCHEMA_CACHE_TTL = 300
+PRIVADOME_CORE_CACHE_SINGLE_FLIGHT = True
+
+# Send the phase timings of API requests in a Server-Timing header, and
+# serve the Prometheus metrics at api/metrics without authentication.
+PRIVADOME_SERVER_TIMING = True
+PRIVADOME_METRICS_PUBLIC = False
+
+# Sampling profiler, started from api/profile/ or with SIGUSR2: seconds
+# between samples, longest profile, seconds profiled on the signal and
+# directory of the collapsed stack files (the temporary directory if None).
+# With --workers, the endpoint profiles a single worker; send SIGUSR2 to
+# the supervisor to profile them all.
+PRIVADOME_PROFILE_INTERVAL = 0.01
+PRIVADOME_PROFILE_MAX_SECONDS = 300
+PRIVADOME_PROFILE_SIGNAL_SECONDS = 30
+PRIVADOME_PROFILE_DIR = None
+
+# Maximum operations of a bulk policy request.
+PRIVADOME_BULK_MAX = 500
+
+# Batched tile requests: maximum tiles per request and the number of
+# tiles fetched from the core concurrently.
+PRIVADOME_TILE_BATCH_MAX = 50
+PRIVADOME_TILE_BATCH_WORKERS = 4
+
+# Shared tile data cache. Tiles are fresh for PRIVADOME_TILE_FRESHNESS
+# seconds (per tile name, PRIVADOME_TILE_DEFAULT_FRESHNESS otherwise),
+# then served stale for up to PRIVADOME_TILE_STALE_WINDOW seconds while
+# being refreshed in the background. A freshness of 0 disables caching.
+# The cache holds up to PRIVADOME_TILE_CACHE_SIZE tiles and
+# PRIVADOME_TILE_CACHE_BYTES bytes of tile JSON, whichever is reached
+# first; a larger tile on its own is not cached.
+PRIVADOME_TILE_CACHE_SIZE = 256
+PRIVADOME_TILE_CACHE_BYTES = 64 * 1024 * 1024
+PRIVADOME_TILE_DEFAULT_FRESHNESS = 1
+PRIVADOME_TILE_FRESHNESS = {}
+PRIVADOME_TILE_STALE_WINDOW = 10
+
+# WSGI thread pool. Requests are answered with 503 once
+# PRIVADOME_WSGI_MAX_QUEUE requests are waiting for a thread.
+PRIVADOME_WSGI_MIN_THREADS = 5
+PRIVADOME_WSGI_MAX_THREADS = 20
+PRIVADOME_WSGI_MAX_QUEUE = 100
+
+# Separate WSGI thread pool for the core proxy endpoints (modules, tiles)
+# so they cannot starve the user and auth endpoints. 0 shares the pool.
+PRIVADOME_CORE_WSGI_MIN_THREADS = 2
+PRIVADOME_CORE_WSGI_MAX_THREADS = 10
+PRIVADOME_CORE_WSGI_MAX_QUEUE = 100
+
+# Answer the module and tile endpoints on the Twisted reactor instead of
+# the WSGI thread pool. Token lookups of the resources served on the
+# reactor run on a separate auth pool. The read endpoints keep the state,
+# schema and tile caches and the ETags of the Django views.
+PRIVADOME_REACTOR_PROXY = False
+PRIVADOME_AUTH_THREADS = 4
+
+# Answer the policy endpoints with minimal handlers bypassing the DRF
+# request cycle (api/fastpath.py) when they are served by Django.
+PRIVADOME_FAST_PROXY = False
+
+# Seconds between core polls of each tile subscribed on /stream.
+PRIVADOME_TILE_STREAM_INTERVAL = 2
+
+# Serve the static bundle from memory, checking for changed files every
+# PRIVADOME_STATIC_WATCH_INTERVAL seconds (0 disables the check).
+PRIVADOME_STATIC_IN_MEMORY = True
+PRIVADOME_STATIC_WATCH_INTERVAL = 2
+
 ALLOWED_HOSTS = ['*']
 
 
@@ -46,6 +133,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, it times the whole request.
+    'privadome_frontend.api.metrics.TimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -53,6 +142,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Last, it answers the core proxy endpoints without URL resolving.
+    'privadome_frontend.api.dispatch.DispatchMiddleware',
 ]
 
 CORS_ORIGIN_WHITELIST = (
@@ -89,10 +180,13 @@ WSGI_APPLICATION = 'privadome_frontend.backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
+# The tuned SQLite backend (WAL, busy timeout), connections are kept open
+# per WSGI thread for CONN_MAX_AGE seconds.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'privadome_frontend.backend.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'privadome_frontend.sqlite3'),
+        'CONN_MAX_AGE': 600,
     }
 }
 
@@ -133,9 +227,36 @@ USE_L10N = True
 
 USE_TZ = False
 
+# Validated tokens are cached in-process for PRIVADOME_TOKEN_CACHE_TTL
+# seconds. Token deletion and user changes invalidate them, in the
+# process that made the change only, so the cache is disabled when
+# serving with --workers: every request then looks its token up.
+PRIVADOME_TOKEN_CACHE_TTL = 60
+PRIVADOME_TOKEN_CACHE_SIZE = 1024
+
+# Token backend: 'db' for expiring tokens stored in the database, or
+# 'signed' for self-expiring HMAC signed tokens verified without the
+# database. Signed tokens are revoked through the default Django cache,
+# which must then be shared by every process and outlive restarts
+# (memcached, redis, a file or database cache): startup fails when it is
+# the per-process local memory cache, since a logged out token would
+# still be accepted by the other workers.
+PRIVADOME_AUTH_TOKENS = 'db'
+PRIVADOME_SIGNED_TOKEN_MAX_AGE = 24 * 60 * 60
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'privadome_frontend.api.authentication.ExpiringTokenAuthentication',
+        'privadome_frontend.api.authentication.ConfiguredTokenAuthentication',
+    ),
+    # JSON through api/jsoncodec.py, orjson or ujson when installed.
+    'DEFAULT_RENDERER_CLASSES': (
+        'privadome_frontend.api.jsoncodec.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'privadome_frontend.api.jsoncodec.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination'\
                                 '.PageNumberPagination',
@@ -0,0 +1,41 @@
+"""
+SQLite backend tuned for the threaded WSGI server.
+
+Connections are opened in WAL mode, so token lookups keep reading while
+a user is written, with synchronous=NORMAL, a memory mapped database
+file and a busy timeout instead of immediate "database is locked"
+errors. Use it with CONN_MAX_AGE to keep one connection per thread.
+
+The pragmas can be changed with the 'PRAGMAS' key of the database
+OPTIONS.
+"""
+from django.db.backends.sqlite3 import base
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+
+def apply_pragmas(connection, pragmas):
+    """ Run PRAGMA statements on a DB-API sqlite3 connection. """
+    for name, value in pragmas.items():
+        connection.execute('PRAGMA {} = {}'.format(name, value))
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = {**PRAGMAS, **kwargs.pop('PRAGMAS', {})}
+        # The timeout of the Python module wraps the busy handler too.
+        kwargs.setdefault('timeout', self.pragmas['busy_timeout'] / 1000)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        apply_pragmas(connection, self.pragmas)
+        return connection
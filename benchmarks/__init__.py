@@ -0,0 +1,4 @@
+"""
+Benchmarks, each runnable with python -m privadome_frontend.benchmarks.<name>
+and printing its results as JSON.
+"""
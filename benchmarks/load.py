@@ -0,0 +1,360 @@
+"""
+Load and latency benchmark of the whole frontend.
+
+Boots the real server (python -m privadome_frontend) against the stub
+core of benchmarks.stub_core and a throwaway database. Each endpoint is
+then driven in turn by concurrent authenticated keep-alive clients for a
+fixed duration. Results per endpoint:
+- p50/p95/p99 latency.
+- Throughput.
+- Response statuses.
+- Peak thread pool use and saturation, sampled from the stats endpoint.
+
+The results are written as JSON. With --baseline, the change in latency
+and throughput against an earlier results file is added.
+
+    python -m privadome_frontend.benchmarks.load --clients 16 --duration 10 \\
+        --core-latency 5 --output results.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import privadome_frontend
+from privadome_frontend.benchmarks import stub_core
+
+# Endpoint -> (method, path, JSON body).
+ENDPOINTS = {
+    'module_config': ('GET', '/api/modules/config/', None),
+    'module_schema': ('GET', '/api/modules/info/', None),
+    'tiles_data': ('POST', '/api/tiles/data/', {'name': 'clients'}),
+    'tiles_batch': ('POST', '/api/tiles/batch/',
+                    {'names': ['clients', 'traffic', 'blocked', 'dns']}),
+    'add_policy_group': ('POST', '/api/modules/addpolicy/group/',
+                         {'groupname': 'benchmark', 'members': []}),
+    'update_policy_address': ('POST', '/api/modules/updatepolicy/address/',
+                              {'address': '10.0.0.1',
+                               'module_policies': {'adblock': {}}}),
+    'user_list': ('GET', '/api/users/', None),
+    'user_page': ('GET', '/api/users/?limit=20', None),
+}
+
+SETTINGS = """from privadome_frontend.backend.settings import *
+DATABASES['default']['NAME'] = {database!r}
+DEBUG = False
+PRIVADOME_STATIC_WATCH_INTERVAL = 0
+PRIVADOME_REACTOR_PROXY = {reactor_proxy!r}
+PRIVADOME_FAST_PROXY = {fast_proxy!r}
+"""
+
+
+def percentile(ordered, q):
+    """ Nearest-rank percentile q (0-100) of sorted values. """
+    if not ordered:
+        return None
+    index = math.ceil(q / 100 * len(ordered)) - 1
+    return ordered[max(0, min(len(ordered) - 1, index))]
+
+
+class Client(threading.Thread):
+    """ Keep-alive HTTP client sending one request after the other. """
+
+    def __init__(self, port, token, endpoint, until):
+        super().__init__(daemon=True)
+        self.port = port
+        self.method, self.path, body = endpoint
+        self.body = None if body is None else json.dumps(body).encode()
+        self.headers = {'Authorization': 'Token ' + token,
+                        'Content-Type': 'application/json'}
+        self.until = until
+        self.latencies = []
+        self.statuses = {}
+
+    def run(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                timeout=30)
+        while time.monotonic() < self.until:
+            started = time.perf_counter()
+            try:
+                connection.request(self.method, self.path, self.body,
+                                   self.headers)
+                response = connection.getresponse()
+                response.read()
+                code = str(response.status)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                code = 'error'
+            self.latencies.append(time.perf_counter() - started)
+            self.statuses[code] = self.statuses.get(code, 0) + 1
+        connection.close()
+
+
+class StatsSampler(threading.Thread):
+    """ Poll the stats endpoint, keeping the peak use of each pool. """
+
+    def __init__(self, port, token, interval):
+        super().__init__(daemon=True)
+        self.port = port
+        self.token = token
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.samples.append(get_stats(self.port, self.token))
+            except (OSError, ValueError, http.client.HTTPException):
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_stats(port, token):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', '/api/stats/',
+                           headers={'Authorization': 'Token ' + token})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def pool_report(before, after, samples):
+    """ Peak use and saturation of each WSGI thread pool during a run. """
+    report = {}
+    for name, end in (after.get('thread_pools') or {}).items():
+        used = [sample['thread_pools'][name] for sample in samples
+                if name in (sample.get('thread_pools') or {})]
+        start = (before.get('thread_pools') or {}).get(name, {})
+        report[name] = {
+            'max_threads': end.get('max_threads'),
+            'peak_active': max([pool.get('active', 0) for pool in used],
+                               default=0),
+            'peak_queued': max([pool.get('queued', 0) for pool in used],
+                               default=0),
+            # Share of the samples with every thread busy.
+            'saturation': round(sum(
+                pool.get('active', 0) >= end.get('max_threads', 0)
+                for pool in used) / len(used), 3) if used else None,
+            'rejected': end.get('rejected', 0) - start.get('rejected', 0),
+        }
+    return report
+
+
+def core_pool_report(before, after):
+    """ Core connection pool activity during a run. """
+    report = {}
+    for name, end in (after.get('core_pools') or {}).items():
+        start = (before.get('core_pools') or {}).get(name, {})
+        report[name] = {key: round(end[key] - start.get(key, 0), 6)
+                        for key in ('hits', 'misses', 'reconnects',
+                                    'timeouts', 'wait_time')
+                        if key in end}
+    return report
+
+
+def run_endpoint(port, token, endpoint, clients, duration, warmup,
+                 interval):
+    """ Drive one endpoint and return its results. """
+    warming = [Client(port, token, endpoint, time.monotonic() + warmup)
+               for _ in range(clients)]
+    for client in warming:
+        client.start()
+    for client in warming:
+        client.join()
+    before = get_stats(port, token)
+    sampler = StatsSampler(port, token, interval)
+    sampler.start()
+    started = time.monotonic()
+    workers = [Client(port, token, endpoint, started + duration)
+               for _ in range(clients)]
+    for client in workers:
+        client.start()
+    for client in workers:
+        client.join()
+    elapsed = time.monotonic() - started
+    sampler.stop()
+    after = get_stats(port, token)
+
+    latencies = sorted(latency for client in workers
+                       for latency in client.latencies)
+    statuses = {}
+    for client in workers:
+        for code, count in client.statuses.items():
+            statuses[code] = statuses.get(code, 0) + count
+    milliseconds = {
+        name: round(percentile(latencies, q) * 1000, 3)
+        for name, q in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+    } if latencies else {}
+    return {
+        'requests': len(latencies),
+        'statuses': statuses,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': milliseconds,
+        'thread_pools': pool_report(before, after, sampler.samples),
+        'core_pools': core_pool_report(before, after),
+    }
+
+
+def compare(results, baseline):
+    """ Relative change of each endpoint against a baseline run. """
+    changes = {}
+    for name, result in results['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(name)
+        if not old:
+            continue
+        change = {}
+        for key in ('p50', 'p95', 'p99'):
+            new_value = result['latency_ms'].get(key)
+            old_value = old.get('latency_ms', {}).get(key)
+            if new_value is not None and old_value:
+                change[key] = round(new_value / old_value - 1, 3)
+        if old.get('throughput_rps'):
+            change['throughput_rps'] = round(
+                result['throughput_rps'] / old['throughput_rps'] - 1, 3)
+        changes[name] = change
+    return changes
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, token, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            get_stats(port, token)
+            return
+        except (OSError, ValueError, http.client.HTTPException):
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start within {}s'.format(timeout))
+
+
+def prepare_database(directory, args):
+    """
+    Write the benchmark settings module, migrate its database and
+    return the environment of the server and an admin token.
+    """
+    with open(os.path.join(directory, 'benchmark_settings.py'), 'w') as f:
+        f.write(SETTINGS.format(
+            database=os.path.join(directory, 'benchmark.sqlite3'),
+            reactor_proxy=args.reactor_proxy, fast_proxy=args.fast_proxy))
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='benchmark_settings')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (
+        directory,
+        os.path.dirname(os.path.dirname(privadome_frontend.__file__)),
+        os.environ.get('PYTHONPATH'))))
+    script = (
+        'import django; django.setup()\n'
+        'from django.core.management import call_command\n'
+        'from django.contrib.auth.models import User\n'
+        'from rest_framework.authtoken.models import Token\n'
+        'call_command("migrate", verbosity=0)\n'
+        'user = User.objects.create_superuser("benchmark", "b@b.b", "b")\n'
+        'for index in range({users}):\n'
+        '    User.objects.create_user("user%d" % index, "u%d@b.b" % index)\n'
+        'print(Token.objects.create(user=user).key)\n'
+    ).format(users=args.users)
+    token = subprocess.run([sys.executable, '-c', script], env=env,
+                           check=True, stdout=subprocess.PIPE,
+                           universal_newlines=True).stdout.split()[-1]
+    return env, token
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS),
+                        default=sorted(ENDPOINTS))
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds each endpoint is driven')
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--core-latency', type=float, default=2.0,
+                        help='milliseconds the stub core takes per call')
+    parser.add_argument('--payload-size', type=int, default=4096,
+                        help='approximate bytes of every core reply')
+    parser.add_argument('--users', type=int, default=50,
+                        help='users in the database')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--reactor-proxy', action='store_true')
+    parser.add_argument('--fast-proxy', action='store_true')
+    parser.add_argument('--sample-interval', type=float, default=0.25,
+                        help='seconds between stats samples')
+    parser.add_argument('--output', help='file the JSON results are written to')
+    parser.add_argument('--baseline', help='results of an earlier run')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='privadome-benchmark-')
+    env, token = prepare_database(directory, args)
+    port = free_port()
+    core = subprocess.Popen(
+        [sys.executable, '-m', 'privadome_frontend.benchmarks.stub_core',
+         '--latency', str(args.core_latency),
+         '--payload-size', str(args.payload_size)],
+        env=env, stdout=subprocess.PIPE)
+    server = None
+    try:
+        if not core.stdout.readline():
+            raise RuntimeError('The stub core did not start, are ports {}'
+                               ' and {} free?'.format(stub_core.POLICY_PORT,
+                                                      stub_core.DATA_PORT))
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'privadome_frontend', '--port', str(port),
+             '--workers', str(args.workers)],
+            env=env, cwd=directory, stdout=subprocess.DEVNULL)
+        wait_until_up(port, token, 60)
+        results = {
+            'config': {
+                'clients': args.clients,
+                'duration': args.duration,
+                'core_latency_ms': args.core_latency,
+                'payload_size': args.payload_size,
+                'users': args.users,
+                'workers': args.workers,
+                'reactor_proxy': args.reactor_proxy,
+                'fast_proxy': args.fast_proxy,
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'endpoints': {
+                name: run_endpoint(port, token, ENDPOINTS[name], args.clients,
+                                   args.duration, args.warmup,
+                                   args.sample_interval)
+                for name in args.endpoints
+            },
+        }
+    finally:
+        for process in (server, core):
+            if process is not None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['change'] = compare(results, json.load(f))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Policy endpoint fast path benchmark.
+
+Posts to a policy endpoint through the Django stack, once answered by
+the DRF view and once by the minimal handler of api.fastpath, with the
+core call stubbed out, and reports the CPU time per request of each.
+Runs against a throwaway test database.
+
+    python -m privadome_frontend.benchmarks.proxy_fastpath --requests 2000
+"""
+import argparse
+import json
+import os
+import time
+from unittest import mock
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'privadome_frontend.backend.settings')
+
+BODY = {'name': 'kids', 'policy': {'blocked': ['ads', 'tracking']}}
+REPLY = {'result': 'ok', 'groups': ['default', 'kids']}
+
+
+def cpu_per_request(client, path, requests):
+    for _ in range(min(requests, 100)):
+        client.post(path, BODY, content_type='application/json')
+    started = time.process_time()
+    for _ in range(requests):
+        client.post(path, BODY, content_type='application/json')
+    return (time.process_time() - started) / requests
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.urls import reverse
+    from rest_framework.authtoken.models import Token
+    from privadome_frontend.api import fastpath, urls, views
+    from privadome_frontend.api.dispatch import ROUTES, build_routes
+
+    setup_test_environment()
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = User.objects.create_user('benchmark', password='benchmark')
+        token = Token.objects.create(user=user)
+        client = Client(HTTP_AUTHORIZATION='Token ' + token.key)
+        path = reverse('add_policy_group')
+        fast = build_routes(urls.urlpatterns, handlers=fastpath.HANDLERS)
+        results = {}
+        with mock.patch.object(views, 'procbridge_call', return_value=REPLY):
+            for name, routes in (('drf', {}), ('fast', fast)):
+                with mock.patch.dict(ROUTES, routes):
+                    results[name + '_cpu_us'] = round(
+                        cpu_per_request(client, path, args.requests) * 1e6, 1)
+        results['saved_cpu_us'] = round(results['drf_cpu_us']
+                                        - results['fast_cpu_us'], 1)
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+SQLite concurrency benchmark.
+
+Reader threads look up tokens while a writer thread keeps updating users,
+once with the SQLite defaults (rollback journal) and once with the pragmas
+of the tuned backend, each thread on its own persistent connection.
+
+    python -m privadome_frontend.benchmarks.sqlite_concurrency --readers 8
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from privadome_frontend.backend.sqlite3.base import PRAGMAS, apply_pragmas
+
+ROWS = 1000
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def create(path):
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE user (id INTEGER PRIMARY KEY, username TEXT,
+                           last_login REAL);
+        CREATE TABLE token (key TEXT PRIMARY KEY, user_id INTEGER,
+                            created REAL);
+    ''')
+    connection.executemany('INSERT INTO user VALUES (?, ?, ?)',
+                           [(i, 'user{}'.format(i), 0) for i in range(ROWS)])
+    connection.executemany('INSERT INTO token VALUES (?, ?, ?)',
+                           [('key{}'.format(i), i, 0) for i in range(ROWS)])
+    connection.commit()
+    connection.close()
+
+
+def connect(path, pragmas):
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None,
+                                 check_same_thread=False)
+    apply_pragmas(connection, pragmas)
+    return connection
+
+
+def run(pragmas, readers, seconds, batch):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.sqlite3')
+    create(path)
+    stop = threading.Event()
+    latencies = [[] for _ in range(readers)]
+    counts = {'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def read(samples):
+        connection = connect(path, pragmas)
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                connection.execute(
+                    'SELECT token.key, user.username FROM token JOIN user '
+                    'ON user.id = token.user_id WHERE token.key = ?',
+                    ('key{}'.format(random.randrange(ROWS)),)).fetchall()
+            except sqlite3.OperationalError:
+                with lock:
+                    counts['errors'] += 1
+                continue
+            samples.append(time.perf_counter() - started)
+        connection.close()
+
+    def write():
+        connection = connect(path, pragmas)
+        while not stop.is_set():
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                for _ in range(batch):
+                    connection.execute(
+                        'UPDATE user SET last_login = ? WHERE id = ?',
+                        (time.time(), random.randrange(ROWS)))
+                connection.execute('COMMIT')
+            except sqlite3.OperationalError:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                with lock:
+                    counts['errors'] += 1
+                continue
+            counts['writes'] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=read, args=(samples,))
+               for samples in latencies]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    samples = [sample for reader in latencies for sample in reader]
+    return {
+        'reads_per_second': round(len(samples) / seconds, 1),
+        'writes_per_second': round(counts['writes'] / seconds, 1),
+        'read_p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'read_p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'read_max_ms': round(max(samples, default=0) * 1000, 3),
+        'errors': counts['errors'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--batch', type=int, default=50,
+                        help='updates per write transaction')
+    args = parser.parse_args(argv)
+    results = {
+        'default': run({}, args.readers, args.seconds, args.batch),
+        'tuned': run(PRAGMAS, args.readers, args.seconds, args.batch),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
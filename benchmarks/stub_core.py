@@ -0,0 +1,102 @@
+"""
+Stub PrivaDome core for benchmarks.
+
+Serves read_state, get_module_configs, tile data and the policy verbs on
+the policy and data procbridge ports, answering every call after a fixed
+latency with a payload of about the requested size. The policy verbs
+answer with the module state, like the core does.
+
+    python -m privadome_frontend.benchmarks.stub_core --latency 5 --payload-size 4096
+"""
+import argparse
+import json
+import threading
+import time
+
+import procbridge
+
+POLICY_PORT = 8077
+DATA_PORT = 8090
+
+POLICY_VERBS = ('add_group', 'add_client', 'delete_group', 'delete_client',
+                'update_network_policy', 'update_group_policy',
+                'update_client_policy')
+
+
+class StubCore:
+    """ Procbridge delegate answering after latency seconds. """
+
+    def __init__(self, latency=0.0, payload_size=1024):
+        self.latency = latency
+        self.state = padded_state(payload_size)
+        self.schemas = padded_schemas(payload_size)
+        self.tile_values = max(1, payload_size // 8)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, method, payload):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'read_state' or method in POLICY_VERBS:
+            return self.state
+        if method == 'get_module_configs':
+            return self.schemas
+        return {'name': method, 'time': time.time(),
+                'values': list(range(self.tile_values))}
+
+
+def padded_state(size):
+    """ A module state of about size bytes of JSON. """
+    state = {'network': {'module_policies': {}}, 'group': {}, 'address': {}}
+    index = 0
+    while len(json.dumps(state)) < size:
+        state['address']['10.0.{}.{}'.format(index // 256, index % 256)] = {
+            'module_policies': {'adblock': {'policy_records': []}}}
+        index += 1
+    return state
+
+
+def padded_schemas(size):
+    """ Module schemas of about size bytes of JSON. """
+    schemas = []
+    while len(json.dumps(schemas)) < size:
+        schemas.append({'id': 'module{}'.format(len(schemas)),
+                        'name': 'Module {}'.format(len(schemas)),
+                        'policy_schema': {'type': 'object'}})
+    return schemas
+
+
+def start(delegate, host='127.0.0.1', ports=(POLICY_PORT, DATA_PORT)):
+    """ Start a procbridge server per port, return the servers. """
+    servers = []
+    for port in ports:
+        server = procbridge.Server(host, port, delegate)
+        server.start()
+        servers.append(server)
+    return servers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds before every reply')
+    parser.add_argument('--payload-size', type=int, default=1024,
+                        help='approximate bytes of every reply')
+    args = parser.parse_args(argv)
+
+    servers = start(StubCore(args.latency / 1000, args.payload_size))
+    print(json.dumps({'ports': [POLICY_PORT, DATA_PORT]}), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+URL dispatch benchmark.
+
+Times resolving every core proxy path with the Django URL resolver and
+with the dispatch table of api.dispatch.
+
+    python -m privadome_frontend.benchmarks.url_dispatch --iterations 20000
+"""
+import argparse
+import json
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'privadome_frontend.backend.settings')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    import django
+    django.setup()
+    from django.urls import get_resolver
+    from privadome_frontend.api.dispatch import ROUTES
+
+    resolver = get_resolver()
+    results = {}
+    for path in sorted(ROUTES):
+        resolve = timeit.timeit(lambda: resolver.resolve(path),
+                                number=args.iterations)
+        lookup = timeit.timeit(lambda: ROUTES.get(path),
+                               number=args.iterations)
+        results[path] = {
+            'resolver_us': round(resolve / args.iterations * 1e6, 3),
+            'dispatch_us': round(lookup / args.iterations * 1e6, 3),
+        }
+    count = len(results)
+    results['mean'] = {
+        key: round(sum(result[key] for result in results.values()) / count, 3)
+        for key in ('resolver_us', 'dispatch_us')
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+User list serialization benchmark.
+
+Serializes the same users with UserListSerializer and with the values()
+row functions of api.serializers, and reports the time per 1000 users
+of each: serialization alone, from already fetched instances or rows,
+and with the query included. Runs against a throwaway test database.
+
+    python -m privadome_frontend.benchmarks.user_serializers --users 1000
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'privadome_frontend.backend.settings')
+
+
+def best_of(repeat, function):
+    """ Shortest of repeat timings of function, in seconds. """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from privadome_frontend.api.serializers import USER_LIST_COLUMNS,\
+        UserListSerializer, user_list_row
+
+    setup_test_environment()
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        User.objects.bulk_create(
+            User(username='user{}'.format(index),
+                 email='user{}@example.com'.format(index),
+                 is_superuser=index % 10 == 0)
+            for index in range(args.users))
+        users = User.objects.order_by('id')
+        instances = list(users)
+        rows = list(users.values(*USER_LIST_COLUMNS))
+        assert [user_list_row(row) for row in rows]\
+            == UserListSerializer(instances, many=True).data
+
+        timings = {
+            'serializer': lambda: UserListSerializer(instances,
+                                                     many=True).data,
+            'rows': lambda: [user_list_row(row) for row in rows],
+            'serializer_with_query': lambda: UserListSerializer(
+                User.objects.order_by('id'), many=True).data,
+            'rows_with_query': lambda: [
+                user_list_row(row) for row in
+                User.objects.order_by('id').values(*USER_LIST_COLUMNS)],
+        }
+        per_thousand = 1000 / args.users
+        results = {
+            name + '_ms_per_1k': round(
+                best_of(args.repeat, function) * per_thousand * 1000, 3)
+            for name, function in timings.items()
+        }
+        results['speedup'] = round(results['serializer_ms_per_1k']
+                                   / results['rows_ms_per_1k'], 1)
+        results['speedup_with_query'] = round(
+            results['serializer_with_query_ms_per_1k']
+            / results['rows_with_query_ms_per_1k'], 1)
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+"""
+Core proxy served directly from the Twisted reactor.
+
+The module and tile endpoints only forward a request to the PrivaDome
+core. Here they are answered without the WSGI thread pool: the core is
+spoken to with a non-blocking procbridge protocol and only the token
+lookup is deferred to a small, separate authentication pool.
+
+The read endpoints share the state, schema and tile caches and the
+versions of the Django views. Module state and schema misses are loaded
+once per key on the reactor; tiles that are not fresh are fetched on the
+tile executor like the tile batches, through the same single flight.
+Policy changes drop the cached module state.
+"""
+
+from procbridge.const import StatusCode
+from procbridge.errors import ProtocolError, ServerError
+
+from twisted.internet import defer, endpoints, protocol, threads
+from twisted.python import failure as twisted_failure
+from twisted.web import resource, server
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework import exceptions
+
+from privadome_frontend.api import jsoncodec
+from privadome_frontend.api.authentication import token_authentication
+from privadome_frontend.api.circuit import CircuitOpen, client_timeout,\
+                                           get_breaker
+from privadome_frontend.api.delta import VERSIONS, versioned
+from privadome_frontend.api.pool import HEADER_LENGTH, decode_reply,\
+                                        encode_request
+from privadome_frontend.api.views import PROC_PORT_DATA, PROC_PORT_POLICY,\
+                                         SCHEMA_CACHE, STATE_CACHE,\
+                                         TILE_CACHE, TILE_EXECUTOR, core_error,\
+                                         fetch_tile
+
+# Proxied endpoint -> (HTTP method, core api identifier, core port).
+# The tile endpoint takes its api identifier from the request body.
+CORE_ROUTES = {
+    b'modules/config': (b'GET', 'read_state', PROC_PORT_POLICY),
+    b'modules/info': (b'GET', 'get_module_configs', PROC_PORT_POLICY),
+    b'modules/addpolicy/group': (b'POST', 'add_group', PROC_PORT_POLICY),
+    b'modules/addpolicy/address': (b'POST', 'add_client', PROC_PORT_POLICY),
+    b'modules/deletepolicy/group': (b'POST', 'delete_group',
+                                    PROC_PORT_POLICY),
+    b'modules/deletepolicy/address': (b'POST', 'delete_client',
+                                      PROC_PORT_POLICY),
+    b'modules/updatepolicy/network': (b'POST', 'update_network_policy',
+                                      PROC_PORT_POLICY),
+    b'modules/updatepolicy/group': (b'POST', 'update_group_policy',
+                                    PROC_PORT_POLICY),
+    b'modules/updatepolicy/address': (b'POST', 'update_client_policy',
+                                      PROC_PORT_POLICY),
+    b'tiles/data': (b'POST', None, PROC_PORT_DATA),
+}
+
+# Core api identifier -> cache of the read endpoints.
+CORE_CACHES = {
+    'read_state': STATE_CACHE,
+    'get_module_configs': SCHEMA_CACHE,
+}
+
+
+class ProcbridgeClientProtocol(protocol.Protocol):
+    """
+    Non-blocking procbridge client sending a single request.
+    C{deferred} fires with the payload of the reply, cancelling it aborts
+    the connection, or the connection attempt C{connecting}.
+    """
+
+    def __init__(self, method, payload=None):
+        self.method = method
+        self.payload = payload
+        self.deferred = defer.Deferred(self._cancel)
+        self.connecting = None
+        self._buffer = b''
+
+    def _cancel(self, deferred):
+        if self.transport is not None:
+            self.transport.abortConnection()
+        elif self.connecting is not None:
+            # Fail with CancelledError, not the error of the connection
+            # attempt, so a timeout is still reported as one.
+            deferred.errback(defer.CancelledError())
+            self.connecting.cancel()
+
+    def connectionMade(self):
+        self.transport.write(encode_request(self.method, self.payload))
+
+    def dataReceived(self, data):
+        self._buffer += data
+        if len(self._buffer) < HEADER_LENGTH or self.deferred.called:
+            return
+        length = int.from_bytes(self._buffer[7:11], byteorder='little')
+        if len(self._buffer) < HEADER_LENGTH + length:
+            return
+        try:
+            result = self._decode(self._buffer[:HEADER_LENGTH + length])
+        except Exception as ex:
+            self.deferred.errback(ex)
+        else:
+            self.deferred.callback(result)
+        self.transport.loseConnection()
+
+    @staticmethod
+    def _decode(frame):
+        code, result = decode_reply(frame[:HEADER_LENGTH],
+                                    frame[HEADER_LENGTH:])
+        if code != StatusCode.GOOD_RESPONSE:
+            raise ServerError(result)
+        return result
+
+    def connectionLost(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(ProtocolError('incomplete data'))
+
+
+def procbridge_request(reactor, host, port, method, payload=None,
+                       timeout=30):
+    """
+    Send a procbridge request from the reactor.
+    Return a Deferred firing with the payload of the reply.
+    """
+    client = ProcbridgeClientProtocol(method, payload)
+    endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port,
+                                            timeout=timeout)
+    client.connecting = endpoints.connectProtocol(endpoint, client)
+    client.connecting.addErrback(_connect_failed, client)
+    client.deferred.addTimeout(timeout, reactor)
+    return client.deferred
+
+
+def _connect_failed(failure, client):
+    # The request may have timed out or been cancelled already.
+    if not client.deferred.called:
+        client.deferred.errback(failure)
+
+
+class DeferredSingleFlight:
+    """
+    Collapse concurrent calls for the same key into one call, on the
+    reactor. Every caller gets its own Deferred firing with the result;
+    cancelling it does not cancel the call of the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """ Call function, which may return a Deferred, once for key. """
+        waiter = defer.Deferred()
+        waiters = self._calls.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            waiters.append(waiter)
+            return waiter
+        self._calls[key] = [waiter]
+        defer.maybeDeferred(function).addBoth(self._done, key)
+        return waiter
+
+    def _done(self, result, key):
+        for waiter in self._calls.pop(key):
+            if waiter.called:
+                continue
+            if isinstance(result, twisted_failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+
+def authenticate(header):
+    """
+    Validate an Authorization header in an authentication pool thread.
+    Return the authenticated user.
+    """
+    close_old_connections()
+    try:
+        parts = header.split()
+        if not parts or parts[0].lower() != b'token':
+            raise exceptions.NotAuthenticated()
+        if len(parts) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        try:
+            key = parts[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        user, _ = token_authentication().authenticate_credentials(key)
+        return user
+    finally:
+        close_old_connections()
+
+
+class CoreProxyResource(resource.Resource):
+    """
+    Answer the module and tile endpoints on the reactor.
+    """
+    isLeaf = True
+
+    def __init__(self, reactor, auth_threadpool):
+        super().__init__()
+        self._reactor = reactor
+        self._auth_threadpool = auth_threadpool
+        self._host = settings.PRIVADOME_CORE_HOST
+        self._timeout = getattr(settings, 'PRIVADOME_CORE_TIMEOUT', 30)
+        self._flight = DeferredSingleFlight()
+
+    def render(self, request):
+        path = b'/'.join(segment for segment in
+                         request.prepath[-1:] + request.postpath if segment)
+        route = CORE_ROUTES.get(path)
+        if route is None:
+            return self._encode(request, 404, {'detail': 'Not found.'})
+        http_method, api_identifier, port = route
+        if request.method != http_method:
+            return self._encode(request, 405, {
+                'detail': 'Method "{}" not allowed.'.format(
+                    request.method.decode('latin-1'))})
+
+        header = request.getHeader(b'authorization') or b''
+        timeout = client_timeout(request.getHeader(b'x-request-timeout'))
+        # Before anything can finish the request.
+        finished = request.notifyFinish()
+        d = threads.deferToThreadPool(self._reactor, self._auth_threadpool,
+                                      authenticate, header)
+        d.addCallback(lambda _: self._forward(request, api_identifier, port,
+                                              timeout))
+        d.addCallback(lambda response: self._finish(request, *response))
+        d.addErrback(self._failed, request)
+        finished.addErrback(lambda _: d.cancel())
+        return server.NOT_DONE_YET
+
+    def _forward(self, request, api_identifier, port, timeout=None):
+        """
+        Return the status, body and headers of the answer to request,
+        or a Deferred firing with them.
+        """
+        if api_identifier in CORE_CACHES:
+            since = request.args.get(b'since')
+            return self._read(
+                api_identifier, self._cached(api_identifier, port, timeout),
+                since[0].decode('latin-1') if since else None,
+                request.getHeader(b'if-none-match'))
+
+        payload = None
+        if request.method == b'POST':
+            body = request.content.read()
+            try:
+                payload = jsoncodec.loads(body)
+            except ValueError as ex:
+                raise exceptions.ParseError('JSON parse error - {}'.format(ex))
+            if api_identifier is None:
+                name = payload.get('name')\
+                    if isinstance(payload, dict) else None
+                if not isinstance(name, str) or not name:
+                    raise exceptions.ValidationError(
+                        {'name': 'A tile name is required.'})
+                return self._read('tile:' + name, self._tile(name, timeout),
+                                  payload.get('since'))
+            payload = jsoncodec.RawJSON(body)
+        d = self._call(port, api_identifier, payload, timeout)
+        d.addBoth(self._invalidate_state)
+        d.addCallback(lambda payload: (200, payload, {}))
+        return d
+
+    @staticmethod
+    def _invalidate_state(result):
+        # Like views.policy_procbridge_request().
+        STATE_CACHE.invalidate()
+        return result
+
+    def _cached(self, api_identifier, port, timeout):
+        """
+        The payload of a read endpoint from its cache, loaded once on a
+        miss whatever the number of clients waiting for it.
+        """
+        cache = CORE_CACHES[api_identifier]
+        hit, value = cache.lookup(api_identifier)
+        if hit:
+            return defer.succeed((value, None))
+        # Clients arriving after an invalidation must not join a load
+        # that started before it.
+        d = self._flight.do(
+            (api_identifier, value),
+            lambda: self._call(port, api_identifier).addCallback(
+                lambda payload: (cache.store(api_identifier, payload, value),
+                                 None)))
+        if timeout:
+            d.addTimeout(timeout, self._reactor)
+        return d
+
+    def _tile(self, name, timeout):
+        """
+        The payload of a tile and its cache state. Only a fresh tile is
+        served on the reactor, the others are fetched on the tile executor.
+        """
+        value = TILE_CACHE.fresh(name)
+        if value is not None:
+            return defer.succeed((value, TILE_CACHE.HIT))
+        future = TILE_EXECUTOR.submit(fetch_tile, name)
+        # Like tiles_data, the tile still reaches the cache when the
+        # client stops waiting for it.
+        d = defer.Deferred(lambda _: future.cancel())
+        future.add_done_callback(
+            lambda _: self._reactor.callFromThread(self._fetched, d, future))
+        if timeout:
+            d.addTimeout(timeout, self._reactor)
+        return d
+
+    @staticmethod
+    def _fetched(d, future):
+        if d.called:
+            return
+        if future.cancelled():
+            d.errback(defer.CancelledError())
+        elif future.exception() is not None:
+            d.errback(future.exception())
+        else:
+            d.callback(future.result())
+
+    def _read(self, key, d, since=None, if_none_match=None):
+        """
+        Answer a read endpoint with the versions of the Django views,
+        or with the last payload served for key when the core fails.
+        """
+        if_none_match = if_none_match.decode('latin-1')\
+            if if_none_match else None
+        d.addCallbacks(self._versioned, self._last_known_good,
+                       callbackArgs=(key, since, if_none_match),
+                       errbackArgs=(key, since, if_none_match))
+        return d
+
+    @staticmethod
+    def _versioned(result, key, since, if_none_match):
+        payload, cache_state = result
+        code, data, headers = versioned(key, payload, since, if_none_match)
+        if cache_state is not None:
+            headers['X-Cache'] = cache_state.upper()
+        return code, data, headers
+
+    @staticmethod
+    def _last_known_good(failure, key, since, if_none_match):
+        # Like views.last_known_good().
+        payload = VERSIONS.latest(key)
+        if payload is None or failure.check(defer.CancelledError):
+            return failure
+        print(failure.getErrorMessage())
+        code, data, headers = versioned(key, payload, since, if_none_match)
+        headers['Warning'] = '110 - "Response is Stale"'
+        return code, data, headers
+
+    def _call(self, port, api_identifier, payload=None, timeout=None):
+        """ Send a request to the core through its circuit breaker. """
+        breaker = get_breaker(port)
+        breaker.before()
+        d = procbridge_request(self._reactor, self._host, port,
+                               api_identifier, payload,
+                               timeout or self._timeout)
+        d.addCallbacks(self._succeeded, self._core_failed,
+                       callbackArgs=(breaker,),
+                       errbackArgs=(breaker, timeout))
+        return d
+
+    @staticmethod
+    def _succeeded(payload, breaker):
+        breaker.success()
+        return payload
+
+    @staticmethod
+    def _core_failed(failure, breaker, timeout):
+        if failure.check(ServerError):
+            # The core answered, it is up.
+            breaker.success()
+        elif failure.check(defer.CancelledError) or (
+                timeout and failure.check(defer.TimeoutError)):
+            # Only the core timeout counts, not a shorter one of the client.
+            breaker.release()
+        else:
+            breaker.failure()
+        return failure
+
+    def _failed(self, failure, request):
+        if failure.check(defer.CancelledError):
+            return
+        error = core_error(failure.value)
+        if error is not None:
+            self._finish(request, *error)
+            return
+        if failure.check(defer.TimeoutError):
+            self._finish(request, 504, {'detail': 'Core request timed out.'})
+            return
+        if failure.check(exceptions.APIException):
+            ex = failure.value
+            if isinstance(ex, (exceptions.NotAuthenticated,
+                               exceptions.AuthenticationFailed)):
+                request.setHeader(b'www-authenticate', b'Token')
+            # Like the exception handler of DRF.
+            data = ex.detail if isinstance(ex.detail, (list, dict))\
+                else {'detail': str(ex.detail)}
+            self._finish(request, ex.status_code, data)
+            return
+        print(failure.getErrorMessage())
+        self._finish(request, 500, {'error': 'Server Error (500)'})
+
+    @staticmethod
+    def _encode(request, code, data, headers=None):
+        request.setResponseCode(code)
+        for name, value in (headers or {}).items():
+            request.setHeader(name.encode('latin-1'), value.encode('latin-1'))
+        if data is None:
+            return b''
+        body = jsoncodec.dumps(data)
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(b'content-length', str(len(body)).encode())
+        return body
+
+    def _finish(self, request, code, data, headers=None):
+        body = self._encode(request, code, data, headers)
+        if body:
+            request.write(body)
+        request.finish()
+
+
+class ApiResource(resource.Resource):
+    """
+    The /api resource. Core proxy endpoints are answered on the reactor
+    when a proxy resource is given, or by the Django WSGI application
+    on the core thread pool when a core WSGI resource is given.
+    Everything else is handed to the Django WSGI application.
+    """
+    CORE_PREFIXES = (b'modules', b'tiles', b'proctest')
+
+    def __init__(self, wsgi_resource, proxy_resource=None,
+                 core_wsgi_resource=None):
+        super().__init__()
+        self._wsgi = wsgi_resource
+        self._proxy = proxy_resource
+        self._core_wsgi = core_wsgi_resource
+
+    def getChild(self, path, request):
+        if self._proxy is not None:
+            route = b'/'.join(segment for segment in
+                              [path] + request.postpath if segment)
+            if route in CORE_ROUTES:
+                return self._proxy
+        request.postpath.insert(0, request.prepath.pop())
+        if self._core_wsgi is not None and path in self.CORE_PREFIXES:
+            return self._core_wsgi
+        return self._wsgi
+
+    def render(self, request):
+        return self._wsgi.render(request)
@@ -0,0 +1,230 @@
+"""
+Sampling profiler toggled at runtime.
+
+While a profile runs, a daemon thread reads the stack of every other
+thread of the process with sys._current_frames() at a fixed interval:
+the reactor thread, the WSGI pool workers, the tile executor and so on.
+Threads waiting for work are left out unless idle stacks are asked for.
+The stacks are counted and written, when the profile ends, in the
+collapsed format read by flamegraph.pl and speedscope:
+
+    PoolThread-wsgi;run (threading.py:982);...;read_state (views.py:412) 17
+
+Profiles are started from the admin profile endpoint or by sending the
+signal installed with install_signal_handler() to the process. Either
+way only one process is profiled: with --workers, the endpoint profiles
+the worker that happened to serve the request, and a later request may
+reach another worker (stats() gives the pid of the profiled one). To
+profile every worker, send the signal to the supervisor, which forwards
+it to each worker; every worker then writes its own file.
+"""
+import collections
+import datetime
+import os
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from privadome_frontend.api import stats
+
+# (module, function) of the frames idle threads wait in.
+IDLE_FRAMES = frozenset((
+    ('threading', 'wait'),
+    ('queue', 'get'),
+    ('epollreactor', 'doPoll'),
+    ('pollreactor', 'doPoll'),
+    ('selectreactor', 'doSelect'),
+))
+
+
+class SamplingProfiler:
+    """ Samples the stacks of every thread until stopped. """
+
+    def __init__(self, interval=0.01, idle=False):
+        self.interval = interval
+        self.idle = idle
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, seconds=None):
+        """ Sample in a background thread for seconds, or until stop(). """
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, args=(seconds,),
+                                        name='profiler', daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """ Ask the sampling thread to end, without waiting for it. """
+        self._stop.set()
+
+    def stop(self):
+        self.cancel()
+        if self._thread is not None\
+                and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, seconds):
+        until = None if seconds is None else time.monotonic() + seconds
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if until is not None and time.monotonic() >= until:
+                break
+            self.sample(exclude=own)
+        self.stopped = time.time()
+        self.finished()
+
+    def finished(self):
+        """ Called in the sampling thread once sampling ended. """
+
+    def sample(self, exclude=None):
+        """ Count the current stack of every thread but exclude. """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude:
+                continue
+            if not self.idle and self._label_key(frame.f_code) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_group(names.get(ident, str(ident))))
+            stack.reverse()
+            self.counts[';'.join(stack)] += 1
+        self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    @staticmethod
+    def _label_key(code):
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        return module, code.co_name
+
+    def collapsed(self):
+        """ The counted stacks in the collapsed format. """
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.counts.most_common())
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+
+def thread_group(name):
+    """ Thread name without its number, so a pool's workers are merged. """
+    return re.sub(r'[-_]\d+$', '', name)
+
+
+class Profile(SamplingProfiler):
+    """ A profile written to path when it ends. """
+
+    def __init__(self, path, interval=0.01, idle=False):
+        super().__init__(interval, idle)
+        self.path = path
+        self.pid = os.getpid()
+        self.error = None
+
+    def finished(self):
+        try:
+            self.write(self.path)
+        except OSError as ex:
+            self.error = str(ex)
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'pid': self.pid,
+            'path': self.path,
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': len(self.counts),
+            'started': self.started,
+            'stopped': self.stopped,
+            'error': self.error,
+        }
+
+
+_PROFILE = None
+_PROFILE_LOCK = threading.Lock()
+
+
+class ProfileRunning(Exception):
+    """ A profile is already running. """
+
+
+def start_profile(seconds, interval=0.01, idle=False, directory=None):
+    """
+    Profile the process for seconds, writing the collapsed stacks to a new
+    file of directory (the temporary directory by default) when done.
+    Raise ProfileRunning while another profile runs.
+    """
+    global _PROFILE
+    with _PROFILE_LOCK:
+        if _PROFILE is not None and _PROFILE.running:
+            raise ProfileRunning('A profile is already running')
+        path = os.path.join(
+            directory or tempfile.gettempdir(),
+            'privadome-{}-{}.collapsed'.format(
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                os.getpid()))
+        _PROFILE = Profile(path, interval, idle)
+        _PROFILE.start(seconds)
+        return _PROFILE
+
+
+def stop_profile():
+    """ End the running profile early, return it or None. """
+    with _PROFILE_LOCK:
+        profile = _PROFILE
+    if profile is not None and profile.running:
+        profile.stop()
+    return profile
+
+
+def current_profile():
+    """ The running or last profile, None before the first. """
+    return _PROFILE
+
+
+def profile_stats():
+    profile = _PROFILE
+    return profile.stats() if profile is not None else {'running': False}
+
+
+stats.register('profiler', profile_stats)
+
+
+def install_signal_handler(signum=signal.SIGUSR2, seconds=30, **options):
+    """
+    Start a profile of seconds when signum is received, or stop the
+    running one early.
+    """
+    def toggle(signum, frame):
+        profile = current_profile()
+        if profile is not None and profile.running:
+            # Joining the sampling thread here would block the main thread.
+            profile.cancel()
+            return
+        try:
+            start_profile(seconds, **options)
+        except ProfileRunning:
+            pass
+    signal.signal(signum, toggle)
@@ -0,0 +1,198 @@
+"""
+Lazy startup.
+
+In lazy mode the site starts listening with only the static bundle
+loaded; Django, DRF and the API resources are loaded on a thread, either
+right after the reactor starts or on the first /api or /stream request.
+Requests arriving while the API loads wait for it.
+
+import_profile digests the -X importtime report of loading the API.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.web import resource, server
+
+
+def load_django():
+    """
+    Import the Django stack and the API modules, safe to run off the
+    reactor thread.
+    """
+    import privadome_frontend.backend.wsgi  # noqa: F401
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    import privadome_frontend.coreproxy  # noqa: F401
+    import privadome_frontend.tilestream  # noqa: F401
+
+
+class LazyLoader:
+    """
+    Run load on a thread once, then build on the reactor thread and put
+    the resources it returns, path segment -> resource, under root.
+    """
+
+    def __init__(self, reactor, root, load, build):
+        self.reactor = reactor
+        self.root = root
+        self._load = load
+        self._build = build
+        self.resources = None
+        self.load_seconds = None
+        self.failures = 0
+        self._loading = False
+        self._waiting = []
+
+    def load(self):
+        """ Start loading unless it is loaded or loading. """
+        if self.resources is not None or self._loading:
+            return
+        self._loading = True
+        started = time.monotonic()
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                      self._load)
+        d.addCallback(lambda _: self._build())
+        d.addCallbacks(self._loaded, self._failed, callbackArgs=(started,))
+
+    def _loaded(self, resources, started):
+        self._loading = False
+        self.load_seconds = time.monotonic() - started
+        self.resources = resources
+        for name, child in resources.items():
+            self.root.putChild(name, child)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(resources)
+
+    def _failed(self, failure):
+        # The next request tries again.
+        self._loading = False
+        self.failures += 1
+        log.err(failure, 'Loading the API failed')
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(failure)
+
+    def when_loaded(self):
+        """ A Deferred firing with the resources once they are loaded. """
+        if self.resources is not None:
+            return defer.succeed(self.resources)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def stats(self):
+        return {
+            'loaded': self.resources is not None,
+            'load_seconds': round(self.load_seconds, 3)
+                            if self.load_seconds is not None else None,
+            'failures': self.failures,
+        }
+
+
+class LazyResource(resource.Resource):
+    """ Placeholder of a resource of a LazyLoader, holding its requests. """
+    isLeaf = True
+
+    def __init__(self, loader, name):
+        super().__init__()
+        self.loader = loader
+        self.name = name
+
+    def _render(self, request):
+        child = self.loader.resources[self.name]
+        return resource.getChildForRequest(child, request).render(request)
+
+    def render(self, request):
+        if self.loader.resources is not None:
+            return self._render(request)
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def loaded(_):
+            if finished:
+                return
+            body = self._render(request)
+            if body is not server.NOT_DONE_YET:
+                request.write(body)
+                request.finish()
+
+        def failed(_):
+            if finished:
+                return
+            request.setResponseCode(503)
+            request.setHeader(b'content-type', b'application/json')
+            request.setHeader(b'retry-after', b'1')
+            request.write(json.dumps({'detail': 'Server is starting.'})
+                          .encode('utf-8'))
+            request.finish()
+
+        self.loader.when_loaded().addCallbacks(loaded, failed)
+        self.loader.load()
+        return server.NOT_DONE_YET
+
+
+def parse_importtime(report):
+    """
+    Parse an -X importtime report into (self_us, cumulative_us, depth,
+    module) tuples.
+    """
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((int(fields[0]), int(fields[1]), depth, name.strip()))
+    return entries
+
+
+def import_digest(entries, top=15):
+    """ Summary of parsed importtime entries, times in milliseconds. """
+    packages = {}
+    for self_us, _, _, name in entries:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return {
+        'total_ms': round(sum(entry[1] for entry in entries
+                              if entry[2] == 0) / 1000, 1),
+        'modules': len(entries),
+        'packages': [(package, round(us / 1000, 1)) for package, us in
+                     sorted(packages.items(), key=lambda item: -item[1])
+                     [:top]],
+        'slowest': [(name, round(self_us / 1000, 1)) for self_us, _, _, name
+                    in sorted(entries, key=lambda entry: -entry[0])[:top]],
+    }
+
+
+def import_profile(top=15):
+    """
+    Load the API in a fresh interpreter under -X importtime and return
+    the digest of the report.
+    """
+    code = 'from privadome_frontend.startup import load_django; load_django()'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE, env=os.environ.copy(),
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return import_digest(parse_importtime(result.stderr), top)
+
+
+def format_digest(digest):
+    lines = ['Imported {modules} modules in {total_ms} ms'.format(**digest),
+             '', 'Self time by package (ms):']
+    lines += ['  {:>8}  {}'.format(ms, package)
+              for package, ms in digest['packages']]
+    lines += ['', 'Slowest modules, self time (ms):']
+    lines += ['  {:>8}  {}'.format(ms, name) for name, ms in digest['slowest']]
+    return '\n'.join(lines)
@@ -0,0 +1,327 @@
+"""
+Static file serving for the Angular bundle.
+
+Files are served from precompressed .br/.gz variants when the client
+accepts them, content-hashed bundle files are cached for a year as
+immutable, and other files such as index.html carry a strong ETag.
+compress_static generates the variants once per bundle.
+
+CompressedStaticFile reads the files from disk on every request,
+MemoryStaticResource loads the whole bundle at startup and answers
+from memory, reloading files that change on disk.
+"""
+import gzip
+import hashlib
+import os
+import re
+from stat import S_ISREG
+
+from twisted.internet import task
+from twisted.web import http, resource, static
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{16,}\.')
+IMMUTABLE = b'public, max-age=31536000, immutable'
+REVALIDATE = b'no-cache'
+
+# Preferred first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+COMPRESSIBLE = ('.js', '.css', '.html', '.txt', '.svg', '.json', '.map',
+                '.ttf', '.eot', '.ico')
+
+_ETAGS = {}
+
+CONTENT_TYPES = static.loadMimeTypes()
+
+
+def accepted_encodings(request):
+    """ Content codings accepted by the client, without q=0 ones. """
+    header = request.getHeader(b'accept-encoding')
+    if not header:
+        return set()
+    accepted = set()
+    for item in header.decode('latin-1').split(','):
+        coding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        try:
+            if params.startswith('q=') and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def file_etag(path, stat):
+    """ Strong ETag of a file, recomputed when the file changes. """
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    etag = _ETAGS.get(key)
+    if etag is None:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        etag = _ETAGS[key] = digest.hexdigest()
+    return etag
+
+
+class CompressedStaticFile(static.File):
+    """ static.File serving precompressed variants with cache headers. """
+
+    def _variant(self, request):
+        """ The freshest accepted precompressed variant, or None. """
+        accepted = accepted_encodings(request)
+        mtime = self.getModificationTime()
+        for coding, extension in ENCODINGS:
+            path = self.path + extension
+            if coding in accepted and os.path.isfile(path)\
+                    and os.path.getmtime(path) >= mtime:
+                return coding, path
+        return None
+
+    def render_GET(self, request):
+        self.restat(False)
+        if not self.exists() or self.isdir():
+            return super().render_GET(request)
+
+        if self.type is None:
+            self.type, self.encoding = static.getTypeAndEncoding(
+                self.basename(), self.contentTypes, self.contentEncodings,
+                self.defaultType)
+        variant = self._variant(request)
+        if self.basename().endswith(COMPRESSIBLE):
+            request.setHeader(b'vary', b'accept-encoding')
+
+        if HASHED_NAME.search(self.basename()):
+            request.setHeader(b'cache-control', IMMUTABLE)
+        else:
+            etag = file_etag(self.path, os.stat(self.path))
+            if variant is not None:
+                etag += '-' + variant[0]
+            request.setHeader(b'cache-control', REVALIDATE)
+            if request.setETag(('"' + etag + '"').encode()) is http.CACHED:
+                return b''
+
+        if variant is None:
+            return super().render_GET(request)
+        coding, path = variant
+        encoded = static.File(path, self.defaultType)
+        encoded.type = self.type
+        encoded.encoding = coding
+        return encoded.render_GET(request)
+
+    render_HEAD = render_GET
+
+
+def compress_static(directory, level=9):
+    """
+    Write .gz (and .br when brotli is installed) variants next to every
+    compressible file of directory. Up to date variants are kept and
+    variants that would not be smaller are not written.
+    Return the paths written.
+    """
+    compressors = [('.gz', lambda data: gzip.compress(data, level, mtime=0))]
+    if brotli is not None:
+        compressors.append(('.br', lambda data: brotli.compress(data)))
+
+    written = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(dirpath, filename)
+            mtime = os.path.getmtime(path)
+            data = None
+            for extension, compress in compressors:
+                target = path + extension
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                written.append(target)
+    return written
+
+
+class Asset:
+    """ A static file and its precompressed variants, held in memory. """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.key = self.stamp()
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.etag = hashlib.sha1(self.data).hexdigest()
+        self.type = static.getTypeAndEncoding(
+            name, CONTENT_TYPES, {}, 'application/octet-stream')[0]
+        self.immutable = bool(HASHED_NAME.search(os.path.basename(name)))
+        self.compressible = name.endswith(COMPRESSIBLE)
+        self.variants = {}
+        for coding, extension in ENCODINGS:
+            variant = path + extension
+            if os.path.isfile(variant) and os.path.getmtime(variant) >= self.mtime:
+                with open(variant, 'rb') as f:
+                    self.variants[coding] = f.read()
+
+    def stamp(self):
+        """
+        (mtime_ns, size) of the file and of each variant, None for
+        those missing. Stale variants are included, so they do not
+        count as changes while they stay as they are.
+        """
+        return tuple(_stamp(self.path + extension)
+                     for extension in ('',) + tuple(
+                         extension for _, extension in ENCODINGS))
+
+    def changed(self):
+        """ Whether the file or one of its variants changed on disk. """
+        return self.stamp() != self.key
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def parse_range(header, size):
+    """
+    The (offset, length) of a single byte range request, None when the
+    header is not a single byte range, ValueError when unsatisfiable.
+    """
+    unit, _, ranges = header.decode('latin-1').partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if not start:
+            length = min(int(end), size)
+            if length <= 0:
+                raise ValueError(header)
+            return size - length, length
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        raise ValueError(header)
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+class MemoryStaticResource(resource.Resource):
+    """
+    Serve a static directory from memory, with index.html answering
+    every unknown path so that SPA deep links work.
+    """
+
+    def __init__(self, directory, index='index.html'):
+        super().__init__()
+        self.directory = directory
+        self.index = index
+        self.assets = {}
+        self.reloads = 0
+        self.load()
+        self.reloads = 0
+
+    def load(self):
+        """ Load every file that is not a precompressed variant. """
+        assets = {}
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(tuple(ext for _, ext in ENCODINGS)):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.directory)\
+                    .replace(os.sep, '/')
+                current = self.assets.get(name)
+                assets[name] = current if current is not None\
+                    and not current.changed() else Asset(path, name)
+        if assets.keys() != self.assets.keys() or any(
+                assets[name] is not self.assets[name] for name in assets):
+            self.reloads += 1
+        self.assets = assets
+
+    def watch(self, reactor, interval):
+        """ Reload changed files every interval seconds. """
+        loop = task.LoopingCall(self.load)
+        loop.clock = reactor
+        loop.start(interval, now=False)
+        return loop
+
+    def getChild(self, path, request):
+        return self
+
+    def render_GET(self, request):
+        name = '/'.join(segment.decode('utf-8', 'replace') for segment in
+                        request.prepath[len(request.sitepath):]
+                        if segment)
+        asset = self.assets.get(name or self.index)
+        if asset is None:
+            asset = self.assets.get(self.index)
+        if asset is None:
+            return resource.NoResource().render(request)
+        return self.render_asset(request, asset)
+
+    render_HEAD = render_GET
+
+    def render_asset(self, request, asset):
+        request.setHeader(b'content-type', asset.type.encode())
+        request.setHeader(b'accept-ranges', b'bytes')
+        if asset.compressible:
+            request.setHeader(b'vary', b'accept-encoding')
+
+        range_header = request.getHeader(b'range')
+        coding = None
+        if range_header is None:
+            accepted = accepted_encodings(request)
+            coding = next((coding for coding, _ in ENCODINGS
+                           if coding in accepted and coding in asset.variants),
+                          None)
+        data = asset.variants[coding] if coding else asset.data
+
+        if asset.immutable:
+            request.setHeader(b'cache-control', IMMUTABLE)
+        else:
+            request.setHeader(b'cache-control', REVALIDATE)
+            etag = asset.etag + ('-' + coding if coding else '')
+            if request.setETag(('"' + etag + '"').encode()) is http.CACHED:
+                return b''
+        if request.setLastModified(asset.mtime) is http.CACHED:
+            return b''
+        if coding:
+            request.setHeader(b'content-encoding', coding.encode())
+
+        if range_header is not None:
+            try:
+                byte_range = parse_range(range_header, len(data))
+            except ValueError:
+                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader(b'content-range',
+                                  'bytes */{}'.format(len(data)).encode())
+                return b''
+            if byte_range is not None:
+                offset, length = byte_range
+                request.setResponseCode(http.PARTIAL_CONTENT)
+                request.setHeader(b'content-range', 'bytes {}-{}/{}'.format(
+                    offset, offset + length - 1, len(data)).encode())
+                data = data[offset:offset + length]
+
+        request.setHeader(b'content-length', str(len(data)).encode())
+        if request.method == b'HEAD':
+            return b''
+        return data
@@ -0,0 +1,311 @@
+"""
+Multi-process serving.
+
+The supervisor binds the listening socket once and starts N worker
+processes that inherit it, each running its own reactor. Workers send a
+heartbeat over a pipe; the supervisor restarts workers that exit or stop
+beating, replaces all of them on SIGHUP, forwards SIGUSR2 (start or stop
+a profile, see profiler.py) to each of them and stops them on
+SIGTERM/SIGINT. A worker asked to stop closes its copy of the socket and
+finishes the requests in progress first (see drain_on_shutdown()).
+
+Workers share nothing but the socket and the database, and their
+in-process caches are not invalidated across workers. The token cache is
+disabled in workers (see worker_count()), so a deleted token or
+deactivated user is refused by every worker at once. A policy change
+made through one worker is seen by the others once their module state
+cache expires (PRIVADOME_STATE_CACHE_TTL).
+"""
+import errno
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.protocols import policies
+from twisted.web.server import Site
+
+HEARTBEAT_INTERVAL = 1.0
+
+# Number of workers, set in the environment of the workers.
+WORKERS_ENV = 'PRIVADOME_WORKERS'
+
+
+def worker_count():
+    """ Number of worker processes serving the API, 1 without supervisor. """
+    try:
+        return int(os.environ.get(WORKERS_ENV, 1))
+    except ValueError:
+        return 1
+
+
+def worker_command():
+    """ Command line starting this program. """
+    if hasattr(sys, "frozen"):
+        return [sys.executable]
+    return [sys.executable, '-m', 'privadome_frontend']
+
+
+class Worker:
+    """ A worker process and the read end of its heartbeat pipe. """
+
+    def __init__(self, process, heartbeat_fd):
+        self.process = process
+        self.heartbeat_fd = heartbeat_fd
+        self.started = time.monotonic()
+        self.last_beat = self.started
+
+    def close(self):
+        try:
+            os.close(self.heartbeat_fd)
+        except OSError:
+            pass
+
+
+class Supervisor:
+    """ Start and supervise worker processes sharing one listening socket. """
+
+    def __init__(self, port, workers, extra_args=(), heartbeat_timeout=10.0,
+                 shutdown_timeout=30.0, backlog=128):
+        self.port = port
+        self.count = workers
+        self.extra_args = list(extra_args)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.backlog = backlog
+        self.workers = []
+        self.socket = None
+        self._stopping = False
+        self._restarting = False
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        sock.set_inheritable(True)
+        self.socket = sock
+
+    def spawn(self):
+        """ Start one worker on the shared socket. """
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        fd = self.socket.fileno()
+        process = subprocess.Popen(
+            worker_command() + self.extra_args
+            + ['--listen-fd', str(fd), '--heartbeat-fd', str(write_fd),
+               '--shutdown-timeout', str(self.shutdown_timeout)],
+            pass_fds=(fd, write_fd),
+            env=dict(os.environ, **{WORKERS_ENV: str(self.count)}))
+        os.close(write_fd)
+        worker = Worker(process, read_fd)
+        self.workers.append(worker)
+        print('Started worker {}'.format(process.pid))
+        return worker
+
+    def run(self):
+        self.bind()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+        signal.signal(signal.SIGUSR2, self._forward)
+        for _ in range(self.count):
+            self.spawn()
+        try:
+            while not self._stopping:
+                if self._restarting:
+                    self._restarting = False
+                    self.restart()
+                self._watch()
+                self._reap()
+        finally:
+            self.stop()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _restart(self, signum, frame):
+        self._restarting = True
+
+    def _forward(self, signum, frame):
+        for worker in list(self.workers):
+            # A worker installs its handler before its first heartbeat,
+            # the signal would kill a worker still starting.
+            if worker.last_beat > worker.started\
+                    and worker.process.poll() is None:
+                worker.process.send_signal(signum)
+
+    def _watch(self):
+        """ Read heartbeats and kill workers whose heartbeat stopped. """
+        fds = [worker.heartbeat_fd for worker in self.workers]
+        try:
+            readable, _, _ = select.select(fds, [], [], HEARTBEAT_INTERVAL)
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+            readable = []
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.heartbeat_fd in readable:
+                try:
+                    os.read(worker.heartbeat_fd, 512)
+                except OSError:
+                    pass
+                worker.last_beat = now
+            elif now - worker.last_beat > self.heartbeat_timeout\
+                    and worker.process.poll() is None:
+                print('Worker {} stopped responding'
+                      .format(worker.process.pid))
+                worker.process.kill()
+
+    def _reap(self):
+        """ Replace workers that exited. """
+        for worker in list(self.workers):
+            if worker.process.poll() is None:
+                continue
+            self.workers.remove(worker)
+            worker.close()
+            print('Worker {} exited with {}'.format(
+                worker.process.pid, worker.process.returncode))
+            if self._stopping:
+                continue
+            # Do not spin on a worker that cannot start.
+            if time.monotonic() - worker.started < 1:
+                time.sleep(1)
+            self.spawn()
+
+    def restart(self):
+        """
+        Graceful restart, new workers are started before the old ones are
+        asked to stop. These stop accepting connections and finish their
+        requests in progress, killed after shutdown_timeout seconds.
+        """
+        old = list(self.workers)
+        for _ in range(self.count):
+            self.spawn()
+        self._terminate(old)
+
+    def _terminate(self, workers):
+        for worker in workers:
+            if worker.process.poll() is None:
+                worker.process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker in workers:
+            try:
+                worker.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+            if worker in self.workers:
+                self.workers.remove(worker)
+            worker.close()
+
+    def stop(self):
+        self._stopping = True
+        self._terminate(list(self.workers))
+        if self.socket is not None:
+            self.socket.close()
+
+
+class DrainableSite(Site):
+    """
+    Site keeping track of its connections and requests in progress, so
+    that a stopping worker can let them finish.
+    """
+
+    def __init__(self, resource, *args, **kwargs):
+        super().__init__(resource, *args, **kwargs)
+        self.active = 0
+        self.connections = set()
+        self._drained = None
+
+    def buildProtocol(self, addr):
+        return policies.ProtocolWrapper(self, super().buildProtocol(addr))
+
+    # Called by the protocol wrappers, like on a WrappingFactory.
+    def registerProtocol(self, protocol):
+        self.connections.add(protocol)
+
+    def unregisterProtocol(self, protocol):
+        self.connections.discard(protocol)
+        self._check_drained()
+
+    def getResourceFor(self, request):
+        self.active += 1
+        request.notifyFinish().addBoth(self._finished)
+        return super().getResourceFor(request)
+
+    def _finished(self, _):
+        self.active -= 1
+        self._check_drained()
+
+    def drain(self):
+        """
+        Close the connections once no request is in progress. Return a
+        Deferred firing when all of them are closed, their last response
+        written.
+        """
+        d = defer.Deferred()
+        if self._drained is None:
+            self._drained = []
+        self._drained.append(d)
+        self._check_drained()
+        return d
+
+    def _check_drained(self):
+        if self._drained is None or self.active:
+            return
+        if self.connections:
+            for protocol in list(self.connections):
+                protocol.loseConnection()
+            return
+        drained, self._drained = self._drained, []
+        for d in drained:
+            if not d.called:
+                d.callback(None)
+
+
+def drain_on_shutdown(reactor, port, site, timeout):
+    """
+    When a worker reactor stops, stop accepting connections on port
+    first and let the requests of site in progress finish, for up to
+    timeout seconds.
+    """
+    def expired(failure):
+        failure.trap(defer.TimeoutError)
+        print('Stopping with {} requests in progress'.format(site.active))
+
+    def drain():
+        stopped = defer.maybeDeferred(port.stopListening)
+        drained = site.drain()
+        drained.addTimeout(timeout, reactor)
+        drained.addErrback(expired)
+        return defer.gatherResults([stopped, drained])
+
+    reactor.addSystemEventTrigger('before', 'shutdown', drain)
+
+
+def start_heartbeat(reactor, fd):
+    """
+    Beat over the supervisor pipe from a worker reactor.
+    The worker stops when the supervisor is gone.
+    """
+    from twisted.internet import task
+
+    def beat():
+        try:
+            os.write(fd, b'.')
+        except BlockingIOError:
+            pass
+        except OSError:
+            reactor.stop()
+
+    loop = task.LoopingCall(beat)
+    loop.clock = reactor
+    loop.start(HEARTBEAT_INTERVAL)
+    return loop
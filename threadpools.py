@@ -0,0 +1,110 @@
+"""
+Instrumented WSGI thread pools.
+
+The pools count queued and running calls and the time calls wait for a
+thread, and the WSGI resource sheds load with a fast 503 once the queue
+of a pool is full instead of letting requests pile up invisibly.
+"""
+import json
+import threading
+import time
+
+from twisted.python.threadpool import ThreadPool
+from twisted.web.wsgi import WSGIResource
+
+POOLS = []
+
+_current = threading.local()
+
+
+def current_queue_wait():
+    """
+    Seconds the call running on this thread waited for it, None outside
+    of an instrumented pool.
+    """
+    return getattr(_current, 'queue_wait', None)
+
+
+class InstrumentedThreadPool(ThreadPool):
+    """ Thread pool with a bounded queue and live metrics. """
+
+    def __init__(self, minthreads=5, maxthreads=20, name=None, max_queue=100):
+        super().__init__(minthreads, maxthreads, name)
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        POOLS.append(self)
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        enqueued = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def timed(*args, **kw):
+            wait = time.monotonic() - enqueued
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+            _current.queue_wait = wait
+            try:
+                return func(*args, **kw)
+            finally:
+                _current.queue_wait = None
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        super().callInThreadWithCallback(onResult, timed, *args, **kw)
+
+    def saturated(self):
+        """ Whether the queue of calls waiting for a thread is full. """
+        with self._lock:
+            return self.queued >= self.max_queue
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_threads': self.min,
+                'max_threads': self.max,
+                'threads': len(self.threads),
+                'active': self.active,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'queue_wait_total': round(self.queue_wait_total, 6),
+                'queue_wait_max': round(self.queue_wait_max, 6),
+                'queue_wait_avg': round(self.queue_wait_total
+                                        / self.completed, 6)
+                                  if self.completed else 0.0,
+            }
+
+
+class SheddingWSGIResource(WSGIResource):
+    """ WSGI resource answering 503 while its thread pool is saturated. """
+
+    def render(self, request):
+        if self._threadpool.saturated():
+            self._threadpool.reject()
+            request.setResponseCode(503)
+            request.setHeader(b'content-type', b'application/json')
+            request.setHeader(b'retry-after', b'1')
+            return json.dumps({'detail': 'Server busy, try again later.'})\
+                .encode('utf-8')
+        return super().render(request)
+
+
+def pool_stats():
+    """ Statistics of every instrumented pool. """
+    return {pool.name: pool.stats() for pool in POOLS}
@@ -0,0 +1,227 @@
+"""
+Server-sent tile updates.
+
+Browsers subscribe to a set of tiles on /stream instead of polling
+/api/tiles/data/. Every subscribed tile is polled from the core once
+per interval, whatever the number of viewers, and only tiles whose
+data changed are pushed to their subscribers. Polls go through the
+circuit breaker of the data port: while it is open, ticks are skipped.
+"""
+import json
+
+from procbridge.errors import ServerError
+
+from twisted.internet import task, threads
+from twisted.web import resource, server
+
+from django.conf import settings
+from rest_framework import exceptions
+
+from privadome_frontend.api import jsoncodec
+from privadome_frontend.api.circuit import CircuitOpen, get_breaker
+from privadome_frontend.api.views import PROC_PORT_DATA, TILE_BATCH_MAX
+from privadome_frontend.coreproxy import authenticate, procbridge_request
+
+
+class TilePoller:
+    """ Poll one tile and fan its changes out to the subscribers. """
+
+    def __init__(self, hub, name):
+        self.hub = hub
+        self.name = name
+        self.subscribers = set()
+        self.last = None
+        self.failing = False
+        self._polling = False
+        self._loop = task.LoopingCall(self.poll)
+        self._loop.clock = hub.reactor
+
+    def start(self):
+        self._loop.start(self.hub.interval, now=True)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def poll(self):
+        # Skip a tick rather than pile up calls to a slow core.
+        if self._polling:
+            return
+        try:
+            self.hub.breaker.before()
+        except CircuitOpen:
+            return
+        self._polling = True
+        d = self.hub.fetch(self.name)
+        d.addCallbacks(self._received, self._failed)
+        d.addBoth(self._done)
+
+    def _done(self, _):
+        self._polling = False
+
+    def _failed(self, failure):
+        if failure.check(ServerError):
+            # The core answered, it is up.
+            self.hub.breaker.success()
+        else:
+            self.hub.breaker.failure()
+        # Log when the tile starts failing, not on every tick.
+        if not self.failing:
+            self.failing = True
+            print('Tile {} failed: {}'.format(self.name,
+                                              failure.getErrorMessage()))
+
+    def _received(self, data):
+        self.hub.breaker.success()
+        if self.failing:
+            self.failing = False
+            print('Tile {} recovered'.format(self.name))
+        encoded = jsoncodec.dumps({'name': self.name, 'data': data})
+        if encoded == self.last:
+            return
+        self.last = encoded
+        for subscriber in list(self.subscribers):
+            subscriber.send(encoded)
+
+
+class TileHub:
+    """ Pollers of every tile that has at least one subscriber. """
+
+    def __init__(self, reactor, interval, fetch=None, breaker=None):
+        self.reactor = reactor
+        self.interval = interval
+        self.fetch = fetch or self._fetch
+        self.breaker = breaker or get_breaker(PROC_PORT_DATA)
+        self.pollers = {}
+        self._host = settings.PRIVADOME_CORE_HOST
+        self._timeout = getattr(settings, 'PRIVADOME_CORE_TIMEOUT', 30)
+
+    def _fetch(self, name):
+        return procbridge_request(self.reactor, self._host, PROC_PORT_DATA,
+                                  name, None, self._timeout)
+
+    def subscribe(self, subscriber, names):
+        for name in names:
+            poller = self.pollers.get(name)
+            if poller is None:
+                poller = self.pollers[name] = TilePoller(self, name)
+                poller.subscribers.add(subscriber)
+                poller.start()
+            else:
+                poller.subscribers.add(subscriber)
+                if poller.last is not None:
+                    subscriber.send(poller.last)
+
+    def unsubscribe(self, subscriber):
+        for name, poller in list(self.pollers.items()):
+            poller.subscribers.discard(subscriber)
+            if not poller.subscribers:
+                poller.stop()
+                del self.pollers[name]
+
+    def stats(self):
+        return {
+            'tiles': len(self.pollers),
+            'subscribers': sum(len(poller.subscribers)
+                               for poller in self.pollers.values()),
+        }
+
+
+class EventStreamSubscriber:
+    """ A browser connection receiving tile events. """
+
+    def __init__(self, request):
+        self.request = request
+        self.closed = False
+
+    def send(self, encoded):
+        self.request.write(b'event: tile\ndata: ' + encoded + b'\n\n')
+
+    def keepalive(self):
+        self.request.write(b': keepalive\n\n')
+
+
+class TileStreamResource(resource.Resource):
+    """
+    GET /stream?names=tile1,tile2 opens a text/event-stream.
+    EventSource cannot send headers, so the token may also be
+    given as a token query parameter.
+    """
+    isLeaf = True
+
+    def __init__(self, reactor, auth_threadpool, hub, keepalive=15):
+        super().__init__()
+        self._reactor = reactor
+        self._auth_threadpool = auth_threadpool
+        self._hub = hub
+        self._subscribers = set()
+        self._keepalive = task.LoopingCall(self._send_keepalive)
+        self._keepalive.clock = reactor
+        self._keepalive_interval = keepalive
+
+    def _send_keepalive(self):
+        for subscriber in list(self._subscribers):
+            subscriber.keepalive()
+
+    def render_GET(self, request):
+        try:
+            names = [name.decode('utf-8')
+                     for value in request.args.get(b'names', [])
+                     for name in value.split(b',') if name]
+        except UnicodeDecodeError:
+            return self._error(request, 400, 'Tile names must be UTF-8.')
+        names = list(dict.fromkeys(names))
+        if not names or len(names) > TILE_BATCH_MAX:
+            return self._error(request, 400, 'Between 1 and {} tile names'
+                               ' are required.'.format(TILE_BATCH_MAX))
+
+        header = request.getHeader(b'authorization')
+        if header is None and b'token' in request.args:
+            header = b'Token ' + request.args[b'token'][0]
+
+        subscriber = EventStreamSubscriber(request)
+        request.notifyFinish().addBoth(self._closed, subscriber)
+        d = threads.deferToThreadPool(self._reactor, self._auth_threadpool,
+                                      authenticate, header or b'')
+        d.addCallback(lambda _: self._open(subscriber, names))
+        d.addErrback(self._failed, subscriber)
+        return server.NOT_DONE_YET
+
+    def _open(self, subscriber, names):
+        if subscriber.closed:
+            return
+        request = subscriber.request
+        request.setHeader(b'content-type', b'text/event-stream')
+        request.setHeader(b'cache-control', b'no-cache')
+        request.write(b'retry: 3000\n\n')
+
+        self._subscribers.add(subscriber)
+        if not self._keepalive.running:
+            self._keepalive.start(self._keepalive_interval, now=False)
+        self._hub.subscribe(subscriber, names)
+
+    def _closed(self, _, subscriber):
+        subscriber.closed = True
+        self._subscribers.discard(subscriber)
+        self._hub.unsubscribe(subscriber)
+        if not self._subscribers and self._keepalive.running:
+            self._keepalive.stop()
+
+    def _failed(self, failure, subscriber):
+        if subscriber.closed:
+            return
+        request = subscriber.request
+        if failure.check(exceptions.APIException):
+            request.setHeader(b'www-authenticate', b'Token')
+            request.write(self._error(request, failure.value.status_code,
+                                      str(failure.value.detail)))
+        else:
+            print(failure.getErrorMessage())
+            request.write(self._error(request, 500, 'Server Error (500)'))
+        request.finish()
+
+    @staticmethod
+    def _error(request, code, detail):
+        request.setResponseCode(code)
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps({'detail': detail}).encode('utf-8')